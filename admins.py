@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from telegram import ChatMember, ChatMemberUpdated, Message
+
+logger = logging.getLogger(__name__)
+
+ADMIN_STATUSES = {ChatMember.ADMINISTRATOR, ChatMember.OWNER}
+GONE_STATUSES = {ChatMember.LEFT, ChatMember.BANNED}
+
+
+class AdminCache:
+    """Кэш администраторов групп.
+
+    Список админов чата загружается через get_chat_administrators один раз,
+    а дальше поддерживается обновлениями chat_member и my_chat_member.
+    Проверка - поиск в set без запросов к API. Раз в ttl секунд список
+    перечитывается в фоне на случай пропущенных обновлений (например, в
+    другом процессе вебхука или пока бот не был админом группы).
+    """
+
+    def __init__(self, ttl: float = 600):
+        self.ttl = ttl
+        self._admins: Dict[int, Set[int]] = {}
+        self._loaded_at: Dict[int, float] = {}
+        self._loading: Dict[int, asyncio.Task] = {}
+
+    async def is_admin(self, bot, chat_id: int, user_id: int) -> bool:
+        """Является ли пользователь администратором чата"""
+        admins = self._admins.get(chat_id)
+        if admins is None:
+            admins = await self.refresh(bot, chat_id)
+        elif time.monotonic() - self._loaded_at[chat_id] > self.ttl and chat_id not in self._loading:
+            # Отвечаем по текущему списку, а свежий загружаем в фоне
+            task = self._start_refresh(bot, chat_id)
+            task.add_done_callback(self._log_refresh_error)
+        return user_id in admins
+
+    async def refresh(self, bot, chat_id: int) -> Set[int]:
+        """Перечитать список администраторов (одновременные вызовы ждут одну загрузку)"""
+        task = self._loading.get(chat_id) or self._start_refresh(bot, chat_id)
+        return await asyncio.shield(task)
+
+    def _start_refresh(self, bot, chat_id: int) -> asyncio.Task:
+        task = asyncio.create_task(self._load(bot, chat_id))
+        self._loading[chat_id] = task
+        task.add_done_callback(lambda _: self._loading.pop(chat_id, None))
+        return task
+
+    async def _load(self, bot, chat_id: int) -> Set[int]:
+        administrators = await bot.get_chat_administrators(chat_id)
+        admins = {member.user.id for member in administrators}
+        self._admins[chat_id] = admins
+        self._loaded_at[chat_id] = time.monotonic()
+        return admins
+
+    @staticmethod
+    def _log_refresh_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"Error refreshing chat administrators: {task.exception()}")
+
+    def update_member(self, member_update: ChatMemberUpdated, bot_id: Optional[int] = None):
+        """Учесть изменение статуса участника из chat_member / my_chat_member"""
+        chat_id = member_update.chat.id
+        user_id = member_update.new_chat_member.user.id
+        status = member_update.new_chat_member.status
+
+        if user_id == bot_id and status in GONE_STATUSES:
+            # Бота убрали из группы - список больше не нужен
+            self.forget(chat_id)
+            return
+
+        admins = self._admins.get(chat_id)
+        if admins is None:
+            # Чат еще не загружен - загрузим целиком при первой проверке
+            return
+        if status in ADMIN_STATUSES:
+            admins.add(user_id)
+        else:
+            admins.discard(user_id)
+
+    def snapshot(self) -> Dict[int, Tuple[List[int], float]]:
+        """Списки админов для снимка: чат -> (админы, сколько секунд назад загружен)"""
+        now = time.monotonic()
+        return {chat_id: (list(admins), now - self._loaded_at[chat_id])
+                for chat_id, admins in self._admins.items()}
+
+    def restore(self, state: Dict[int, Tuple[List[int], float]], elapsed: float):
+        """
+        Загрузить списки из снимка, сделанного elapsed секунд назад, - без
+        запросов к API при запуске; устаревшие перечитаются в фоне, как обычно.
+        """
+        now = time.monotonic()
+        for chat_id, (admins, age) in state.items():
+            self._admins[chat_id] = set(admins)
+            self._loaded_at[chat_id] = now - age - elapsed
+
+    def forget(self, chat_id: int):
+        """Забыть список администраторов чата"""
+        self._admins.pop(chat_id, None)
+        self._loaded_at.pop(chat_id, None)
+
+
+def is_anonymous_admin(message: Optional[Message]) -> bool:
+    """Сообщение от анонимного администратора (отправлено от имени самой группы)"""
+    return bool(message and message.sender_chat and message.sender_chat.id == message.chat.id)
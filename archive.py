@@ -0,0 +1,351 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Заголовок блока в сегменте: длина сжатых данных и их CRC32
+BLOCK_HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.seg'
+INDEX_FILE = 'index.sqlite3'
+
+
+def read_block(f, offset: int) -> Optional[List[Dict[str, Any]]]:
+    """Записи блока по смещению в сегменте; None - блок оборван или испорчен"""
+    f.seek(offset)
+    header = f.read(BLOCK_HEADER.size)
+    if len(header) < BLOCK_HEADER.size:
+        return None
+    length, crc = BLOCK_HEADER.unpack(header)
+    data = f.read(length)
+    if len(data) < length or zlib.crc32(data) != crc:
+        return None
+    return [json.loads(line) for line in zlib.decompress(data).decode('utf-8').splitlines()]
+
+
+class Archive:
+    """Сжатый архив всей переписки в файлах только для дописывания.
+
+    Записи (сообщения пользователей и ответы админов) копятся в памяти
+    и раз в flush_interval секунд дописываются в текущий сегмент блоками:
+    JSON-строки, сжатые zlib, с заголовком (длина, CRC32). Несжатый блок
+    не больше block_size, поэтому экспорт держит в памяти один блок, а не
+    всю переписку. Индекс в SQLite помнит, в каких блоках есть записи темы
+    и пользователя, и экспорт читает только их.
+
+    Сегмент закрывается, когда дорастает до segment_size; закрытые
+    сегменты старше retention секунд и самые старые сверх max_size
+    удаляются вместе со своими записями индекса. Диск и индекс пишутся
+    в отдельном потоке, обработчики только кладут запись в список.
+    У каждого процесса вебхука свои сегменты (worker в имени файла),
+    индекс общий. После сбоя оборванный хвост сегмента отрезается,
+    а блоки, не успевшие попасть в индекс, индексируются заново.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blocks (
+            chat_id INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            segment TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (chat_id, topic_id, segment, offset)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS blocks_user ON blocks (user_id, created_at);
+        CREATE INDEX IF NOT EXISTS blocks_segment ON blocks (segment);
+    """
+
+    def __init__(self, directory: str, worker: int = 0, flush_interval: float = 5.0,
+                 block_size: int = 256 * 1024, segment_size: int = 64 * 2**20,
+                 max_size: Optional[int] = None, retention: Optional[float] = None,
+                 cleanup_interval: float = 3600):
+        self.directory = directory
+        self.worker = worker
+        self.flush_interval = flush_interval
+        self.block_size = block_size
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.retention = retention
+        self.cleanup_interval = cleanup_interval
+        self._pending: List[Dict[str, Any]] = []
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        # Все записи на диск - в одном потоке, по порядку
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._file = None
+        # Блоки, записанные в сегмент, но еще не попавшие в индекс: (сегмент, смещение, записи)
+        self._unindexed: List[Tuple[str, int, List[Dict[str, Any]]]] = []
+        self._segment = ''
+        self._number = 0
+        self._cleaned_at = 0.0
+
+    @property
+    def index_file(self) -> str:
+        return os.path.join(self.directory, INDEX_FILE)
+
+    async def _run(self, func: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive')
+        await self._run(self._open)
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    def append(self, user_id: int, topic: Tuple[int, int], text: Optional[str], from_admin: bool = False,
+               author: Optional[str] = None, media: Optional[str] = None):
+        """Добавить сообщение в архив (запишется на диск в фоне)"""
+        self._pending.append({
+            'time': time.time(),
+            'user_id': user_id,
+            'chat_id': topic[0],
+            'topic_id': topic[1],
+            'from_admin': from_admin,
+            'author': author,
+            'text': text,
+            'media': media
+        })
+
+    async def flush(self):
+        """Дописать накопленные записи в сегмент"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            written = [0]
+            try:
+                await self._run(self._write, pending, written)
+            except Exception:
+                # Не потеряем записи: допишем в следующий раз те, что не попали на диск
+                self._pending = pending[written[0]:] + self._pending
+                raise
+
+    async def export(self, filename: str, format_record: Callable[[Dict[str, Any]], str],
+                     topic: Optional[Tuple[int, int]] = None, user_id: Optional[int] = None) -> int:
+        """
+        Записать в файл переписку темы или пользователя по порядку, строку
+        на запись (format_record). Возвращает количество записей.
+        """
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._export, filename, format_record, topic, user_id)
+
+    # ----- поток записи -----
+    def _segment_path(self, segment: str) -> str:
+        return os.path.join(self.directory, segment)
+
+    def _own_segments(self) -> List[str]:
+        """Сегменты этого процесса от старых к новым"""
+        prefix = f'{self.worker}-'
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.startswith(prefix) and name.endswith(SEGMENT_SUFFIX))
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._conn = sqlite3.connect(self.index_file, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+
+        segments = self._own_segments()
+        if segments:
+            self._segment = segments[-1]
+            self._number = int(self._segment[len(f'{self.worker}-'):-len(SEGMENT_SUFFIX)])
+            self._recover()
+            self._file = open(self._segment_path(self._segment), 'ab')
+        else:
+            self._rotate()
+        self._cleanup()
+
+    def _close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def _recover(self):
+        """Проиндексировать блоки после последнего известного индексу и отрезать оборванный хвост"""
+        path = self._segment_path(self._segment)
+        last = self._conn.execute('SELECT max(offset) FROM blocks WHERE segment = ?',
+                                  (self._segment,)).fetchone()[0]
+        recovered = 0
+        with open(path, 'r+b') as f:
+            # Если и последний проиндексированный блок не уцелел - проверяем сегмент с начала
+            offset = 0
+            if last is not None and read_block(f, last) is not None:
+                offset = f.tell()
+            while True:
+                records = read_block(f, offset)
+                if records is None:
+                    break
+                self._index(records, offset)
+                recovered += 1
+                offset = f.tell()
+            size = f.seek(0, os.SEEK_END)
+            if size > offset:
+                logger.warning(f"Archive segment {self._segment}: dropped {size - offset} damaged bytes")
+                f.truncate(offset)
+        self._conn.execute('DELETE FROM blocks WHERE segment = ? AND offset >= ?', (self._segment, offset))
+        self._conn.commit()
+        if recovered:
+            logger.info(f"Archive segment {self._segment}: indexed {recovered} blocks after restart")
+
+    def _rotate(self):
+        if self._file:
+            self._file.close()
+        self._number += 1
+        self._segment = f'{self.worker}-{self._number:08d}{SEGMENT_SUFFIX}'
+        self._file = open(self._segment_path(self._segment), 'ab')
+
+    def _write(self, records: List[Dict[str, Any]], written: List[int]):
+        """Дописать записи блоками; written[0] - сколько из них уже на диске (если запись прервется)"""
+        try:
+            start, size = 0, 0
+            lines = [json.dumps(record, ensure_ascii=False).encode('utf-8') for record in records]
+            for i, line in enumerate(lines):
+                if i > start and size + len(line) > self.block_size:
+                    self._write_block(lines[start:i], records[start:i])
+                    written[0] = i
+                    start, size = i, 0
+                size += len(line) + 1
+            self._write_block(lines[start:], records[start:])
+            written[0] = len(records)
+        finally:
+            # Записанные блоки индексируем, даже если следующий не записался
+            self._index_written()
+
+        if self._file.tell() >= self.segment_size:
+            self._rotate()
+            self._cleanup()
+        elif time.time() - self._cleaned_at >= self.cleanup_interval:
+            self._cleanup()
+
+    def _write_block(self, lines: List[bytes], records: List[Dict[str, Any]]):
+        data = zlib.compress(b'\n'.join(lines))
+        offset = self._file.tell()
+        try:
+            self._file.write(BLOCK_HEADER.pack(len(data), zlib.crc32(data)) + data)
+            self._file.flush()
+        except Exception:
+            # Оборванный блок не должен остаться перед следующими - отрезаем его
+            try:
+                self._file.truncate(offset)
+            except OSError as e:
+                logger.error(f"Archive segment {self._segment}: cannot cut a torn block at {offset}: {e}")
+            raise
+        self._unindexed.append((self._segment, offset, records))
+
+    def _index_written(self):
+        # Если индекс не записался, блоки останутся в списке до следующей записи
+        for segment, offset, records in self._unindexed:
+            self._index(records, offset, segment)
+        self._conn.commit()
+        self._unindexed.clear()
+
+    def _index(self, records: List[Dict[str, Any]], offset: int, segment: Optional[str] = None):
+        topics = {(record['chat_id'], record['topic_id'], record['user_id']) for record in records}
+        self._conn.executemany(
+            'INSERT OR IGNORE INTO blocks (chat_id, topic_id, user_id, segment, offset, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [topic + (segment or self._segment, offset, records[0]['time']) for topic in topics]
+        )
+
+    def _cleanup(self):
+        """Удалить закрытые сегменты старше retention и самые старые сверх max_size"""
+        self._cleaned_at = time.time()
+        closed = [segment for segment in self._own_segments() if segment != self._segment]
+        sizes = {segment: os.path.getsize(self._segment_path(segment)) for segment in closed}
+        total = sum(sizes.values()) + self._file.tell()
+        expired = []
+        for segment in closed:
+            too_old = (self.retention is not None
+                       and os.path.getmtime(self._segment_path(segment)) < time.time() - self.retention)
+            too_big = self.max_size is not None and total > self.max_size
+            if not (too_old or too_big):
+                break
+            expired.append(segment)
+            total -= sizes[segment]
+
+        for segment in expired:
+            # Сначала индекс: экспорт не должен искать блоки в удаленном файле
+            with self._conn:
+                self._conn.execute('DELETE FROM blocks WHERE segment = ?', (segment,))
+            os.remove(self._segment_path(segment))
+        if expired:
+            logger.info(f"Archive: removed {len(expired)} old segments")
+
+    # ----- экспорт (в пуле потоков, параллельно с записью) -----
+    def _blocks(self, topic: Optional[Tuple[int, int]], user_id: Optional[int]) -> List[Tuple[str, int]]:
+        conn = sqlite3.connect(self.index_file, timeout=30)
+        try:
+            if topic is not None:
+                rows = conn.execute('SELECT segment, offset FROM blocks WHERE chat_id = ? AND topic_id = ? '
+                                    'ORDER BY created_at, segment, offset', topic)
+            else:
+                rows = conn.execute('SELECT DISTINCT segment, offset, created_at FROM blocks WHERE user_id = ? '
+                                    'ORDER BY created_at, segment, offset', (user_id,))
+            return [(segment, offset) for segment, offset, *_ in rows]
+        finally:
+            conn.close()
+
+    def iter_records(self, topic: Optional[Tuple[int, int]] = None,
+                     user_id: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Записи темы (или всех тем пользователя) по порядку, по одному блоку в памяти"""
+        files = {}
+        try:
+            for segment, offset in self._blocks(topic, user_id):
+                f = files.get(segment)
+                if f is None:
+                    try:
+                        f = files[segment] = open(self._segment_path(segment), 'rb')
+                    except FileNotFoundError:
+                        # Сегмент удален по сроку хранения, пока шел экспорт
+                        continue
+                records = read_block(f, offset)
+                if records is None:
+                    logger.warning(f"Archive segment {segment}: damaged block at {offset}")
+                    continue
+                for record in records:
+                    if (topic is None and record['user_id'] == user_id
+                            or topic is not None and (record['chat_id'], record['topic_id']) == topic):
+                        yield record
+        finally:
+            for f in files.values():
+                f.close()
+
+    def _export(self, filename: str, format_record: Callable[[Dict[str, Any]], str],
+                topic: Optional[Tuple[int, int]], user_id: Optional[int]) -> int:
+        count = 0
+        with open(filename, 'w', encoding='utf-8') as out:
+            for record in self.iter_records(topic, user_id):
+                out.write(format_record(record) + '\n')
+                count += 1
+        return count
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error writing archive: {e}")
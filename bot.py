@@ -1,125 +1,1188 @@
 import asyncio
+import bisect
+import functools
+import itertools
 import logging
-import shelve
+import os
+import secrets
 import sys
+import tempfile
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ForumTopic
+from telegram import (Update, InlineKeyboardButton, InlineKeyboardMarkup, ForumTopic, Message, MessageEntity,
+                      InputFile, ReplyParameters)
+from telegram.constants import MessageAttachmentType
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
+    ApplicationHandlerStop,
     ContextTypes,
+    TypeHandler,
     filters
 )
 
+from admins import GONE_STATUSES, AdminCache, is_anonymous_admin
+from archive import Archive
+from chat_registry import ChatRegistry, worker_filename
+from coalesce import MergedText, merge_texts, utf16_len
+from dispatch import ConversationUpdateProcessor
+from flood import FloodControl
+from idle import IdleScheduler
+from logs import bind, setup_logging, start_trace
+from message_index import MessageIndex
+from outbox import DEAD, DONE, PENDING, DeliveryPostponed, Outbox, OutboxEntry, part_key
+from placement import PlacementPolicy, create_policy
+from metrics import (ACTIVE_TOPICS, DATABASE_SECONDS, MESSAGES_THROTTLED, QUEUE_DEPTH, SPARE_TOPICS, TOPICS_AUTO_CLOSED,
+                     TOPICS_CREATED, TOPICS_REOPENED, instrument_handlers, serve_metrics, timed)
+from relay import RelayBuffer
+from sender import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, OutboundScheduler, PassThroughLimiter, TokenBucket
+from snapshot import load_snapshot, save_snapshot, snapshot_age
+from storage import Changes, SQLiteBackend, StorageBackend, TopicInfo, TopicOwners, TopicRef, create_backend
+from topic_pool import TopicPool
+from transcripts import Transcripts
+from webhook import run_webhook
+
 # ========== НАСТРОЙКИ ==========
 API_TOKEN_FILE = 'api'  # Файл с токеном бота
-ADMIN_GROUP_ID = None  # ID группы для админов (заполнится автоматически)
 DATABASE_FILE = 'bot_database.db'
-
-# Включим логирование
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+STORAGE_BACKEND = 'shelve'  # Хранилище базы: 'shelve' или 'sqlite'
+SQLITE_DATABASE_FILE = 'bot_database.sqlite3'  # Файл базы для хранилища 'sqlite'
+SQLITE_POOL_SIZE = 4  # Количество соединений SQLite
+DATABASE_PRELOAD = True  # Загружать все связи в память при старте
+DATABASE_FLUSH_INTERVAL = 5.0  # Как часто сбрасывать изменения базы на диск (сек)
+DATABASE_FLUSH_THRESHOLD = 100  # Сбросить раньше, если накопилось столько изменений
+GLOBAL_RATE_LIMIT = 30  # Сообщений в секунду на всего бота (лимит Telegram)
+GROUP_RATE_LIMIT = 20  # Сообщений в минуту в одну группу (лимит Telegram)
+GROUP_BURST = 3  # Сколько сообщений в группу можно отправить подряд без паузы
+PRIVATE_RATE_LIMIT = 1  # Сообщений в секунду в один личный чат
+SEND_MAX_RETRIES = 3  # Сколько раз повторять запрос после RetryAfter
+RELAY_BATCH_WINDOW = 0.1  # Сколько ждать остальные сообщения пачки перед пересылкой (сек)
+MEDIA_GROUP_WINDOW = 1.0  # Сколько ждать следующую часть альбома перед пересылкой (сек)
+# Склейка текстов пользователя, пришедших подряд, в одно сообщение в теме. Выключена (0):
+# каждый текст задерживается на это время. Чтобы включить, задайте паузу, например 1.0
+TEXT_COALESCE_WINDOW = 0  # Склеивать тексты с паузой меньше этой (сек); 0 - не склеивать
+TEXT_COALESCE_MAX_DELAY = 5.0  # Дольше этого первое сообщение пачки не задерживается (сек)
+MESSAGE_MAX_LENGTH = 4096  # Ограничение Telegram на длину сообщения
+MERGED_TEXTS_CACHE_SIZE = 10_000  # Сколько склеенных сообщений помнить, чтобы править их по правке одной из частей
+MAX_CONCURRENT_UPDATES = 256  # Сколько обновлений разных разговоров обрабатывать одновременно
+WEBHOOK_URL = None  # Публичный URL вебхука (например, https://example.com/webhook); None - polling
+WEBHOOK_LISTEN = '0.0.0.0'  # Адрес HTTP-сервера вебхука
+WEBHOOK_PORT = 8443  # Порт HTTP-сервера вебхука (TLS - на прокси перед ботом)
+WEBHOOK_SECRET_TOKEN = None  # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; None - сгенерировать
+WEBHOOK_WORKERS = 4  # Количество процессов-обработчиков в режиме вебхука
+WEBHOOK_QUEUE_SIZE = 10_000  # Обновлений в очереди процесса, сверх которых Telegram получит 503 и повторит
+PLACEMENT_POLICY = 'least_loaded'  # Выбор группы для новой темы: 'least_loaded', 'hash' или 'language'
+LANGUAGE_GROUPS = {}  # Для 'language': код языка -> ID группы, например {'en': -100123, 'ru': -100456}
+ADMIN_CACHE_TTL = 600  # Как часто перечитывать список админов группы в фоне (сек)
+TOPIC_POOL_SIZE = 5  # Сколько заранее созданных тем держать в каждой группе для новых обращений; 0 - не держать
+TOPIC_POOL_LOW_WATERMARK = 2  # Досоздавать темы про запас, когда их в группе остается столько или меньше
+POOL_TOPIC_NAME = '⏳ Свободная тема'  # Название темы в запасе (при выдаче переименовывается)
+TOPIC_IDLE_CLOSE_HOURS = 72  # Закрывать темы без сообщений дольше стольких часов (вернувшемуся пользователю - открыть снова); None - не закрывать
+CLOSEALL_IDLE_DAYS = 7  # /closeall закрывает темы без сообщений дольше стольких дней
+CLOSEALL_CONCURRENCY = 4  # Сколько тем /closeall закрывает одновременно
+CLOSEALL_PROGRESS_INTERVAL = 10  # Как часто обновлять сообщение о ходе /closeall (сек)
+BROADCAST_RATE = 20  # Сообщений в секунду при /broadcast (лимит Telegram - 30, остальное остается переписке)
+BROADCAST_CONCURRENCY = 10  # Сколько сообщений рассылки отправлять одновременно
+BROADCAST_PROGRESS_INTERVAL = 10  # Как часто сохранять ход /broadcast и обновлять сообщение о нем (сек)
+FLOOD_RATE_PER_MINUTE = 10  # Сколько сообщений в минуту пользователь может присылать постоянно; None - без ограничения
+FLOOD_BURST = 10  # Сколько сообщений подряд можно прислать без паузы (альбом - до 10 сообщений)
+FLOOD_MUTE = 60  # На сколько секунд глушить пользователя за превышение (каждый следующий раз - вдвое дольше)
+FLOOD_MAX_MUTE = 3600  # Дольше этого не глушить (сек)
+ADMIN_REPLIES_ONLY = False  # Пересылать пользователям ответы только администраторов группы
+ACK_MODE = 'reaction'  # Подтверждение доставки: 'reaction' (реакция на сообщение), 'status' (у админов - одно сообщение в теме, которое обновляется) или 'message' (новое сообщение каждый раз)
+ACK_REACTION = '👌'  # Реакция-подтверждение (только из разрешенных Telegram)
+ACK_BATCH_WINDOW = 1.0  # Подтверждения ответов в одной теме за это время объединяются (сек)
+METRICS_LISTEN = '127.0.0.1'  # Адрес HTTP-сервера метрик Prometheus
+METRICS_PORT = 9090  # Порт метрик (у процессов вебхука - METRICS_PORT + номер); None - выключить
+MESSAGE_INDEX_FILE = 'message_index.sqlite3'  # Связи ID сообщений (ответы с цитатой и правки)
+MESSAGE_INDEX_CACHE_SIZE = 100_000  # Сколько связей сообщений держать в памяти
+MESSAGE_INDEX_RETENTION_DAYS = 30  # Сколько дней хранить связи сообщений
+OUTBOX_FILE = 'outbox.sqlite3'  # Журнал исходящих пересылок (недоставленное уходит после перезапуска)
+OUTBOX_MAX_ATTEMPTS = 8  # Сколько раз пытаться доставить сообщение, прежде чем считать его недоставленным
+OUTBOX_RETRY_DELAY = 1.0  # Пауза перед первым повтором, дальше растет вдвое (сек)
+OUTBOX_MAX_RETRY_DELAY = 300  # Максимальная пауза между повторами (сек)
+TRANSCRIPTS_FILE = 'transcripts.sqlite3'  # Архив текстов переписки для поиска /search
+SEARCH_RESULTS = 10  # Сколько тем показывать в ответ на /search
+ARCHIVE_DIR = 'archive'  # Сжатый архив всей переписки (для /export); у процессов вебхука свои сегменты
+ARCHIVE_SEGMENT_MB = 64  # Размер файла-сегмента архива, после которого начинается новый
+ARCHIVE_MAX_MB = 2048  # Сколько места может занимать архив каждого процесса; None - без ограничения
+ARCHIVE_RETENTION_DAYS = 365  # Сколько дней хранить переписку в архиве; None - всегда
+EXPORT_MAX_MB = 50  # Ограничение Telegram на размер файла, который отправляет бот
+CHAT_REGISTRY_FILE = 'chats.json'  # Группы, из которых бот получал обновления (для script_bot_groups_search.py)
+OUTBOX_RETENTION_HOURS = 24  # Сколько помнить доставленные сообщения, чтобы не доставить дважды
+LOG_FORMAT = 'json'  # Формат логов: 'json' (запись - строка JSON с trace_id, user_id, topic_id) или 'text'
+LOG_SAMPLE_RATES = {'httpx': 0.1}  # Какую долю INFO-записей логгера писать (httpx - строка на каждый запрос к API)
+CONSOLE_SETUP_GUIDE = True  # Печатать инструкцию по настройке, если бот запущен в терминале (иначе - только в лог)
+SHUTDOWN_TIMEOUT = 30  # Сколько ждать отправки очередей при остановке (сек); неотправленное уйдет после перезапуска
+SNAPSHOT_FILE = 'snapshot.bin'  # Снимок состояния при остановке для быстрого запуска (у процессов вебхука свой); None - не сохранять
+
+# Включим логирование: записи форматирует и пишет фоновый поток, а не поток событий
+setup_logging(logging.INFO, json_format=LOG_FORMAT == 'json', sample_rates=LOG_SAMPLE_RATES)
 logger = logging.getLogger(__name__)
 
 
 # ========== БАЗА ДАННЫХ ==========
 class Database:
-    """Простая база данных для хранения связей пользователь-тема"""
-
-    def __init__(self, filename=DATABASE_FILE):
-        self.filename = filename
-
-    def get_user_topic(self, user_id: int) -> Optional[int]:
-        """Получить ID темы для пользователя"""
-        with shelve.open(self.filename) as db:
-            return db.get(f'user_{user_id}')
+    """База данных для хранения связей пользователь-тема.
+
+    Админских групп может быть несколько, поэтому тема задается парой
+    (chat_id, topic_id) - TopicRef. Связи держатся в памяти в двусторонних словарях, а изменения копятся
+    и пачками сбрасываются в хранилище (shelve или SQLite) фоновой задачей
+    по интервалу или по количеству изменений. При preload=True все связи
+    загружаются при старте; иначе промахи дочитываются из хранилища и
+    кэшируются (для очень больших баз).
+
+    Для каждой темы хранятся сведения (TopicInfo: время создания и последней
+    активности, счетчики сообщений, время первого ответа), а общая
+    статистика копится в ключе stats, поэтому /stats ничего не пересчитывает.
+
+    При shared=True базу одновременно используют несколько процессов
+    (режим вебхука): связи не кэшируются, каждое изменение сразу пишется
+    в хранилище, а настройки перечитываются по интервалу записи. Ключи,
+    которые пишет только один процесс (статистика, задания), получают
+    суффикс с номером процесса worker.
+    """
 
-    def set_user_topic(self, user_id: int, topic_id: int):
+    def __init__(self, backend: StorageBackend, preload: bool = True, shared: bool = False,
+                 flush_interval: float = DATABASE_FLUSH_INTERVAL,
+                 flush_threshold: int = DATABASE_FLUSH_THRESHOLD, worker: int = 0):
+        self.backend = backend
+        self.shared = shared
+        self.worker = worker
+        self.preload = preload and not shared
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+
+        self._user_topics: Dict[int, TopicRef] = {}
+        self._topic_users: Dict[TopicRef, int] = {}
+        self._topics: Dict[TopicRef, TopicInfo] = {}
+        self._values: Dict[str, Any] = {}
+        self._own_keys = set()
+
+        self._dirty = Changes()
+        self._flush_lock = asyncio.Lock()
+        self._flush_needed = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    # ----- загрузка и запись на диск -----
+    async def open(self, snapshot: Optional[Dict[str, Any]] = None):
+        """
+        Открыть хранилище, загрузить данные и запустить фоновую запись.
+        snapshot - связи из снимка прошлой остановки (см. snapshot()): если
+        хранилище с тех пор не менялось, они берутся из снимка, а не читаются.
+        """
+        await self.backend.open()
+        self._values = await self.backend.load_values()
+        if self.preload:
+            snapshot_id = self._values.get(self.own_key('snapshot_id'))
+            from_snapshot = snapshot is not None and snapshot['id'] == snapshot_id
+            if from_snapshot:
+                self._user_topics = snapshot['mappings']
+                self._topics = {topic: TopicInfo._make(info) for topic, info in snapshot['topics'].items()}
+            else:
+                self._user_topics = await self.backend.load_mappings()
+                self._topics = await self.backend.load_topics()
+            self._topic_users = {topic: user_id for user_id, topic in self._user_topics.items()}
+            # Темам из старой базы без сведений отсчитываем активность с этого запуска
+            now = time.time()
+            opened: Dict[str, int] = {}
+            for topic, user_id in self._topic_users.items():
+                if topic not in self._topics:
+                    self._topics[topic] = TopicInfo(user_id, now, now)
+                    self._dirty.set_topic(topic, self._topics[topic])
+                    key = f'open_{topic[0]}'
+                    opened[key] = opened.get(key, 0) + 1
+            if opened:
+                self._update_stats(topics_created=sum(opened.values()), **opened)
+            logger.info(f"Database loaded{' from snapshot' if from_snapshot else ''}: "
+                        f"{len(self._user_topics)} users")
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Остановить фоновую запись, сохранить все изменения и закрыть хранилище"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        await self.backend.close()
+
+    async def snapshot(self) -> Optional[Dict[str, Any]]:
+        """
+        Связи и сведения о темах для снимка при остановке (None - без preload
+        снимок не нужен). Метка снимка сохраняется в хранилище, поэтому
+        вызывается перед close(): при запуске снимок используется, только
+        если метка в хранилище совпадает с его меткой.
+        """
+        if not self.preload:
+            return None
+        snapshot_id = secrets.token_hex(8)
+        await self.set_value(self.own_key('snapshot_id'), snapshot_id)
+        return {
+            'id': snapshot_id,
+            'mappings': self._user_topics,
+            'topics': {topic: tuple(info) for topic, info in self._topics.items()}
+        }
+
+    @timed(DATABASE_SECONDS)
+    async def flush(self):
+        """Записать накопленные изменения в хранилище"""
+        async with self._flush_lock:
+            changes, self._dirty = self._dirty, Changes()
+            if not changes:
+                return
+            try:
+                await self.backend.write(changes)
+            except Exception:
+                self._dirty.merge_older(changes)
+                raise
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+                if self.shared:
+                    values = await self.backend.load_values()
+                    # Свои ключи этого процесса в памяти не старее, чем в хранилище
+                    values.update({key: self._values[key] for key in self._own_keys
+                                   if key in self._values})
+                    self._values = values
+            except Exception as e:
+                logger.error(f"Error flushing database: {e}")
+
+    async def _changed(self):
+        if self.shared:
+            await self.flush()
+        elif len(self._dirty) >= self.flush_threshold:
+            self._flush_needed.set()
+
+    def _remember(self, user_id: int, topic: TopicRef):
+        """Закэшировать связь, прочитанную из хранилища"""
+        if not self.shared:
+            self._user_topics[user_id] = topic
+            self._topic_users[topic] = user_id
+
+    # ----- связи пользователь-тема -----
+    @timed(DATABASE_SECONDS)
+    async def get_user_topic(self, user_id: int) -> Optional[TopicRef]:
+        """Получить тему пользователя: (ID группы, ID темы)"""
+        topic = self._user_topics.get(user_id)
+        if topic is None and not self.preload and user_id not in self._dirty.mappings:
+            topic = await self.backend.get_user_topic(user_id)
+            if topic is not None and user_id not in self._dirty.mappings:
+                self._remember(user_id, topic)
+        return topic
+
+    @timed(DATABASE_SECONDS)
+    async def set_user_topic(self, user_id: int, topic: TopicRef):
         """Сохранить связь пользователь-тема"""
-        with shelve.open(self.filename) as db:
-            db[f'user_{user_id}'] = topic_id
-            db[f'topic_{topic_id}'] = user_id
-
-    def get_user_by_topic(self, topic_id: int) -> Optional[int]:
-        """Получить пользователя по ID темы"""
-        with shelve.open(self.filename) as db:
-            return db.get(f'topic_{topic_id}')
-
-    def delete_user(self, user_id: int):
-        """Удалить пользователя из базы"""
-        with shelve.open(self.filename) as db:
-            topic_id = db.get(f'user_{user_id}')
-            if topic_id:
-                if f'user_{user_id}' in db:
-                    del db[f'user_{user_id}']
-                if f'topic_{topic_id}' in db:
-                    del db[f'topic_{topic_id}']
-
-    def save_group_id(self, group_id: int):
-        """Сохранить ID группы админов"""
-        with shelve.open(self.filename) as db:
-            db['admin_group_id'] = group_id
-
-    def get_group_id(self) -> Optional[int]:
-        """Получить ID группы админов"""
-        with shelve.open(self.filename) as db:
-            return db.get('admin_group_id')
+        old_topic = self._user_topics.get(user_id)
+        if old_topic is not None and old_topic != topic:
+            self._topic_users.pop(old_topic, None)
+
+        self._remember(user_id, topic)
+        self._dirty.set_mapping(user_id, topic)
+        await self._changed()
+
+    @timed(DATABASE_SECONDS)
+    async def get_user_by_topic(self, chat_id: int, topic_id: int) -> Optional[int]:
+        """Получить пользователя по теме в группе"""
+        topic = (chat_id, topic_id)
+        user_id = self._topic_users.get(topic)
+        if user_id is None and not self.preload:
+            user_id = await self.backend.get_user_by_topic(chat_id, topic_id)
+            # Связь могла измениться, пока изменения еще не записаны
+            if user_id is not None and self._dirty.mappings.get(user_id, topic) != topic:
+                return None
+            if user_id is not None:
+                self._remember(user_id, topic)
+        return user_id
+
+    @timed(DATABASE_SECONDS)
+    async def delete_user(self, user_id: int):
+        """Удалить пользователя из базы (его тема считается закрытой)"""
+        topic = await self.get_user_topic(user_id)
+        if topic is not None:
+            info = await self.get_topic(topic)
+        self._user_topics.pop(user_id, None)
+        if topic is not None:
+            if self._topic_users.get(topic) == user_id:
+                del self._topic_users[topic]
+            self._topics.pop(topic, None)
+            self._dirty.set_topic(topic, None)
+            # Тема, закрытая по неактивности, уже учтена как закрытая
+            if not (info and info.closed):
+                self._update_stats(topics_closed=1, **{f'open_{topic[0]}': -1})
+        self._dirty.set_mapping(user_id, None)
+        await self._changed()
+
+    # ----- сведения о темах -----
+    async def get_topic(self, topic: TopicRef) -> Optional[TopicInfo]:
+        """Сведения о теме"""
+        info = self._topics.get(topic)
+        if info is None and not self.preload and topic not in self._dirty.topics:
+            info = await self.backend.get_topic(topic)
+            if info is not None and not self.shared and topic not in self._dirty.topics:
+                self._topics[topic] = info
+        return info
+
+    def _set_topic(self, topic: TopicRef, info: TopicInfo):
+        if not self.shared:
+            self._topics[topic] = info
+        self._dirty.set_topic(topic, info)
+
+    @timed(DATABASE_SECONDS)
+    async def start_topic(self, user_id: int, topic: TopicRef):
+        """Записать сведения о новой теме пользователя"""
+        now = time.time()
+        self._set_topic(topic, TopicInfo(user_id, now, now))
+        self._update_stats(topics_created=1, **{f'open_{topic[0]}': 1})
+        await self._changed()
+
+    @timed(DATABASE_SECONDS)
+    async def record_messages(self, topic: TopicRef, from_admin: bool, count: int = 1):
+        """Учесть сообщения в теме: от пользователя или ответ админа"""
+        now = time.time()
+        info = await self.get_topic(topic)
+        if info is None:
+            user_id = await self.get_user_by_topic(*topic)
+            if user_id is None:
+                return
+            info = TopicInfo(user_id, now, now)
+
+        if from_admin:
+            first_response = info.first_response
+            if first_response is None:
+                first_response = now - info.created_at
+                self._update_stats(from_admins=count, responded=1,
+                                   first_response_total=first_response)
+            else:
+                self._update_stats(from_admins=count)
+            info = info._replace(last_activity=now, from_admins=info.from_admins + count,
+                                 first_response=first_response)
+        else:
+            info = info._replace(last_activity=now, from_user=info.from_user + count)
+            self._update_stats(from_user=count)
+        self._set_topic(topic, info)
+        await self._changed()
+
+    @timed(DATABASE_SECONDS)
+    async def close_topic(self, topic: TopicRef) -> bool:
+        """Отметить тему закрытой, сохранив связь с пользователем; False - уже закрыта"""
+        info = await self.get_topic(topic)
+        if info is None or info.closed:
+            return False
+        self._set_topic(topic, info._replace(closed=True))
+        self._update_stats(topics_closed=1, **{f'open_{topic[0]}': -1})
+        await self._changed()
+        return True
+
+    @timed(DATABASE_SECONDS)
+    async def reopen_topic(self, topic: TopicRef):
+        """Снова открыть закрытую тему вернувшегося пользователя"""
+        info = await self.get_topic(topic)
+        if info is None or not info.closed:
+            return
+        self._set_topic(topic, info._replace(closed=False, last_activity=time.time()))
+        self._update_stats(topics_reopened=1, **{f'open_{topic[0]}': 1})
+        await self._changed()
+
+    async def iter_users(self, after: int = 0, batch: int = 1000) -> AsyncIterator[int]:
+        """
+        ID пользователей с темами по возрастанию, начиная после after.
+        Читаются пачками по batch, поэтому весь список не загружается разом.
+        В режиме preload список сортируется один раз: пользователи, появившиеся
+        после начала обхода, в него не попадут.
+        """
+        if self.preload:
+            snapshot = sorted(self._user_topics)
+            for index in range(bisect.bisect_right(snapshot, after), len(snapshot)):
+                yield snapshot[index]
+            return
+        while True:
+            await self.flush()
+            user_ids = await self.backend.user_ids(after, batch)
+            if not user_ids:
+                return
+            for user_id in user_ids:
+                yield user_id
+            after = user_ids[-1]
+
+    async def idle_topics(self, before: float) -> List[TopicRef]:
+        """Открытые темы без сообщений с момента before (unix)"""
+        if self.preload:
+            return [topic for topic, info in self._topics.items()
+                    if info.last_activity < before and not info.closed]
+        await self.flush()
+        return await self.backend.idle_topics(before)
+
+    async def topic_activity(self) -> Dict[TopicRef, float]:
+        """Время последней активности всех открытых тем (для планировщика закрытия)"""
+        topics = self._topics if self.preload else await self.backend.load_topics()
+        return {topic: info.last_activity for topic, info in topics.items() if not info.closed}
+
+    # ----- статистика -----
+    def _update_stats(self, **increments: float):
+        """Прибавить к счетчикам статистики (запишется вместе с остальными изменениями)"""
+        key = self.own_key('stats')
+        stats = dict(self._values.get(key, {}))
+        for name, value in increments.items():
+            stats[name] = stats.get(name, 0) + value
+        self._values[key] = stats
+        self._dirty.set_value(key, stats)
+
+    def get_stats(self) -> Dict[str, float]:
+        """Общая статистика всех процессов"""
+        total: Dict[str, float] = {}
+        for key, stats in self._values.items():
+            if key == 'stats' or key.startswith('stats_'):
+                for name, value in stats.items():
+                    total[name] = total.get(name, 0) + value
+        return total
+
+    @property
+    def open_topics(self) -> int:
+        """Сколько сейчас открытых обращений"""
+        stats = self.get_stats()
+        return int(stats.get('topics_created', 0) - stats.get('topics_closed', 0)
+                   + stats.get('topics_reopened', 0))
+
+    def group_loads(self) -> Dict[int, int]:
+        """Сколько открытых тем в каждой админской группе"""
+        stats = self.get_stats()
+        return {group_id: int(stats.get(f'open_{group_id}', 0)) for group_id in self.get_groups()}
+
+    # ----- админские группы -----
+    @staticmethod
+    def _groups(values: Dict[str, Any]) -> List[int]:
+        groups = values.get('admin_groups')
+        if groups is None:
+            # База старого формата: одна группа
+            group_id = values.get('admin_group_id')
+            groups = [group_id] if group_id is not None else []
+        return list(groups)
+
+    @classmethod
+    def _with_group(cls, group_id: int, values: Dict[str, Any]) -> Dict[str, Any]:
+        groups = cls._groups(values)
+        if group_id in groups:
+            return {}
+        changes = {'admin_groups': groups + [group_id]}
+        # Первая группа остается основной (в ней темы из базы старого формата)
+        if values.get('admin_group_id') is None:
+            changes['admin_group_id'] = group_id
+        return changes
+
+    @classmethod
+    def _without_group(cls, group_id: int, values: Dict[str, Any]) -> Dict[str, Any]:
+        groups = cls._groups(values)
+        if group_id not in groups:
+            return {}
+        groups.remove(group_id)
+        return {'admin_groups': groups}
+
+    async def _update_groups(self, update: Callable[[Dict[str, Any]], Dict[str, Any]]) -> bool:
+        """
+        Изменить список групп. В общем хранилище изменение идет одной
+        транзакцией по свежим значениям, чтобы процессы вебхука не затирали
+        группы, добавленные другими.
+        """
+        if self.shared:
+            changes = await self.backend.update_values(('admin_groups', 'admin_group_id'), update)
+        else:
+            changes = update(self._values)
+            for key, value in changes.items():
+                self._dirty.set_value(key, value)
+        if not changes:
+            return False
+        self._values.update(changes)
+        if not self.shared:
+            await self._changed()
+        return True
+
+    @timed(DATABASE_SECONDS)
+    async def add_group(self, group_id: int) -> bool:
+        """Добавить админскую группу; False - группа уже добавлена"""
+        return await self._update_groups(functools.partial(self._with_group, group_id))
+
+    @timed(DATABASE_SECONDS)
+    async def remove_group(self, group_id: int) -> bool:
+        """Убрать группу из списка для новых тем; False - группы нет в списке"""
+        return await self._update_groups(functools.partial(self._without_group, group_id))
+
+    def get_groups(self) -> List[int]:
+        """ID всех админских групп"""
+        return self._groups(self._values)
+
+    # ----- настройки -----
+
+    def own_key(self, name: str) -> str:
+        """Ключ, который пишет только этот процесс"""
+        key = name if self.worker == 0 else f'{name}_{self.worker}'
+        self._own_keys.add(key)
+        return key
+
+    def get_value(self, key: str, default: Any = None) -> Any:
+        """Прочитать произвольный ключ настроек"""
+        return self._values.get(key, default)
+
+    @timed(DATABASE_SECONDS)
+    async def set_value(self, key: str, value: Any):
+        """Сохранить произвольный ключ настроек"""
+        self._values[key] = value
+        self._dirty.set_value(key, value)
+        await self._changed()
+
+    @timed(DATABASE_SECONDS)
+    async def delete_value(self, key: str):
+        """Удалить ключ настроек"""
+        self._values.pop(key, None)
+        self._dirty.delete_value(key)
+        await self._changed()
+
+
+_database: Optional[Database] = None
+
+
+def get_database() -> Database:
+    """Общий экземпляр базы данных (открывается в post_init)"""
+    return _database
+
+
+async def open_database(shared: bool = False, worker: int = 0,
+                        snapshot: Optional[Dict[str, Any]] = None) -> Database:
+    """
+    Создать хранилище из настроек и открыть базу данных.
+    Для нескольких процессов (shared) всегда используется SQLite: shelve не
+    переносит одновременную запись. worker - номер процесса вебхука,
+    snapshot - связи из снимка прошлой остановки.
+    """
+    global _database
+    kind = 'sqlite' if shared else STORAGE_BACKEND
+    backend = create_backend(kind, DATABASE_FILE, SQLITE_DATABASE_FILE, SQLITE_POOL_SIZE)
+    if isinstance(backend, SQLiteBackend):
+        await backend.open()
+        try:
+            await backend.migrate_from_shelve(DATABASE_FILE)
+        finally:
+            await backend.close()
+    _database = Database(backend, preload=DATABASE_PRELOAD, shared=shared, worker=worker)
+    await _database.open(snapshot)
+    return _database
 
 
 # ========== КОМАНДЫ ДЛЯ АДМИНОВ ==========
-async def admin_set_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда для установки админской группы"""
-    user_id = update.effective_user.id
+_admin_cache: Optional[AdminCache] = None
 
-    # Проверяем, что команда вызвана в группе
-    if update.effective_chat.type not in ['group', 'supergroup']:
-        await update.message.reply_text("❌ Эту команду нужно использовать в группе!")
-        return
 
-    # Проверяем, что пользователь - администратор
-    try:
-        admins = await update.effective_chat.get_administrators()
-        is_admin = any(admin.user.id == user_id for admin in admins)
+def get_admin_cache() -> AdminCache:
+    """Общий кэш администраторов групп (создается в post_init)"""
+    return _admin_cache
+
+
+async def is_group_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Отправитель сообщения - администратор группы (без запросов к API, если список в кэше)"""
+    if is_anonymous_admin(update.effective_message):
+        return True
+    return await get_admin_cache().is_admin(context.bot, update.effective_chat.id,
+                                            update.effective_user.id)
+
 
-        if not is_admin:
-            await update.message.reply_text("❌ Только администраторы могут использовать эту команду!")
+def admin_only(handler):
+    """Декоратор для команд, доступных только администраторам группы"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Проверяем, что команда вызвана в группе
+        if update.effective_chat.type not in ['group', 'supergroup']:
+            await update.message.reply_text("❌ Эту команду нужно использовать в группе!")
             return
-    except Exception as e:
-        logger.error(f"Error checking admin status: {e}")
-        await update.message.reply_text("❌ Ошибка при проверке прав администратора")
+
+        # Проверяем, что пользователь - администратор
+        try:
+            if not await is_group_admin(update, context):
+                await update.message.reply_text("❌ Только администраторы могут использовать эту команду!")
+                return
+        except Exception as e:
+            logger.error(f"Error checking admin status: {e}")
+            await update.message.reply_text("❌ Ошибка при проверке прав администратора")
+            return
+
+        return await handler(update, context)
+    return wrapper
+
+
+async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обновление кэша админов при смене статуса участника группы"""
+    get_admin_cache().update_member(update.chat_member or update.my_chat_member,
+                                    bot_id=context.bot.id)
+
+
+_chat_registry: Optional[ChatRegistry] = None
+
+
+async def record_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Записать группу, из которой пришло обновление, в реестр чатов"""
+    chat = update.effective_chat
+    if chat is None:
         return
+    member = None
+    if update.my_chat_member:
+        member = update.my_chat_member.new_chat_member.status not in GONE_STATUSES
+    _chat_registry.record(chat, member)
+
 
+@admin_only
+async def admin_set_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда для добавления админской группы (их может быть несколько)"""
     # Сохраняем ID группы
     chat_id = update.effective_chat.id
-    db = Database()
-    db.save_group_id(chat_id)
+    db = get_database()
+    if not await db.add_group(chat_id):
+        await update.message.reply_text("ℹ️ Эта группа уже добавлена как админская.")
+        return
 
-    # Обновляем глобальную переменную
-    global ADMIN_GROUP_ID
-    ADMIN_GROUP_ID = chat_id
+    if _topic_pool is not None:
+        _topic_pool.refill()
 
+    groups = db.get_groups()
     await update.message.reply_text(
         f"✅ Группа установлена как админская!\n"
         f"ID: {chat_id}\n"
-        f"Название: {update.effective_chat.title}\n\n"
-        f"Теперь бот будет создавать темы в этой группе для каждого нового пользователя."
+        f"Название: {update.effective_chat.title}\n"
+        f"Всего админских групп: {len(groups)}\n\n"
+        f"Теперь бот будет создавать темы в этой группе для новых пользователей."
+    )
+
+
+@admin_only
+async def admin_remove_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перестать создавать темы в группе (ответы в уже созданных темах работают)"""
+    db = get_database()
+    if not await db.remove_group(update.effective_chat.id):
+        await update.message.reply_text("❌ Эта группа не добавлена как админская.")
+        return
+    await update.message.reply_text(
+        "✅ Новые темы в этой группе больше не создаются.\n"
+        "Ответы в уже открытых темах по-прежнему доходят до пользователей."
+    )
+
+
+def format_duration(seconds: float) -> str:
+    """Длительность в виде '1 ч 5 мин' / '3 мин 20 с'"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds} с"
+
+
+@admin_only
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Статистика по обращениям (из накопленных счетчиков, без обхода базы)"""
+    db = get_database()
+    stats = db.get_stats()
+    created = int(stats.get('topics_created', 0))
+    responded = int(stats.get('responded', 0))
+
+    stats_text = f"""
+📊 Статистика обращений:
+
+Открытых обращений: {db.open_topics}
+Всего обращений: {created}
+Закрыто: {int(stats.get('topics_closed', 0))}
+Открыто снова: {int(stats.get('topics_reopened', 0))}
+
+Сообщений от пользователей: {int(stats.get('from_user', 0))}
+Ответов админов: {int(stats.get('from_admins', 0))}
+Обращений с ответом: {responded} из {created}
+    """
+    if responded:
+        average = stats.get('first_response_total', 0) / responded
+        stats_text += f"\nСреднее время первого ответа: {format_duration(average)}"
+
+    if _topic_pool is not None:
+        stats_text += f"\nТем в запасе: {_topic_pool.available()}"
+
+    loads = db.group_loads()
+    if len(loads) > 1:
+        stats_text += "\n\nОткрытых тем по группам:"
+        for group_id, load in loads.items():
+            stats_text += f"\n{group_id}: {load}"
+
+    await update.message.reply_text(stats_text)
+
+
+_closeall_task: Optional[asyncio.Task] = None
+
+
+@admin_only
+async def admin_close_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Закрыть все темы без активности (по умолчанию - дольше CLOSEALL_IDLE_DAYS дней)"""
+    global _closeall_task
+    if _closeall_task and not _closeall_task.done():
+        await update.message.reply_text("⏳ Темы уже закрываются, дождитесь окончания.")
+        return
+
+    db = get_database()
+    job = db.get_value(db.own_key('closeall_job'))
+    if job:
+        await update.message.reply_text(
+            f"▶️ Продолжаю прерванное закрытие: осталось {len(job['topics'])} из {job['total']} тем."
+        )
+    else:
+        try:
+            days = float(context.args[0]) if context.args else CLOSEALL_IDLE_DAYS
+        except ValueError:
+            await update.message.reply_text("❌ Использование: /closeall [дней без активности]")
+            return
+
+        topics = await db.idle_topics(time.time() - days * 86400)
+        if not topics:
+            await update.message.reply_text(f"✅ Нет тем без активности дольше {days:g} дн.")
+            return
+
+        progress = await update.message.reply_text(f"🔒 Закрываю {len(topics)} тем...")
+        job = {'chat_id': progress.chat_id, 'message_id': progress.message_id,
+               'topics': [list(topic) for topic in topics],
+               'total': len(topics), 'closed': 0, 'failed': 0}
+        await db.set_value(db.own_key('closeall_job'), job)
+
+    _closeall_task = asyncio.create_task(close_topics(context.bot, job))
+
+
+async def close_topics(bot, job: Dict[str, Any]):
+    """
+    Закрыть темы из задания /closeall по несколько одновременно.
+    Оставшиеся темы периодически сохраняются в базу, поэтому после
+    перезапуска бота закрытие продолжается с того же места.
+    """
+    db = get_database()
+    key = db.own_key('closeall_job')
+    # В JSON пары (chat_id, topic_id) хранятся списками
+    topics = iter([tuple(topic) for topic in job['topics']])
+    done = set()
+
+    def checkpoint():
+        job['topics'] = [topic for topic in job['topics'] if tuple(topic) not in done]
+        done.clear()
+        return db.set_value(key, job)
+
+    async def report(text: str):
+        try:
+            await bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'],
+                                        rate_limit_args={'priority': PRIORITY_LOW})
+        except Exception as e:
+            logger.error(f"Error updating /closeall progress: {e}")
+
+    async def worker():
+        for chat_id, topic_id in topics:
+            try:
+                await bot.close_forum_topic(chat_id=chat_id, message_thread_id=topic_id,
+                                            rate_limit_args={'priority': PRIORITY_LOW})
+            except BadRequest as e:
+                # Тема уже закрыта или удалена вручную - все равно отмечаем закрытой
+                logger.info(f"Topic {topic_id} in {chat_id} not closed: {e}")
+            except Exception as e:
+                logger.error(f"Error closing topic {topic_id} in {chat_id}: {e}")
+                job['failed'] += 1
+                done.add((chat_id, topic_id))
+                continue
+
+            # Связь с пользователем остается: если он напишет снова, тема откроется
+            await db.close_topic((chat_id, topic_id))
+            job['closed'] += 1
+            done.add((chat_id, topic_id))
+
+    async def progress():
+        while True:
+            await asyncio.sleep(CLOSEALL_PROGRESS_INTERVAL)
+            await checkpoint()
+            await report(f"🔒 Закрыто {job['closed']} из {job['total']} тем...")
+
+    progress_task = asyncio.create_task(progress())
+    try:
+        await asyncio.gather(*[worker() for _ in range(CLOSEALL_CONCURRENCY)])
+    finally:
+        progress_task.cancel()
+        # При остановке бота сохраняем, что осталось закрыть
+        await checkpoint()
+
+    await db.delete_value(key)
+    text = f"✅ Закрыто {job['closed']} из {job['total']} тем."
+    if job['failed']:
+        text += f"\n❌ Не удалось закрыть: {job['failed']}"
+    await report(text)
+
+
+_broadcast_task: Optional[asyncio.Task] = None
+
+
+@admin_only
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Разослать сообщение всем пользователям: ответом на сообщение или текстом после команды"""
+    global _broadcast_task
+    db = get_database()
+    key = db.own_key('broadcast_job')
+    running = _broadcast_task and not _broadcast_task.done()
+
+    if context.args == ['cancel']:
+        job = db.get_value(key)
+        if running:
+            _broadcast_task.cancel()
+            await asyncio.gather(_broadcast_task, return_exceptions=True)
+        if not job:
+            await update.message.reply_text("ℹ️ Рассылка не идет.")
+            return
+        await db.delete_value(key)
+        await update.message.reply_text(f"⏹ Рассылка остановлена. {broadcast_progress(job)}")
+        return
+
+    if running:
+        await update.message.reply_text("⏳ Рассылка уже идет. Остановить: /broadcast cancel")
+        return
+
+    job = db.get_value(key)
+    if job:
+        await update.message.reply_text(f"▶️ Продолжаю прерванную рассылку. {broadcast_progress(job)}")
+    else:
+        # В темах форума каждое сообщение - ответ на служебное сообщение о создании темы
+        source = update.message.reply_to_message
+        if source and source.forum_topic_created:
+            source = None
+        parts = update.message.text.split(maxsplit=1)
+        text = parts[1] if len(parts) > 1 else None
+        if not source and not text:
+            await update.message.reply_text(
+                "❌ Использование: ответьте командой /broadcast на сообщение для рассылки "
+                "или напишите /broadcast <текст>"
+            )
+            return
+
+        progress = await update.message.reply_text("📣 Начинаю рассылку...")
+        job = {'chat_id': progress.chat_id, 'message_id': progress.message_id,
+               'source': [source.chat_id, source.message_id] if source else None,
+               'text': None if source else text,
+               'cursor': 0, 'done': [], 'sent': 0, 'failed': 0, 'blocked': 0, 'closed': 0}
+        await db.set_value(key, job)
+
+    _broadcast_task = asyncio.create_task(broadcast(context.bot, job))
+
+
+def broadcast_progress(job: Dict[str, Any]) -> str:
+    text = f"Отправлено: {job['sent']}"
+    if job['failed']:
+        text += f", не доставлено: {job['failed']}"
+    if job['blocked']:
+        text += f", заблокировали бота: {job['blocked']}"
+    if job.get('closed'):
+        text += f" (закрыто их тем: {job['closed']})"
+    return text
+
+
+async def broadcast(bot, job: Dict[str, Any]):
+    """
+    Разослать сообщение из задания /broadcast всем пользователям.
+    Пользователи читаются из базы по возрастанию ID, поэтому в базу
+    периодически сохраняется курсор (все до него уже получили сообщение)
+    и отправленные после него - после перезапуска рассылка продолжается
+    с того же места. Отправка идет не быстрее BROADCAST_RATE сообщений
+    в секунду и с низким приоритетом, чтобы не мешать переписке.
+    Открытые темы пользователей, заблокировавших бота, закрываются.
+    """
+    db = get_database()
+    job.setdefault('closed', 0)  # Задания, начатые до появления счетчика
+    key = db.own_key('broadcast_job')
+    rate = TokenBucket(BROADCAST_RATE, 1)
+    limit = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    in_flight = set()
+    done = set(job['done'])
+    last_taken = job['cursor']
+    tasks = set()
+
+    def checkpoint():
+        # Все пользователи до самого раннего неотправленного уже получили сообщение
+        job['cursor'] = min(in_flight) - 1 if in_flight else last_taken
+        done.difference_update([user_id for user_id in done if user_id <= job['cursor']])
+        job['done'] = sorted(done)
+        return db.set_value(key, job)
+
+    async def report(text: str):
+        try:
+            await bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'],
+                                        rate_limit_args={'priority': PRIORITY_LOW})
+        except Exception as e:
+            logger.error(f"Error updating /broadcast progress: {e}")
+
+    async def send(user_id: int):
+        try:
+            if job['source']:
+                from_chat_id, message_id = job['source']
+                await bot.copy_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id,
+                                       rate_limit_args={'priority': PRIORITY_LOW})
+            else:
+                await bot.send_message(chat_id=user_id, text=job['text'],
+                                       rate_limit_args={'priority': PRIORITY_LOW})
+            job['sent'] += 1
+        except Forbidden:
+            # Пользователь заблокировал бота - ответы админов ему не дойдут
+            job['blocked'] += 1
+            if await close_blocked_topic(bot, user_id):
+                job['closed'] += 1
+        except Exception as e:
+            logger.error(f"Error broadcasting to {user_id}: {e}")
+            job['failed'] += 1
+        finally:
+            limit.release()
+        in_flight.discard(user_id)
+        done.add(user_id)
+
+    async def progress():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await checkpoint()
+            await report(f"📣 Рассылка идет. {broadcast_progress(job)}")
+
+    progress_task = asyncio.create_task(progress())
+    try:
+        async for user_id in db.iter_users(after=job['cursor']):
+            if user_id in done:
+                continue
+            await limit.acquire()
+            await rate.acquire()
+            in_flight.add(user_id)
+            last_taken = user_id
+            task = asyncio.create_task(send(user_id))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        progress_task.cancel()
+        # При остановке бота неотправленное останется в задании
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await checkpoint()
+
+    await db.delete_value(key)
+    await report(f"✅ Рассылка завершена. {broadcast_progress(job)}")
+
+
+async def close_blocked_topic(bot, user_id: int) -> bool:
+    """
+    Закрыть тему пользователя, заблокировавшего бота, с пометкой для админов.
+    Связь с темой остается: если пользователь снова напишет, тема откроется.
+    False - открытой темы у пользователя нет (или закрыть не удалось).
+    """
+    db = get_database()
+    topic = await db.get_user_topic(user_id)
+    info = await db.get_topic(topic) if topic else None
+    if info is None or info.closed:
+        return False
+
+    chat_id, topic_id = topic
+    try:
+        await bot.send_message(chat_id, "🚫 Пользователь заблокировал бота: ответы ему не дойдут. Тема закрыта.",
+                               message_thread_id=topic_id, rate_limit_args={'priority': PRIORITY_LOW})
+        await bot.close_forum_topic(chat_id=chat_id, message_thread_id=topic_id,
+                                    rate_limit_args={'priority': PRIORITY_LOW})
+    except BadRequest as e:
+        # Тема уже закрыта или удалена вручную - все равно отмечаем закрытой
+        logger.info(f"Topic {topic_id} in {chat_id} not closed: {e}")
+    except Exception as e:
+        logger.error(f"Error closing topic {topic_id} in {chat_id} of blocked user {user_id}: {e}")
+        return False
+
+    await db.close_topic(topic)
+    _ack_status.pop(topic, None)
+    return True
+
+
+@admin_only
+async def admin_outbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Состояние журнала отправки и недоставленные сообщения"""
+    outbox = get_outbox()
+    counts = await outbox.counts()
+    text = (
+        f"📮 Очередь отправки:\n\n"
+        f"В ожидании: {counts.get(PENDING, 0)}\n"
+        f"Не доставлено: {counts.get(DEAD, 0)}\n"
+        f"Доставлено за {OUTBOX_RETENTION_HOURS} ч: {counts.get(DONE, 0)}"
     )
 
+    dead = await outbox.dead()
+    if dead:
+        text += "\n\nНедоставленные (последние 10):"
+        for entry in dead[-10:]:
+            created = datetime.fromtimestamp(entry.created_at).strftime('%Y-%m-%d %H:%M')
+            text += f"\n#{entry.id} {entry.key} ({created}, попыток: {entry.attempts})\n{entry.error}"
+        text += "\n\nОтправить снова: /redeliver <номер> или /redeliver all"
+
+    await update.message.reply_text(text[:MESSAGE_MAX_LENGTH])
+
+
+@admin_only
+async def admin_redeliver(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Повторить доставку недоставленных сообщений (одного или всех)"""
+    arg = context.args[0].lstrip('#') if context.args else ''
+    if arg != 'all' and not arg.isdigit():
+        await update.message.reply_text("❌ Использование: /redeliver <номер> или /redeliver all")
+        return
+
+    entries = await get_outbox().revive(None if arg == 'all' else int(arg))
+    if not entries:
+        await update.message.reply_text("ℹ️ Нет таких недоставленных сообщений.")
+        return
+
+    for entry in entries:
+        requeue(context.bot, entry)
+    await update.message.reply_text(f"🔁 Отправляю снова: {len(entries)}")
+
+
+@admin_only
+async def admin_throttled(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пользователи, которых глушило ограничение частоты сообщений"""
+    flood = get_flood_control()
+    users = flood.throttled() if flood is not None else []
+    if not users:
+        await update.message.reply_text("✅ Никто не флудит.")
+        return
+
+    text = "🚦 Ограниченные пользователи:\n"
+    for user in users[:30]:
+        state = f"заглушен еще {format_duration(user.muted_for)}" if user.muted_for else "не заглушен"
+        text += f"\n{user.user_id}: {state}, раз: {user.strikes}, отброшено: {user.dropped}"
+    if len(users) > 30:
+        text += f"\n... и еще {len(users) - 30}"
+    text += "\n\nСнять ограничения: /unthrottle <ID> или /unthrottle all"
+    await update.message.reply_text(text[:MESSAGE_MAX_LENGTH])
+
+
+@admin_only
+async def admin_unthrottle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Снять ограничение частоты с пользователя или со всех"""
+    arg = context.args[0] if context.args else ''
+    if arg != 'all' and not arg.isdigit():
+        await update.message.reply_text("❌ Использование: /unthrottle <ID пользователя> или /unthrottle all")
+        return
+    flood = get_flood_control()
+    released = flood.release(None if arg == 'all' else int(arg)) if flood is not None else 0
+    await update.message.reply_text(f"✅ Ограничения сняты: {released}")
+
+
+def topic_link(chat_id: int, topic_id: int) -> str:
+    """Ссылка на тему в супергруппе (ID группы без префикса -100)"""
+    return f"https://t.me/c/{str(chat_id).removeprefix('-100')}/{topic_id}"
+
+
+@admin_only
+async def admin_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Поиск по текстам переписки: темы с самыми свежими совпадениями"""
+    if update.effective_chat.id not in get_database().get_groups():
+        await update.message.reply_text("❌ Искать по переписке можно только в админской группе.")
+        return
+    query = ' '.join(context.args)
+    if not query:
+        await update.message.reply_text("❌ Использование: /search <слова> (оплат* - слова с этим началом)")
+        return
+
+    # Одна строка на тему - с самым свежим совпадением
+    topics = {}
+    for hit in await get_transcripts().search(query, limit=SEARCH_RESULTS * 5):
+        topics.setdefault((hit.chat_id, hit.topic_id), hit)
+        if len(topics) == SEARCH_RESULTS:
+            break
+    if not topics:
+        await update.message.reply_text("🔍 Ничего не найдено.")
+        return
+
+    text = f"🔍 Последние темы с совпадениями: {len(topics)}"
+    for (chat_id, topic_id), hit in topics.items():
+        when = datetime.fromtimestamp(hit.created_at).strftime('%Y-%m-%d %H:%M')
+        author = "🛠 админ" if hit.from_admin else "👤 пользователь"
+        text += f"\n\n{topic_link(chat_id, topic_id)}\nПользователь {hit.user_id}, {when}, {author}:\n{hit.snippet}"
+    await update.message.reply_text(text[:MESSAGE_MAX_LENGTH])
+
+
+def format_archive_record(record: Dict[str, Any]) -> str:
+    """Строка выгрузки /export"""
+    when = datetime.fromtimestamp(record['time']).strftime('%Y-%m-%d %H:%M:%S')
+    author = f"🛠 {record['author'] or 'Админ'}" if record['from_admin'] else "👤 Пользователь"
+    text = record['text'] or ''
+    if record['media']:
+        text = f"[{record['media']}] {text}".rstrip()
+    return f"[{when}] {author}: {text}"
+
+
+@admin_only
+async def admin_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выгрузить переписку файлом: в теме - эту тему, с ID - все темы пользователя"""
+    chat_id = update.effective_chat.id
+    if chat_id not in get_database().get_groups():
+        await update.message.reply_text("❌ Выгружать переписку можно только в админской группе.")
+        return
+    if context.args and context.args[0].isdigit():
+        user_id = int(context.args[0])
+        topic = None
+        filename = f"transcript_{user_id}.txt"
+    elif update.message.is_topic_message:
+        user_id = None
+        topic = (chat_id, update.message.message_thread_id)
+        filename = f"transcript_{topic[1]}.txt"
+    else:
+        await update.message.reply_text("❌ Использование: /export в теме или /export <ID пользователя>")
+        return
+
+    fd, path = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    try:
+        count = await get_archive().export(path, format_archive_record, topic=topic, user_id=user_id)
+        if not count:
+            await update.message.reply_text("ℹ️ В архиве нет переписки.")
+            return
+        if os.path.getsize(path) > EXPORT_MAX_MB * 2**20:
+            await update.message.reply_text(f"❌ Выгрузка больше {EXPORT_MAX_MB} МБ - Telegram ее не примет.")
+            return
+        with open(path, 'rb') as f:
+            # Файл читается при отправке по частям, а не целиком в память
+            document = InputFile(f, filename=filename, read_file_handle=False)
+            await update.message.reply_document(document, caption=f"🗂 Сообщений: {count}")
+    finally:
+        os.remove(path)
+
 
 async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Помощь для админов"""
     help_text = """
 🛠 Команды для администраторов:
 
-/setgroup - Установить текущую группу как админскую (выполнить в группе)
+/setgroup - Добавить текущую группу как админскую (выполнить в каждой группе)
+/removegroup - Не создавать новые темы в текущей группе
 /stats - Статистика по обращениям
-/closeall - Закрыть все старые темы
+/closeall [дней] - Закрыть темы без сообщений дольше N дней (по умолчанию 7)
+/outbox - Очередь отправки и недоставленные сообщения
+/redeliver <номер|all> - Отправить недоставленное снова
+/broadcast <текст> - Разослать сообщение всем пользователям (или ответом на сообщение)
+/broadcast cancel - Остановить рассылку
+/throttled - Пользователи, которых ограничило за флуд
+/unthrottle <ID|all> - Снять ограничение за флуд
+/search <слова> - Найти темы по тексту переписки
+/export [ID пользователя] - Выгрузить переписку темы (или всех тем пользователя) файлом
 /adminhelp - Эта справка
 
 📌 Как работает бот:
@@ -173,10 +1236,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать статус обращения пользователя"""
     user_id = update.effective_user.id
-    db = Database()
-    topic_id = db.get_user_topic(user_id)
+    db = get_database()
+    topic = await db.get_user_topic(user_id)
 
-    if topic_id:
+    if topic:
         status_text = "✅ У вас есть активное обращение. Команда поддержки уже видит ваши сообщения."
     else:
         status_text = "❌ У вас нет активных обращений. Напишите любое сообщение, чтобы создать обращение."
@@ -187,14 +1250,15 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отмена обращения пользователя"""
     user_id = update.effective_user.id
-    db = Database()
-    topic_id = db.get_user_topic(user_id)
+    db = get_database()
+    topic = await db.get_user_topic(user_id)
 
-    if topic_id and ADMIN_GROUP_ID:
+    if topic:
         # Закрываем тему в группе
+        chat_id, topic_id = topic
         try:
             await context.bot.close_forum_topic(
-                chat_id=ADMIN_GROUP_ID,
+                chat_id=chat_id,
                 message_thread_id=topic_id
             )
             await update.message.reply_text("✅ Ваше обращение закрыто. Если будут вопросы - пишите снова!")
@@ -203,231 +1267,1153 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("✅ Обращение отменено (тема в группе останется открытой).")
 
         # Удаляем из базы
-        db.delete_user(user_id)
+        await db.delete_user(user_id)
+        _ack_status.pop(topic, None)
     else:
         await update.message.reply_text("❌ У вас нет активных обращений.")
 
 
 # ========== ОСНОВНАЯ ЛОГИКА ==========
-async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка сообщений от пользователей в личке"""
-    global ADMIN_GROUP_ID
+# Приветствия в новых темах, которые еще отправляются (их ждет первая пересылка в тему)
+_topic_setups: Dict[TopicRef, asyncio.Task] = {}
+_background_tasks = set()  # Фоновые запросы по новым темам (см. run_in_background)
 
-    # Загружаем ID группы из базы, если еще не загружено
-    if ADMIN_GROUP_ID is None:
-        db = Database()
-        ADMIN_GROUP_ID = db.get_group_id()
 
-    user = update.effective_user
+async def create_user_topic(context: ContextTypes.DEFAULT_TYPE, user, message_text: str) -> TopicRef:
+    """
+    Создать тему для пользователя в выбранной политикой группе (или взять готовую
+    из запаса); приветствие в нее уходит в фоне.
+    Вызывается только из обработчика личных сообщений, а обновления одного
+    пользователя ConversationUpdateProcessor обрабатывает по очереди, поэтому
+    второе сообщение, пришедшее одновременно с первым, уже найдет тему в базе.
+    """
     user_id = user.id
-    message_text = update.message.text or update.message.caption or "[Медиа-файл]"
-
-    db = Database()
-
-    # Проверяем, есть ли уже тема для этого пользователя
-    topic_id = db.get_user_topic(user_id)
-
-    if not topic_id:
-        # Создаем новую тему в группе
-        if not ADMIN_GROUP_ID:
-            await update.message.reply_text(
-                "⏳ Админская группа еще не настроена. "
-                "Администраторы должны добавить бота в группу и выполнить команду /setgroup"
-            )
-            return
-
-        # Создаем тему с информацией о пользователе
-        user_info = f"👤 Аноним (ID: {user_id})"
-        if user.username:
-            user_info = f"👤 @{user.username}"
+    db = get_database()
+    loads = db.group_loads()
+    for group_id, count in _placing.items():
+        loads[group_id] = loads.get(group_id, 0) + count
+    chat_id = get_placement().choose(user, db.get_groups(), loads)
 
-        try:
+    _placing[chat_id] = _placing.get(chat_id, 0) + 1
+    try:
+        # Берем готовую тему из запаса; если он пуст - создаем
+        topic_id = await _topic_pool.take(chat_id) if _topic_pool is not None else None
+        pooled = topic_id is not None
+        if not pooled:
             topic = await context.bot.create_forum_topic(
-                chat_id=ADMIN_GROUP_ID,
-                name=user_info[:128]  # Ограничение Telegram на длину названия темы
+                chat_id=chat_id,
+                name=topic_name(user)
             )
             topic_id = topic.message_thread_id
+        TOPICS_CREATED.inc()
+
+        # Сохраняем связь в базе
+        await db.set_user_topic(user_id, (chat_id, topic_id))
+        await db.start_topic(user_id, (chat_id, topic_id))
+    finally:
+        _placing[chat_id] -= 1
+        if not _placing[chat_id]:
+            del _placing[chat_id]
+
+    # Приветствие и название темы - в фоне; пересылка первого сообщения ждет
+    # только приветствие (оно отправляется с тем же приоритетом, что и пересылка)
+    topic = (chat_id, topic_id)
+    _topic_setups[topic] = run_in_background(setup_user_topic(context.bot, user, topic, message_text, pooled))
+    return topic
+
+
+def topic_name(user) -> str:
+    """Название темы пользователя"""
+    name = f"👤 Аноним (ID: {user.id})"
+    if user.username:
+        name = f"👤 @{user.username}"
+    return name[:128]  # Ограничение Telegram на длину названия темы
+
+
+async def create_pool_topic(bot, chat_id: int) -> int:
+    """Создать тему про запас (переименуется, когда ее займет новое обращение)"""
+    topic = await bot.create_forum_topic(
+        chat_id=chat_id,
+        name=POOL_TOPIC_NAME,
+        rate_limit_args={'priority': PRIORITY_LOW}
+    )
+    return topic.message_thread_id
 
-            # Сохраняем связь в базе
-            db.set_user_topic(user_id, topic_id)
 
-            # Отправляем приветственное сообщение в тему
-            welcome_to_admins = f"""
+async def save_topic_pool(state: Dict[int, List[int]]):
+    db = get_database()
+    await db.set_value(db.own_key('spare_topics'), state)
+
+
+async def setup_user_topic(bot, user, topic: TopicRef, message_text: str, pooled: bool) -> TopicRef:
+    """
+    Отправить приветствие в тему нового обращения и переименовать тему из запаса.
+    Возвращает тему пользователя: если тему из запаса удалили вручную, создается новая.
+    """
+    user_id = user.id
+    chat_id, topic_id = topic
+    welcome_to_admins = f"""
 📨 Новое обращение!
 
 ID пользователя: {user_id}
 Имя: {user.first_name}
 Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-            """
+    """
 
-            if user.username:
-                welcome_to_admins += f"\nUsername: @{user.username}"
+    if user.username:
+        welcome_to_admins += f"\nUsername: @{user.username}"
 
-            if message_text and message_text != "[Медиа-файл]":
-                welcome_to_admins += f"\n\nПервое сообщение:\n{message_text}"
+    if message_text and message_text != "[Медиа-файл]":
+        welcome_to_admins += f"\n\nПервое сообщение:\n{message_text}"
 
-            await context.bot.send_message(
-                chat_id=ADMIN_GROUP_ID,
-                message_thread_id=topic_id,
-                text=welcome_to_admins
-            )
+    try:
+        await bot.send_message(
+            chat_id=chat_id,
+            message_thread_id=topic_id,
+            text=welcome_to_admins,
+            # Первая пересылка в тему ждет приветствие - оно идет с ее приоритетом
+            rate_limit_args={'priority': PRIORITY_NORMAL}
+        )
+    except BadRequest as e:
+        if not pooled:
+            logger.error(f"Error sending welcome to topic {topic_id} in {chat_id}: {e}")
+            return topic
+        # Тему из запаса удалили - заводим обращению новую
+        logger.warning(f"Spare topic {topic_id} in {chat_id} is gone: {e}")
+        db = get_database()
+        await db.delete_user(user_id)
+        try:
+            new_topic = await bot.create_forum_topic(chat_id=chat_id, name=topic_name(user))
+        except Exception as e:
+            logger.error(f"Error creating topic: {e}")
+            return topic
+        topic = (chat_id, new_topic.message_thread_id)
+        await db.set_user_topic(user_id, topic)
+        await db.start_topic(user_id, topic)
+        touch_topic(topic)
+        return await setup_user_topic(bot, user, topic, message_text, pooled=False)
+    except Exception as e:
+        logger.error(f"Error sending welcome to topic {topic_id} in {chat_id}: {e}")
 
-            # Если это медиа-файл, пересылаем его отдельно
-            if update.message.photo:
-                await context.bot.send_photo(
-                    chat_id=ADMIN_GROUP_ID,
-                    message_thread_id=topic_id,
-                    photo=update.message.photo[-1].file_id,
-                    caption=message_text if message_text != "[Медиа-файл]" else None
-                )
-            elif update.message.document:
-                await context.bot.send_document(
-                    chat_id=ADMIN_GROUP_ID,
-                    message_thread_id=topic_id,
-                    document=update.message.document.file_id,
-                    caption=message_text if message_text != "[Медиа-файл]" else None
-                )
-            elif message_text and message_text != "[Медиа-файл]":
-                await context.bot.send_message(
-                    chat_id=ADMIN_GROUP_ID,
-                    message_thread_id=topic_id,
-                    text=f"👤 Пользователь:\n{message_text}"
-                )
+    if pooled:
+        run_in_background(rename_topic(bot, topic, topic_name(user)))
+    return topic
+
+
+def run_in_background(coroutine) -> asyncio.Task:
+    """Запустить задачу, которую post_stop дождется перед остановкой бота"""
+    task = asyncio.create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def rename_topic(bot, topic: TopicRef, name: str):
+    chat_id, topic_id = topic
+    try:
+        await bot.edit_forum_topic(chat_id=chat_id, message_thread_id=topic_id, name=name,
+                                   rate_limit_args={'priority': PRIORITY_LOW})
+    except Exception as e:
+        logger.error(f"Error renaming topic {topic_id} in {chat_id}: {e}")
+
+
+async def reopen_user_topic(context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                           topic: TopicRef) -> Optional[TopicRef]:
+    """Открыть закрытую по неактивности тему вернувшегося пользователя; None - темы больше нет"""
+    chat_id, topic_id = topic
+    try:
+        await context.bot.reopen_forum_topic(chat_id=chat_id, message_thread_id=topic_id)
+    except BadRequest as e:
+        # TOPIC_NOT_MODIFIED - тему уже открыли вручную
+        if 'not_modified' not in str(e).lower():
+            # Тему удалили - связь больше не нужна, создадим новую
+            logger.info(f"Topic {topic_id} in {chat_id} not reopened: {e}")
+            await get_database().delete_user(user_id)
+            return None
+
+    await get_database().reopen_topic(topic)
+    TOPICS_REOPENED.inc()
+    return topic
+
+
+async def close_idle_topic(bot, topic: TopicRef):
+    """Закрыть тему без сообщений дольше TOPIC_IDLE_CLOSE_HOURS (связь с пользователем остается)"""
+    db = get_database()
+    info = await db.get_topic(topic)
+    if info is None or info.closed:
+        return
+    # Сообщения могли пройти через другой процесс вебхука - сверяемся с базой
+    if info.last_activity + _idle_scheduler.timeout > time.time():
+        _idle_scheduler.touch(topic, info.last_activity)
+        return
+
+    chat_id, topic_id = topic
+    start_trace(f'idle:{chat_id}:{topic_id}', user_id=info.user_id, group_id=chat_id, topic_id=topic_id)
+    try:
+        await bot.close_forum_topic(chat_id=chat_id, message_thread_id=topic_id,
+                                    rate_limit_args={'priority': PRIORITY_LOW})
+    except BadRequest as e:
+        # Тема уже закрыта или удалена вручную - все равно отмечаем закрытой
+        logger.info(f"Topic {topic_id} in {chat_id} not closed: {e}")
+    except Exception as e:
+        logger.error(f"Error closing idle topic {topic_id} in {chat_id}: {e}")
+        # Попробуем еще раз через 5 минут
+        _idle_scheduler.touch(topic, time.time() - _idle_scheduler.timeout + 300)
+        return
+
+    if await db.close_topic(topic):
+        TOPICS_AUTO_CLOSED.inc()
+    # После открытия статус начнется заново - внизу темы
+    _ack_status.pop(topic, None)
+
+
+def touch_topic(topic: TopicRef):
+    """Отметить активность в теме, чтобы она не закрылась по неактивности"""
+    if _idle_scheduler is not None:
+        _idle_scheduler.touch(topic)
+
+
+async def copy_to_chat(bot, from_chat_id: int, message_ids: List[int], chat_id: int,
+                       message_thread_id: Optional[int] = None, **kwargs) -> List[int]:
+    """
+    Скопировать сообщения (любого типа) в чат без указания автора.
+    Одно сообщение - copy_message, несколько - один вызов copy_messages.
+    Возвращает ID копий.
+    """
+    if len(message_ids) == 1:
+        copy = await bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=from_chat_id,
+            message_id=message_ids[0],
+            message_thread_id=message_thread_id,
+            **kwargs
+        )
+        return [copy.message_id]
+
+    copies = await bot.copy_messages(
+        chat_id=chat_id,
+        from_chat_id=from_chat_id,
+        message_ids=message_ids,
+        message_thread_id=message_thread_id,
+        **kwargs
+    )
+    return [copy.message_id for copy in copies]
+
+
+class RelayItem(NamedTuple):
+    """Сообщение пользователя, ожидающее пересылки в тему"""
+    message: Message
+    topic: TopicRef  # (ID группы, ID темы)
+    first: bool  # Первое сообщение нового обращения
+    key: str  # Ключ записи в журнале отправки
+
+
+class ReplyItem(NamedTuple):
+    """Ответ админа, ожидающий отправки пользователю"""
+    message: Message
+    user_id: int
+    topic: TopicRef
+    quoted: Optional[int]  # Какое сообщение процитировать в личке пользователя
+    key: str
+
+
+def relay_ack_text(items: List[RelayItem]) -> Optional[str]:
+    """Текст подтверждения пользователю после пересылки пачки"""
+    if any(item.first for item in items):
+        return "✅ Ваше сообщение отправлено команде поддержки. Ожидайте ответа здесь."
+    # На обычный текст не отвечаем, чтобы не засорять чат
+    if all(item.message.text for item in items):
+        return None
+    if len(items) == 1:
+        message = items[0].message
+        if message.photo:
+            return "✅ Фото отправлено команде поддержки."
+        if message.document:
+            return "✅ Файл отправлен команде поддержки."
+        return "✅ Сообщение отправлено команде поддержки."
+    # Альбом или несколько сообщений подряд - одно подтверждение на всю пачку
+    if all(item.message.photo for item in items):
+        return "✅ Фото отправлены команде поддержки."
+    if all(item.message.document for item in items):
+        return "✅ Файлы отправлены команде поддержки."
+    return "✅ Сообщения отправлены команде поддержки."
+
+
+MergedPart = Tuple[int, str, Tuple[MessageEntity, ...]]  # (ID сообщения пользователя, текст, entities)
+
+# Склеенные сообщения в темах, чтобы при правке одной из частей поправить все
+# сообщение: (группа, ID сообщения) -> (пользователь, части)
+_merged_texts: 'OrderedDict[Tuple[int, int], Tuple[int, List[MergedPart]]]' = OrderedDict()
+_merged_parts: Dict[Tuple[int, int], Tuple[int, int]] = {}  # (пользователь, ID сообщения) -> склеенное сообщение
+
+
+def remember_merged(user_id: int, copy: Tuple[int, int], parts: List[MergedPart]):
+    """Запомнить, из каких сообщений пользователя склеено сообщение в теме"""
+    _merged_texts[copy] = (user_id, parts)
+    for message_id, _, _ in parts:
+        _merged_parts[(user_id, message_id)] = copy
+    while len(_merged_texts) > MERGED_TEXTS_CACHE_SIZE:
+        _, (evicted_user, evicted) = _merged_texts.popitem(last=False)
+        for message_id, _, _ in evicted:
+            _merged_parts.pop((evicted_user, message_id), None)
+
+
+async def send_merged(bot, user_id: int, topic: TopicRef, run: List[RelayItem],
+                      chunk: MergedText, whole: bool) -> List[int]:
+    """
+    Отправить в тему склеенные тексты пользователя одним сообщением.
+    Возвращает пустой список: склеенную копию нельзя править по одному
+    тексту, правки частей идут через remember_merged.
+    """
+    chat_id, topic_id = topic
+    sent = await bot.send_message(
+        chat_id=chat_id,
+        message_thread_id=topic_id,
+        text=chunk.text,
+        entities=chunk.entities
+    )
+    # Текст, разрезанный на несколько сообщений, целиком не поправить
+    if whole:
+        remember_merged(user_id, (chat_id, sent.message_id),
+                        [(run[index].message.message_id, run[index].message.text, run[index].message.entities)
+                         for index in chunk.parts])
+    return []
+
+
+async def forward_run(bot, user_id: int, topic: TopicRef, run: List[RelayItem]) -> List[int]:
+    """Скопировать в тему подряд идущие сообщения пользователя одним вызовом; возвращает ID копий"""
+    chat_id, topic_id = topic
+    # Ответ пользователя на сообщение админа - цитируем его оригинал в теме
+    kwargs = {}
+    if len(run) == 1 and run[0].message.reply_to_message:
+        quoted = await get_message_index().get_group_message(
+            user_id, run[0].message.reply_to_message.message_id)
+        if quoted and quoted[0] == chat_id:
+            kwargs['reply_parameters'] = ReplyParameters(quoted[1], allow_sending_without_reply=True)
+
+    return await copy_to_chat(
+        bot,
+        user_id,
+        [item.message.message_id for item in run],
+        chat_id,
+        topic_id,
+        **kwargs
+    )
+
+
+class ForwardSend(NamedTuple):
+    """Один запрос пересылки в тему"""
+    items: List[RelayItem]  # Сообщения, которые он отправляет (целиком или частью)
+    done: List[RelayItem]  # Сообщения, доставленные после него целиком
+    parts: List[str]  # Части длинных текстов, которые он доставляет не последними (part_key)
+    send: Callable[[], Awaitable[List[int]]]
+
+
+def forward_sends(bot, user_id: int, topic: TopicRef, group: List[RelayItem]) -> List[ForwardSend]:
+    """
+    Разбить сообщения пользователя на отправки в тему: тексты подряд
+    склеиваются, остальное копируется пачкой. Каждое склеенное сообщение -
+    отдельная отправка со своими записями журнала, поэтому повтор не
+    отправит заново уже дошедшие. Текст, который не помещается в одно
+    сообщение, всегда начинает новое и режется одинаково, поэтому его
+    части, кроме последней, доставляются под своими ключами (part_key).
+    """
+    sends = []
+    for merge, run in itertools.groupby(
+        group, key=lambda item: TEXT_COALESCE_WINDOW > 0 and bool(item.message.text)
+    ):
+        run = list(run)
+        if not merge or len(run) == 1 and utf16_len(run[0].message.text or '') <= MESSAGE_MAX_LENGTH:
+            sends.append(ForwardSend(run, run, [], functools.partial(forward_run, bot, user_id, topic, run)))
+            continue
+        chunks = merge_texts([(item.message.text, item.message.entities) for item in run], MESSAGE_MAX_LENGTH)
+        pieces = [[number for number, chunk in enumerate(chunks) if index in chunk.parts] for index in range(len(run))]
+        for number, chunk in enumerate(chunks):
+            whole = all(len(pieces[index]) == 1 for index in chunk.parts)
+            done = [run[index] for index in chunk.parts if pieces[index][-1] == number]
+            parts = [part_key(run[index].key, pieces[index].index(number))
+                     for index in chunk.parts if pieces[index][-1] != number]
+            sends.append(ForwardSend([run[index] for index in chunk.parts], done, parts,
+                                     functools.partial(send_merged, bot, user_id, topic, run, chunk, whole)))
+    return sends
+
+
+async def forward_to_topic(user_id: int, items: List[RelayItem]):
+    """Переслать пачку сообщений пользователя в его тему (с повторами через журнал)"""
+    outbox = get_outbox()
+    index = get_message_index()
+    postponed = None
+    # Если за время пачки тема сменилась (/cancel и новое обращение), шлем по частям
+    for topic, group in itertools.groupby(items, key=lambda item: item.topic):
+        group = list(group)
+        setup = _topic_setups.pop(topic, None)
+        if setup is not None:
+            # Приветствие должно оказаться в новой теме раньше первого сообщения
+            topic = await setup
+        last_message = group[-1].message
+        bot = last_message.get_bot()
+        delivered = []
+
+        sends = forward_sends(bot, user_id, topic, group)
+        sent_parts = await outbox.delivered([part for send in sends for part in send.parts])
+        for send in sends:
+            if not send.done and sent_parts.issuperset(send.parts):
+                # Начало длинного текста дошло до повтора
+                continue
+            bind(trace_id=','.join(item.key for item in send.items), user_id=user_id,
+                 group_id=topic[0], topic_id=topic[1])
+            try:
+                copy_ids = await outbox.deliver([item.key for item in send.done], send.send, send.parts)
+            except DeliveryPostponed as e:
+                postponed = e
+                # Неотправленное (с этой отправки) ждет повтора, дошедшее подтверждаем
+                rest = items[next(i for i, item in enumerate(items) if item is send.items[0]):]
+                break
+            except Exception as e:
+                logger.error(f"Error forwarding message: {e}")
+                await send.items[-1].message.reply_text("❌ Ошибка при отправке сообщения.")
+                continue
+
+            # copyMessages пропускает сообщения, которые нельзя скопировать, и тогда
+            # ID копий не сопоставить с оригиналами - такую пачку не индексируем
+            if len(copy_ids) == len(send.done):
+                for item, copy_id in zip(send.done, copy_ids):
+                    await index.add(user_id, item.message.message_id, topic[0], copy_id)
+            elif copy_ids:
+                logger.warning(f"Got {len(copy_ids)} copies for {len(send.done)} messages, "
+                               f"replies to them will not be linked")
+            for item in send.done:
+                record_transcript(user_id, topic, item.message, from_admin=False)
+                delivered.append(item)
+
+        if delivered:
+            await get_database().record_messages(topic, from_admin=False, count=len(delivered))
 
             # Подтверждаем пользователю
-            await update.message.reply_text("✅ Ваше сообщение отправлено команде поддержки. Ожидайте ответа здесь.")
+            ack = relay_ack_text(delivered)
+            if ack:
+                await acknowledge_user(last_message, ack, first=any(item.first for item in delivered))
+
+        if postponed is not None:
+            # Бот останавливается - остальное уйдет из журнала после перезапуска
+            if postponed.delay is not None:
+                get_relay().defer(user_id, rest, postponed.delay)
+            return
+
+
+async def send_reply(bot, item: ReplyItem) -> List[int]:
+    """Скопировать ответ админа пользователю; возвращает ID копии"""
+    # Добавляем кнопку "Ответить" для пользователя
+    keyboard = [[InlineKeyboardButton("📝 Ответить", callback_data="reply_to_admin")]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    kwargs = {}
+    if item.quoted:
+        kwargs['reply_parameters'] = ReplyParameters(item.quoted, allow_sending_without_reply=True)
+
+    return await copy_to_chat(
+        bot,
+        item.message.chat_id,
+        [item.message.message_id],
+        item.user_id,
+        reply_markup=reply_markup,
+        rate_limit_args={'priority': PRIORITY_HIGH},
+        **kwargs
+    )
+
+
+async def deliver_replies(user_id: int, items: List[ReplyItem]):
+    """Отправить пользователю ответы админов по порядку (с повторами через журнал)"""
+    outbox = get_outbox()
+    for position, item in enumerate(items):
+        message = item.message
+        bind(trace_id=item.key, user_id=user_id, group_id=item.topic[0], topic_id=item.topic[1])
+        try:
+            copy_ids = await outbox.deliver([item.key], functools.partial(send_reply, message.get_bot(), item))
+        except DeliveryPostponed as e:
+            # Этот и следующие ответы повторятся после паузы (или после перезапуска)
+            if e.delay is not None:
+                get_replies().defer(user_id, items[position:], e.delay)
+            return
+        except Exception as e:
+            logger.error(f"Error sending reply to user: {e}")
+            await message.reply_text(
+                f"❌ Ошибка: {e}",
+                reply_to_message_id=message.message_id
+            )
+            continue
+
+        await get_message_index().add(user_id, copy_ids[0], message.chat_id, message.message_id)
+        record_transcript(user_id, item.topic, message, from_admin=True)
+        await get_database().record_messages(item.topic, from_admin=True)
+        touch_topic(item.topic)
+
+        # Подтверждаем админу
+        if ACK_MODE == 'message':
+            await message.reply_text(
+                "✅ Ответ отправлен пользователю.",
+                reply_to_message_id=message.message_id
+            )
+        else:
+            get_acks().add(item.topic, message)
+
+
+_no_reactions = set()  # Чаты, где реакция-подтверждение недоступна (подтверждаем сообщением)
+
+
+async def set_ack_reaction(message: Message) -> bool:
+    """Поставить на сообщение реакцию-подтверждение; False - реакции в чате недоступны"""
+    if message.chat_id in _no_reactions:
+        return False
+    try:
+        await message.get_bot().set_message_reaction(message.chat_id, message.message_id, ACK_REACTION,
+                                                     rate_limit_args={'priority': PRIORITY_LOW})
+    except BadRequest as e:
+        # Реакции в чате отключены или эта реакция не разрешена - больше не пробуем до перезапуска
+        logger.warning(f"Cannot set ack reaction in {message.chat_id}: {e}")
+        _no_reactions.add(message.chat_id)
+        return False
+    return True
+
+
+async def acknowledge_user(message: Message, text: str, first: bool):
+    """
+    Подтвердить пользователю пересылку его сообщений. Первое сообщение
+    обращения подтверждаем текстом (в нем объяснение, где ждать ответа),
+    остальные - реакцией, если ACK_MODE не 'message'.
+    """
+    if first or ACK_MODE == 'message' or not await set_ack_reaction(message):
+        await message.reply_text(text)
+
+
+_ack_status: Dict[TopicRef, Tuple[int, int]] = {}  # Тема -> (ID сообщения о статусе, сколько ответов доставлено)
+
+
+async def send_acks(topic: TopicRef, messages: List[Message]):
+    """
+    Подтвердить админам доставку пачки ответов в теме. Пока отправляется
+    одно подтверждение, следующие копятся, поэтому под нагрузкой на пачку
+    уходит один запрос: правка сообщения о статусе темы ('status') или
+    реакция на последний ответ каждого админа ('reaction').
+    """
+    bot = messages[-1].get_bot()
+    if ACK_MODE == 'status':
+        await update_ack_status(bot, topic, len(messages))
+        return
+    last = {}
+    for message in messages:
+        last[message.from_user.id if message.from_user else None] = message
+    for message in last.values():
+        if not await set_ack_reaction(message):
+            await message.reply_text("✅ Ответ отправлен пользователю.",
+                                     reply_to_message_id=message.message_id)
+
+
+async def update_ack_status(bot, topic: TopicRef, delivered: int):
+    """Обновить сообщение о статусе темы (или отправить новое, если его еще нет или оно удалено)"""
+    chat_id, topic_id = topic
+    message_id, total = _ack_status.get(topic, (None, 0))
+    total += delivered
+    text = f"✅ Ответов доставлено пользователю: {total} (последний - {datetime.now():%H:%M:%S})"
+    if message_id is not None:
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                                        rate_limit_args={'priority': PRIORITY_LOW})
+            _ack_status[topic] = (message_id, total)
+            return
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                _ack_status[topic] = (message_id, total)
+                return
+            logger.info(f"Ack status message in topic {topic_id} of {chat_id} is gone: {e}")
+    message = await bot.send_message(chat_id, text, message_thread_id=topic_id,
+                                     rate_limit_args={'priority': PRIORITY_LOW})
+    _ack_status[topic] = (message.message_id, total)
+
+
+def attachment_type(message: Message) -> Optional[str]:
+    """Вид вложения сообщения ('photo', 'voice'...)"""
+    for kind in MessageAttachmentType:
+        if getattr(message, kind.value, None):
+            return kind.value
+    return None
+
+
+def record_transcript(user_id: int, topic: TopicRef, message: Message, from_admin: bool):
+    """Доставленное сообщение - в поиск по переписке и в архив"""
+    text = message.text or message.caption
+    get_transcripts().add(user_id, topic, text, from_admin=from_admin)
+    get_archive().append(user_id, topic, text, from_admin=from_admin,
+                         author=message.from_user.full_name if from_admin and message.from_user else None,
+                         media=attachment_type(message))
+
+
+def requeue(bot, entry: OutboxEntry):
+    """Поставить запись журнала обратно в очередь отправки (после перезапуска или /redeliver)"""
+    payload = entry.payload
+    message = Message.de_json(payload['message'], bot)
+    topic = tuple(payload['topic'])
+    if entry.kind == 'to_topic':
+        get_relay().add(message.chat_id, RelayItem(message, topic, payload['first'], entry.key))
+    elif entry.kind == 'to_user':
+        user_id = payload['user_id']
+        get_replies().add(user_id, ReplyItem(message, user_id, topic, payload['quoted'], entry.key))
+    else:
+        logger.error(f"Unknown outbox entry kind: {entry.kind}")
+
+
+_relay: Optional[RelayBuffer] = None
+_idle_scheduler: Optional[IdleScheduler] = None
+_replies: Optional[RelayBuffer] = None
+_acks: Optional[RelayBuffer] = None
+_outbox: Optional[Outbox] = None
+_message_index: Optional[MessageIndex] = None
+_transcripts: Optional[Transcripts] = None
+_archive: Optional[Archive] = None
+_flood_control: Optional[FloodControl] = None
+_placement: Optional[PlacementPolicy] = None
+_topic_pool: Optional[TopicPool] = None
+# Темы, которые сейчас создаются, по группам - чтобы параллельные
+# обращения не выбирали одну и ту же группу до записи в базу
+_placing: Dict[int, int] = {}
+
+
+def get_placement() -> PlacementPolicy:
+    """Политика выбора группы для новых тем (создается в post_init)"""
+    return _placement
+
+
+def get_relay() -> RelayBuffer:
+    """Общий буфер пересылки сообщений пользователей (создается в post_init)"""
+    return _relay
+
+
+def get_replies() -> RelayBuffer:
+    """Очередь ответов админов пользователям (создается в post_init)"""
+    return _replies
+
+
+def get_acks() -> RelayBuffer:
+    """Очередь подтверждений админам по темам (создается в post_init)"""
+    return _acks
+
+
+def get_outbox() -> Outbox:
+    """Журнал исходящих пересылок (создается в post_init)"""
+    return _outbox
+
+
+def get_message_index() -> MessageIndex:
+    """Связи сообщений пользователей и их копий в темах (создается в post_init)"""
+    return _message_index
+
+
+def get_transcripts() -> Transcripts:
+    """Архив переписки для поиска (создается в post_init)"""
+    return _transcripts
+
+
+def get_archive() -> Archive:
+    """Архив переписки для /export (создается в post_init)"""
+    return _archive
+
+
+async def trace_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начать контекст логов обновления: trace_id и пользователь попадут во все его записи"""
+    start_trace(f'update:{update.update_id}',
+                user_id=update.effective_user.id if update.effective_user else None)
+
+
+def get_flood_control() -> Optional[FloodControl]:
+    """Ограничение частоты сообщений пользователей (None - выключено)"""
+    return _flood_control
+
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Отбросить сообщение пользователя сверх ограничения частоты раньше
+    остальных обработчиков - до базы и запросов к Telegram.
+    """
+    flood = get_flood_control()
+    if flood is None:
+        return
+    decision = flood.check(update.effective_user.id)
+    if decision.allowed:
+        return
+
+    MESSAGES_THROTTLED.inc()
+    if decision.muted_for:
+        # Предупреждаем один раз за заглушение, остальное отбрасываем молча
+        await update.effective_message.reply_text(
+            f"⏳ Слишком много сообщений подряд. Это сообщение и все, что придет "
+            f"в ближайшие {format_duration(decision.muted_for)}, не будут доставлены."
+        )
+    raise ApplicationHandlerStop
+
+
+async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка сообщений от пользователей в личке"""
+    user = update.effective_user
+    user_id = user.id
+    message_text = update.message.text or update.message.caption or "[Медиа-файл]"
+    # Ключ сообщения в журнале отправки - он же trace_id в логах до самой доставки
+    key = f'user:{user_id}:{update.message.message_id}'
+    bind(trace_id=key)
+
+    db = get_database()
+
+    # Проверяем, есть ли уже тема для этого пользователя
+    topic = await db.get_user_topic(user_id)
+    first = False
+
+    if topic:
+        info = await db.get_topic(topic)
+        if info and info.closed:
+            # Пользователь вернулся после закрытия по неактивности - открываем старую тему
+            try:
+                topic = await reopen_user_topic(context, user_id, topic)
+            except Exception as e:
+                logger.error(f"Error reopening topic: {e}")
+                await update.message.reply_text("❌ Ошибка при создании обращения. Попробуйте позже.")
+                return
+            first = topic is not None
+
+    if not topic:
+        # Создаем новую тему в одной из групп
+        if not db.get_groups():
+            await update.message.reply_text(
+                "⏳ Админская группа еще не настроена. "
+                "Администраторы должны добавить бота в группу и выполнить команду /setgroup"
+            )
+            return
 
+        first = True
+        try:
+            topic = await create_user_topic(context, user, message_text)
         except Exception as e:
             logger.error(f"Error creating topic: {e}")
             await update.message.reply_text("❌ Ошибка при создании обращения. Попробуйте позже.")
             return
+
+    touch_topic(topic)
+    bind(group_id=topic[0], topic_id=topic[1])
+
+    # Пересылаем сообщение в тему; сообщения, пришедшие вместе, уйдут одним вызовом.
+    # Части альбома придерживаем, пока приходят остальные, чтобы альбом ушел целиком,
+    # а короткие тексты подряд - чтобы склеить их в одно сообщение
+    if update.message.media_group_id:
+        hold = MEDIA_GROUP_WINDOW
+    elif update.message.text:
+        hold = TEXT_COALESCE_WINDOW
     else:
-        # Пересылаем сообщение в существующую тему
-        try:
-            # Если есть текст
-            if update.message.text:
-                await context.bot.send_message(
-                    chat_id=ADMIN_GROUP_ID,
-                    message_thread_id=topic_id,
-                    text=f"👤 Пользователь:\n{message_text}"
-                )
-            # Если есть фото
-            elif update.message.photo:
-                await context.bot.send_photo(
-                    chat_id=ADMIN_GROUP_ID,
-                    message_thread_id=topic_id,
-                    photo=update.message.photo[-1].file_id,
-                    caption=f"👤 Пользователь: {message_text}" if message_text != "[Медиа-файл]" else None
-                )
-                await update.message.reply_text("✅ Фото отправлено команде поддержки.")
-            # Если есть документ
-            elif update.message.document:
-                await context.bot.send_document(
-                    chat_id=ADMIN_GROUP_ID,
-                    message_thread_id=topic_id,
-                    document=update.message.document.file_id,
-                    caption=f"👤 Пользователь: {message_text}" if message_text != "[Медиа-файл]" else None
-                )
-                await update.message.reply_text("✅ Файл отправлен команде поддержки.")
+        hold = 0.0
 
-        except Exception as e:
-            logger.error(f"Error forwarding message: {e}")
-            await update.message.reply_text("❌ Ошибка при отправке сообщения.")
+    # Сначала записываем в журнал: если бот упадет до отправки, сообщение уйдет после перезапуска
+    item = RelayItem(update.message, topic, first, key)
+    payload = {'message': update.message.to_dict(), 'topic': list(topic), 'first': first}
+    if not await get_outbox().add(item.key, 'to_topic', payload):
+        # Telegram прислал уже полученное обновление повторно
+        return
+    get_relay().add(user_id, item, hold=hold)
 
 
 async def handle_group_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка ответов админов в группе"""
-    global ADMIN_GROUP_ID
-
-    # Загружаем ID группы из базы, если еще не загружено
-    if ADMIN_GROUP_ID is None:
-        db = Database()
-        ADMIN_GROUP_ID = db.get_group_id()
-        if not ADMIN_GROUP_ID:
-            return
-
+    """Обработка ответов админов в группах"""
     # Проверяем, что это ответ на сообщение бота
-    if not update.message.reply_to_message:
+    reply_to = update.message.reply_to_message
+    if not reply_to:
         return
 
-    # Проверяем, что это ответ именно на сообщение бота
-    if update.message.reply_to_message.from_user.id != context.bot.id:
+    # Сообщение пользователя (или ответ админа), на которое отвечают, - чтобы процитировать его в личке
+    chat_id = update.effective_chat.id
+    index = get_message_index()
+    quoted = await index.get_private_message(chat_id, reply_to.message_id)
+
+    # Проверяем, что это ответ именно на сообщение бота или на уже пересланный ответ
+    if not quoted and (not reply_to.from_user or reply_to.from_user.id != context.bot.id):
         return
 
+    # Проверяем права отвечающего, если отвечать могут только админы
+    if ADMIN_REPLIES_ONLY:
+        try:
+            if not await is_group_admin(update, context):
+                return
+        except Exception as e:
+            logger.error(f"Error checking admin status: {e}")
+            return
+
     # Получаем ID темы из сообщения
     topic_id = update.message.message_thread_id
 
     # Находим пользователя по теме
-    db = Database()
-    user_id = db.get_user_by_topic(topic_id)
+    db = get_database()
+    user_id = await db.get_user_by_topic(chat_id, topic_id)
 
     if not user_id:
+        if chat_id not in db.get_groups():
+            # Не админская группа - не наше дело
+            return
         await update.message.reply_text(
             "❌ Не могу найти пользователя для этой темы.",
             reply_to_message_id=update.message.message_id
         )
         return
 
-    # Пересылаем ответ пользователю
-    try:
-        reply_text = f"📨 Ответ от поддержки:\n\n{update.message.text}"
+    # Ставим ответ в очередь пользователя, записав его в журнал отправки
+    key = f'reply:{chat_id}:{update.message.message_id}'
+    bind(trace_id=key, user_id=user_id, group_id=chat_id, topic_id=topic_id)
+    item = ReplyItem(
+        update.message,
+        user_id,
+        (chat_id, topic_id),
+        quoted[1] if quoted and quoted[0] == user_id else None,
+        key
+    )
+    payload = {'message': update.message.to_dict(), 'user_id': user_id, 'topic': [chat_id, topic_id],
+               'quoted': item.quoted}
+    if await get_outbox().add(item.key, 'to_user', payload):
+        get_replies().add(user_id, item)
 
-        # Добавляем кнопку "Ответить" для пользователя
-        keyboard = [[InlineKeyboardButton("📝 Ответить", callback_data="reply_to_admin")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
 
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=reply_text,
-            reply_markup=reply_markup
-        )
+async def handle_edited_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Правка сообщения пользователем - правим его копию в теме"""
+    message = update.edited_message
+    user_id = update.effective_user.id
 
-        # Подтверждаем админу
-        await update.message.reply_text(
-            "✅ Ответ отправлен пользователю.",
-            reply_to_message_id=update.message.message_id
-        )
+    copy = await get_message_index().get_group_message(user_id, message.message_id)
+    try:
+        merged = _merged_parts.get((user_id, message.message_id))
+        if merged and message.text and await edit_merged(context.bot, merged, message):
+            return
+        if copy:
+            chat_id, copy_id = copy
+            if message.text:
+                await context.bot.edit_message_text(
+                    chat_id=chat_id, message_id=copy_id,
+                    text=message.text, entities=message.entities
+                )
+                return
+            if message.caption is not None:
+                await context.bot.edit_message_caption(
+                    chat_id=chat_id, message_id=copy_id,
+                    caption=message.caption, caption_entities=message.caption_entities
+                )
+                return
 
-    except Exception as e:
-        logger.error(f"Error sending reply to user: {e}")
-        await update.message.reply_text(
-            f"❌ Ошибка: {e}",
-            reply_to_message_id=update.message.message_id
+        # Копии нет (сообщение было склеено с другими и уже забыто или слишком старое) -
+        # отправляем новую версию текстом в тему
+        topic = await get_database().get_user_topic(user_id)
+        text = message.text or message.caption
+        if not topic or not text:
+            return
+        chat_id, topic_id = topic
+        await context.bot.send_message(
+            chat_id=chat_id,
+            message_thread_id=topic_id,
+            text=f"✏️ Пользователь изменил сообщение:\n{text}"[:MESSAGE_MAX_LENGTH],
+            reply_parameters=ReplyParameters(copy[1], allow_sending_without_reply=True) if copy else None
         )
+    except BadRequest as e:
+        # "message is not modified" и правки удаленных копий
+        logger.warning(f"Error editing message copy for user {user_id}: {e}")
+
+
+async def edit_merged(bot, copy: Tuple[int, int], message: Message) -> bool:
+    """Поправить склеенное сообщение по правке одной из частей; False - не помещается в одно сообщение"""
+    user_id, parts = _merged_texts[copy]
+    parts = [(part[0], message.text, message.entities) if part[0] == message.message_id else part
+             for part in parts]
+    chunks = merge_texts([(text, entities) for _, text, entities in parts], MESSAGE_MAX_LENGTH)
+    if len(chunks) > 1:
+        return False
+    await bot.edit_message_text(chat_id=copy[0], message_id=copy[1],
+                                text=chunks[0].text, entities=chunks[0].entities)
+    _merged_texts[copy] = (user_id, parts)
+    _merged_texts.move_to_end(copy)
+    return True
 
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатий на кнопки"""
     query = update.callback_query
-    await query.answer()
 
     if query.data == "reply_to_admin":
-        await query.edit_message_text(
-            "📝 Напишите ваш ответ. Он будет передан команде поддержки."
-        )
+        # Кнопка висит на копии ответа админа (текст, фото, голосовое...) -
+        # само сообщение не трогаем, подсказываем всплывающим уведомлением
+        await query.answer("📝 Напишите ваш ответ. Он будет передан команде поддержки.")
+    else:
+        await query.answer()
 
 
 # ========== ЗАПУСК БОТА ==========
-def main():
-    """Основная функция запуска бота"""
+_metrics_server: Optional[asyncio.AbstractServer] = None
+
+
+async def start_metrics(application: Application):
+    """Подключить показатели очередей и запустить HTTP-сервер метрик"""
+    global _metrics_server
+    ACTIVE_TOPICS.set_function(lambda: get_database().open_topics)
+    QUEUE_DEPTH.set_function(lambda: get_relay().depth, 'relay')
+    QUEUE_DEPTH.set_function(lambda: get_replies().depth, 'replies')
+    QUEUE_DEPTH.set_function(lambda: get_acks().depth, 'acks')
+    QUEUE_DEPTH.set_function(application.update_queue.qsize, 'updates')
+    QUEUE_DEPTH.set_function(lambda: application.update_processor.active_conversations, 'conversations')
+    rate_limiter = application.bot.rate_limiter
+    if isinstance(rate_limiter, OutboundScheduler):
+        QUEUE_DEPTH.set_function(lambda: rate_limiter.queue_depth, 'outbound')
+
+    if METRICS_PORT is not None:
+        port = METRICS_PORT + application.bot_data.get('worker_index', 0)
+        try:
+            _metrics_server = await serve_metrics(METRICS_LISTEN, port)
+        except OSError as e:
+            logger.error(f"Error starting metrics server on port {port}: {e}")
+
+
+async def post_init(application: Application):
+    """Запуск фоновых задач после инициализации приложения"""
+    global _relay, _replies, _acks, _outbox, _admin_cache, _closeall_task, _placement, _message_index, _idle_scheduler
+    global _topic_pool, _chat_registry, _broadcast_task, _transcripts, _archive, _flood_control
+    _admin_cache = AdminCache(ttl=ADMIN_CACHE_TTL)
+    _placement = create_policy(PLACEMENT_POLICY, LANGUAGE_GROUPS)
+    if FLOOD_RATE_PER_MINUTE and application.bot_data.get('flood_control', True):
+        _flood_control = FloodControl(FLOOD_RATE_PER_MINUTE / 60, FLOOD_BURST, mute=FLOOD_MUTE,
+                                      max_mute=FLOOD_MAX_MUTE)
+    _relay = RelayBuffer(forward_to_topic, window=RELAY_BATCH_WINDOW, max_delay=TEXT_COALESCE_MAX_DELAY)
+    _replies = RelayBuffer(deliver_replies)
+    _acks = RelayBuffer(send_acks, window=ACK_BATCH_WINDOW)
+    shared = application.bot_data.get('shared_storage', False)
+    worker = application.bot_data.get('worker_index', 0)
+    # Состояние с прошлой остановки: связи, списки админов, лимиты
+    snapshot = load_snapshot(worker_filename(SNAPSHOT_FILE, worker)) if SNAPSHOT_FILE else None
+    db = await open_database(shared=shared, worker=worker,
+                             snapshot=snapshot.get('database') if snapshot else None)
+    if snapshot:
+        restore_state(application, snapshot)
+    _message_index = MessageIndex(
+        MESSAGE_INDEX_FILE,
+        capacity=MESSAGE_INDEX_CACHE_SIZE,
+        retention=MESSAGE_INDEX_RETENTION_DAYS * 86400,
+        shared=shared
+    )
+    await _message_index.open()
+    _outbox = Outbox(
+        OUTBOX_FILE,
+        worker=worker,
+        max_attempts=OUTBOX_MAX_ATTEMPTS,
+        base_delay=OUTBOX_RETRY_DELAY,
+        max_delay=OUTBOX_MAX_RETRY_DELAY,
+        retention=OUTBOX_RETENTION_HOURS * 3600
+    )
+    await _outbox.open()
+    _transcripts = Transcripts(TRANSCRIPTS_FILE)
+    await _transcripts.open()
+    _archive = Archive(
+        ARCHIVE_DIR,
+        worker=worker,
+        segment_size=ARCHIVE_SEGMENT_MB * 2**20,
+        max_size=ARCHIVE_MAX_MB * 2**20 if ARCHIVE_MAX_MB is not None else None,
+        retention=ARCHIVE_RETENTION_DAYS * 86400 if ARCHIVE_RETENTION_DAYS is not None else None
+    )
+    await _archive.open()
+    _chat_registry = ChatRegistry(worker_filename(CHAT_REGISTRY_FILE, worker))
+    _chat_registry.open()
+    await start_metrics(application)
+
+    # Досылаем то, что не успели доставить до остановки
+    pending = await _outbox.pending()
+    if pending:
+        logger.info(f"Resuming delivery of {len(pending)} outbox entries")
+        for entry in pending:
+            requeue(application.bot, entry)
+
+    # Закрытие тем по неактивности; открытые темы из базы загружает первый процесс
+    if TOPIC_IDLE_CLOSE_HOURS:
+        _idle_scheduler = IdleScheduler(TOPIC_IDLE_CLOSE_HOURS * 3600,
+                                        functools.partial(close_idle_topic, application.bot))
+        if worker == 0:
+            for topic, last_activity in (await db.topic_activity()).items():
+                _idle_scheduler.touch(topic, last_activity)
+        _idle_scheduler.start()
+
+    # Запас готовых тем; у каждого процесса вебхука свой
+    if TOPIC_POOL_SIZE:
+        _topic_pool = TopicPool(
+            functools.partial(create_pool_topic, application.bot),
+            db.get_groups,
+            low=min(TOPIC_POOL_LOW_WATERMARK, TOPIC_POOL_SIZE - 1),
+            high=TOPIC_POOL_SIZE,
+            on_change=save_topic_pool
+        )
+        _topic_pool.load(db.get_value(db.own_key('spare_topics')))
+        _topic_pool.start()
+        SPARE_TOPICS.set_function(_topic_pool.available)
+
+    # Продолжаем /closeall, прерванный остановкой бота
+    job = db.get_value(db.own_key('closeall_job'))
+    if job:
+        logger.info(f"Resuming /closeall: {len(job['topics'])} topics left")
+        _closeall_task = asyncio.create_task(close_topics(application.bot, job))
+
+    # Продолжаем прерванную /broadcast
+    job = db.get_value(db.own_key('broadcast_job'))
+    if job:
+        logger.info(f"Resuming /broadcast after user {job['cursor']}")
+        _broadcast_task = asyncio.create_task(broadcast(application.bot, job))
+
+    # Показываем сохраненные админские группы
+    groups = db.get_groups()
+    if groups:
+        logger.info(f"Loaded admin groups: {', '.join(map(str, groups))}")
+
+
+def restore_state(application: Application, snapshot: Dict[str, Any]):
+    """Восстановить списки админов, лимиты и сообщения о статусе тем из снимка прошлой остановки"""
+    elapsed = snapshot_age(snapshot)
+    get_admin_cache().restore(snapshot['admins'], elapsed)
+    rate_limiter = application.bot.rate_limiter
+    if isinstance(rate_limiter, OutboundScheduler) and snapshot.get('rate_limiter'):
+        rate_limiter.restore(snapshot['rate_limiter'], elapsed)
+    if _flood_control is not None and snapshot.get('flood'):
+        _flood_control.restore(snapshot['flood'], elapsed)
+    _ack_status.update(snapshot.get('ack_status') or {})
+    logger.info(f"Restored state from snapshot taken {elapsed:.1f}s ago")
+
+
+def capture_state(application: Application) -> Dict[str, Any]:
+    """Списки админов, лимиты и сообщения о статусе тем для снимка при остановке (связи добавляются отдельно)"""
+    rate_limiter = application.bot.rate_limiter
+    return {
+        'admins': get_admin_cache().snapshot(),
+        'rate_limiter': rate_limiter.snapshot() if isinstance(rate_limiter, OutboundScheduler) else None,
+        'flood': _flood_control.snapshot() if _flood_control is not None else None,
+        'ack_status': _ack_status
+    }
+
+
+async def drain_outbound(timeout: float) -> bool:
+    """
+    Дождаться фоновых запросов по новым темам и отправки очередей пересылки,
+    ответов и подтверждений; False - не успели за timeout секунд.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if _background_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.wait(list(_background_tasks), timeout=remaining)
+            continue
+        for buffer in (get_relay(), get_replies(), get_acks()):
+            if not await buffer.drain(deadline - time.monotonic()):
+                return False
+        # Пересылка могла запустить новые фоновые запросы
+        if not _background_tasks:
+            return True
+
+
+async def post_stop(application: Application):
+    """
+    Остановка, пока бот еще может делать запросы. Новые обновления уже не
+    принимаются, а начатые обработаны (это делает application.stop()):
+    останавливаем фоновые задачи и досылаем очереди, но не дольше
+    SHUTDOWN_TIMEOUT секунд.
+    """
+    if _idle_scheduler is not None:
+        await _idle_scheduler.stop()
+    if _topic_pool is not None:
+        await _topic_pool.stop()
+    # Незакрытые темы /closeall и неотправленная рассылка остаются в заданиях
+    # и продолжатся после перезапуска
+    for task in (_closeall_task, _broadcast_task):
+        if task and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    if not await drain_outbound(SHUTDOWN_TIMEOUT):
+        # Не успели: прерываем отправку. Сообщения остаются в журнале и уйдут
+        # после перезапуска (прерванные на полпути могут прийти повторно)
+        get_outbox().stop()
+        left = await get_relay().cancel() + await get_replies().cancel()
+        await get_acks().cancel()
+        tasks = list(_background_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.warning(f"Shutdown timeout ({SHUTDOWN_TIMEOUT}s): {left} queued messages left in outbox")
+    # Повторы отправки прекращаются: недоставленное (и отложенные повторы)
+    # останется в журнале
+    get_outbox().stop()
+    await get_relay().cancel()
+    await get_replies().cancel()
+
+
+async def post_shutdown(application: Application):
+    """Сохранение состояния при остановке бота"""
+    if _metrics_server:
+        _metrics_server.close()
+    state = capture_state(application) if SNAPSHOT_FILE else None
+    if state is not None:
+        # Метка снимка попадет в хранилище вместе с последними изменениями
+        state['database'] = await get_database().snapshot()
+    await get_outbox().close()
+    await _chat_registry.close()
+    await get_message_index().close()
+    await get_transcripts().close()
+    await get_archive().close()
+    await get_database().close()
+
+    if state is not None:
+        filename = worker_filename(SNAPSHOT_FILE, get_database().worker)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, save_snapshot, filename, state)
+        except Exception as e:
+            logger.error(f"Error saving snapshot {filename}: {e}")
 
-    # Читаем токен из файла
-    try:
-        with open(API_TOKEN_FILE, 'r') as f:
-            TOKEN = f.read().strip()
-    except FileNotFoundError:
-        print(f"❌ Файл '{API_TOKEN_FILE}' не найден!")
-        print(f"Создайте файл '{API_TOKEN_FILE}' и поместите туда токен бота.")
-        return
 
-    if not TOKEN:
-        print("❌ Токен не найден в файле!")
-        return
+def build_application(token: str, base_url: Optional[str] = None, shared_storage: bool = False,
+                      rate_limits: bool = True, workers: int = 1, flood_control: bool = True) -> Application:
+    """
+    Создать приложение со всеми обработчиками.
+    shared_storage - база используется несколькими процессами (вебхук),
+    workers - сколько процессов делят общие лимиты Telegram,
+    rate_limits=False отключает планировщик отправки, а flood_control=False -
+    ограничение частоты сообщений пользователей (для нагрузочных тестов).
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(ConversationUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if rate_limits:
+        # Личные чаты закреплены за одним процессом, а общий лимит бота
+        # и лимит админской группы делятся между всеми процессами
+        builder = builder.rate_limiter(OutboundScheduler(
+            global_rate=GLOBAL_RATE_LIMIT / workers,
+            group_rate=GROUP_RATE_LIMIT / 60 / workers,
+            group_burst=GROUP_BURST,
+            private_rate=PRIVATE_RATE_LIMIT,
+            max_retries=SEND_MAX_RETRIES
+        ))
+    else:
+        builder = builder.rate_limiter(PassThroughLimiter())
+    application = builder.build()
+    application.bot_data['shared_storage'] = shared_storage
+    application.bot_data['flood_control'] = flood_control
 
-    print("✅ Токен загружен")
+    # Контекст логов обновления - первым делом
+    application.add_handler(TypeHandler(Update, trace_update), group=-2)
 
-    # Создаем приложение
-    application = Application.builder().token(TOKEN).build()
+    # Ограничение частоты сообщений пользователей - раньше всех обработчиков
+    application.add_handler(MessageHandler(
+        filters.ChatType.PRIVATE & (filters.UpdateType.MESSAGE | filters.UpdateType.EDITED_MESSAGE),
+        flood_guard
+    ), group=-1)
 
     # Обработчики команд для пользователей
     application.add_handler(CommandHandler("start", start_command))
@@ -437,55 +2423,109 @@ def main():
 
     # Обработчики команд для админов
     application.add_handler(CommandHandler("setgroup", admin_set_group))
+    application.add_handler(CommandHandler("removegroup", admin_remove_group))
+    application.add_handler(CommandHandler("stats", admin_stats))
+    application.add_handler(CommandHandler("closeall", admin_close_all))
+    application.add_handler(CommandHandler("outbox", admin_outbox))
+    application.add_handler(CommandHandler("redeliver", admin_redeliver))
+    application.add_handler(CommandHandler("broadcast", admin_broadcast))
+    application.add_handler(CommandHandler("throttled", admin_throttled))
+    application.add_handler(CommandHandler("unthrottle", admin_unthrottle))
+    application.add_handler(CommandHandler("search", admin_search))
+    application.add_handler(CommandHandler("export", admin_export))
     application.add_handler(CommandHandler("adminhelp", admin_help))
 
-    # Обработчики сообщений - ТЕКСТ
+    # Обработчик сообщений пользователей - любые типы (текст, фото, голосовые, стикеры...)
     application.add_handler(MessageHandler(
-        filters.TEXT & filters.ChatType.PRIVATE & ~filters.COMMAND,
+        filters.UpdateType.MESSAGE & filters.ChatType.PRIVATE & ~filters.COMMAND & ~filters.StatusUpdate.ALL,
         handle_private_message
     ))
 
-    # Обработчик медиа-файлов
+    # Обработчик правок сообщений пользователей
     application.add_handler(MessageHandler(
-        (filters.PHOTO | filters.Document.ALL) & filters.ChatType.PRIVATE,
-        handle_private_message
+        filters.UpdateType.EDITED_MESSAGE & filters.ChatType.PRIVATE & ~filters.COMMAND,
+        handle_edited_message
     ))
 
-    # Обработчик ответов в группе
+    # Обработчик ответов в группе - тоже любые типы
     application.add_handler(MessageHandler(
-        filters.TEXT & filters.ChatType.GROUPS & filters.REPLY,
+        filters.UpdateType.MESSAGE & filters.ChatType.GROUPS & filters.REPLY
+        & ~filters.COMMAND & ~filters.StatusUpdate.ALL,
         handle_group_reply
     ))
 
     # Обработчик кнопок
     application.add_handler(CallbackQueryHandler(button_callback))
 
-    print("🤖 Бот запускается...")
-    print("=" * 50)
-    print("📋 ИНСТРУКЦИЯ ПО НАСТРОЙКЕ:")
-    print("1. Добавьте бота в группу (где будут работать вы и ваши друзья)")
-    print("2. Назначьте бота администратором группы")
-    print("3. Превратите группу в Супергруппу")
-    print("4. Включите 'Темы' в настройках группы")
-    print("5. В группе выполните команду /setgroup")
-    print("6. Теперь пользователи могут писать боту в личку")
-    print("=" * 50)
-
-    # Загружаем сохраненный ID группы
-    db = Database()
-    group_id = db.get_group_id()
-    if group_id:
-        global ADMIN_GROUP_ID
-        ADMIN_GROUP_ID = group_id
-        print(f"✅ Загружен ID админской группы: {group_id}")
+    # Изменения состава админов групп - в кэш админов
+    application.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.ANY_CHAT_MEMBER))
+
+    # Все группы, откуда приходят обновления, - в реестр чатов (после основных обработчиков)
+    application.add_handler(TypeHandler(Update, record_chat), group=1)
+
+    # Время и результат каждого обработчика - в метрики
+    instrument_handlers(application)
+    return application
+
+
+SETUP_GUIDE = """==================================================
+📋 ИНСТРУКЦИЯ ПО НАСТРОЙКЕ:
+1. Добавьте бота в группу (где будут работать вы и ваши друзья)
+2. Назначьте бота администратором группы
+3. Превратите группу в Супергруппу
+4. Включите 'Темы' в настройках группы
+5. В группе выполните команду /setgroup
+6. Теперь пользователи могут писать боту в личку
+=================================================="""
+
+
+def main():
+    """Основная функция запуска бота"""
+
+    # Читаем токен из файла
+    try:
+        with open(API_TOKEN_FILE, 'r') as f:
+            TOKEN = f.read().strip()
+    except FileNotFoundError:
+        logger.error(f"Token file '{API_TOKEN_FILE}' not found: create it and put the bot token there")
+        return
+
+    if not TOKEN:
+        logger.error(f"Token file '{API_TOKEN_FILE}' is empty")
+        return
+
+    logger.info("Token loaded, starting the bot")
+    # Инструкция - человеку у терминала; под systemd или в контейнере она только в логе
+    if CONSOLE_SETUP_GUIDE and sys.stdout.isatty():
+        print(SETUP_GUIDE)
+    else:
+        logger.info("Setup: add the bot to a supergroup as an admin, enable topics and run /setgroup there")
 
     # Запускаем бота
     try:
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if WEBHOOK_URL:
+            secret_token = WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32)
+            logger.info(f"Webhook mode: {WEBHOOK_URL}, workers: {WEBHOOK_WORKERS}")
+            run_webhook(
+                functools.partial(build_application, TOKEN, shared_storage=WEBHOOK_WORKERS > 1,
+                                  workers=WEBHOOK_WORKERS),
+                TOKEN,
+                secret_token,
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url=WEBHOOK_URL,
+                workers=WEBHOOK_WORKERS,
+                queue_size=WEBHOOK_QUEUE_SIZE,
+                # Ответы в теме - в процесс ее пользователя (при нескольких процессах база - SQLite)
+                topic_owner=TopicOwners(SQLITE_DATABASE_FILE) if WEBHOOK_WORKERS > 1 else None
+            )
+        else:
+            application = build_application(TOKEN)
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
     except KeyboardInterrupt:
-        print("\n👋 Бот остановлен")
-    except Exception as e:
-        print(f"❌ Ошибка при запуске бота: {e}")
+        logger.info("Bot stopped")
+    except Exception:
+        logger.exception("Bot stopped with an error")
 
 
 if __name__ == '__main__':
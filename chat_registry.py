@@ -0,0 +1,114 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from telegram import Chat
+
+logger = logging.getLogger(__name__)
+
+# Чаты, которые записываются в реестр (личные чаты пользователей не нужны)
+REGISTERED_TYPES = {Chat.GROUP, Chat.SUPERGROUP, Chat.CHANNEL}
+
+
+class ChatRegistry:
+    """Реестр групп и каналов, из которых бот получал обновления.
+
+    Бот отмечает каждый такой чат (название, тип, время последнего
+    обновления, состоит ли в нем бот), а реестр раз в flush_interval
+    секунд целиком перезаписывает JSON-файл через временный файл, поэтому
+    script_bot_groups_search.py может читать его в любой момент, не
+    мешая работающему боту.
+    """
+
+    def __init__(self, filename: str, flush_interval: float = 60.0):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self._chats: Dict[int, Dict[str, Any]] = {}
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+
+    def open(self):
+        self._chats = {chat['id']: chat for chat in load_registry(self.filename)}
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def record(self, chat: Chat, member: Optional[bool] = None):
+        """Отметить обновление из чата; member - бота добавили (True) или убрали (False)"""
+        if chat.type not in REGISTERED_TYPES:
+            return
+        entry = self._chats.get(chat.id)
+        if entry is None:
+            entry = self._chats[chat.id] = {'id': chat.id, 'member': True}
+        entry.update(title=chat.title, type=chat.type, username=chat.username, seen_at=time.time())
+        if member is not None:
+            entry['member'] = member
+        self._dirty = True
+
+    async def flush(self):
+        """Записать реестр на диск, если он изменился"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        data = json.dumps(list(self._chats.values()), ensure_ascii=False, indent=1)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, data)
+        except Exception:
+            self._dirty = True
+            raise
+
+    def _write(self, data: str):
+        tmp_file = f'{self.filename}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_file, self.filename)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error writing chat registry: {e}")
+
+
+def load_registry(filename: str) -> List[Dict[str, Any]]:
+    """Прочитать файл реестра (пустой список, если его еще нет)"""
+    try:
+        with open(filename, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+    except ValueError as e:
+        logger.warning(f"Chat registry {filename} is damaged, starting a new one: {e}")
+        return []
+
+
+def worker_filename(filename: str, worker: int) -> str:
+    """Свой файл реестра у каждого процесса вебхука: chats.json, chats.1.json, ..."""
+    if worker == 0:
+        return filename
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}.{worker}{ext}'
+
+
+def find_registry_files(filename: str) -> List[str]:
+    """Файлы реестра всех процессов"""
+    stem, ext = os.path.splitext(filename)
+    directory = os.path.dirname(filename) or '.'
+    prefix = os.path.basename(stem) + '.'
+    files = [filename] if os.path.exists(filename) else []
+    for name in sorted(os.listdir(directory)):
+        if name.startswith(prefix) and name.endswith(ext):
+            worker = name[len(prefix):len(name) - len(ext)]
+            if worker.isdigit():
+                files.append(os.path.join(directory, name))
+    return files
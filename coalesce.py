@@ -0,0 +1,67 @@
+from typing import List, NamedTuple, Sequence, Tuple
+
+from telegram import MessageEntity
+
+
+class MergedText(NamedTuple):
+    """Одно сообщение в теме из склеенных текстов пользователя"""
+    text: str
+    entities: List[MessageEntity]
+    parts: List[int]  # Номера склеенных текстов (длинный текст может попасть в несколько сообщений)
+
+
+def utf16_len(text: str) -> int:
+    """Длина в единицах UTF-16: в них Telegram считает длину текста и смещения entities"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _entity(entity: MessageEntity, offset: int, length: int) -> MessageEntity:
+    return MessageEntity.de_json({**entity.to_dict(), 'offset': offset, 'length': length}, None)
+
+
+def _split(text: str, entities: List[MessageEntity],
+           at: int) -> Tuple[str, List[MessageEntity], str, List[MessageEntity]]:
+    """Разрезать текст на позиции at (UTF-16), не разрывая суррогатную пару"""
+    data = text.encode('utf-16-le')
+    # Старшая половина суррогатной пары остается со своей младшей
+    if 0xD800 <= int.from_bytes(data[2 * at - 2:2 * at], 'little') <= 0xDBFF:
+        at -= 1
+    head, tail = data[:2 * at].decode('utf-16-le'), data[2 * at:].decode('utf-16-le')
+    head_entities, tail_entities = [], []
+    for entity in entities:
+        end = entity.offset + entity.length
+        if entity.offset < at:
+            head_entities.append(_entity(entity, entity.offset, min(end, at) - entity.offset))
+        if end > at:
+            start = max(entity.offset, at)
+            tail_entities.append(_entity(entity, start - at, end - start))
+    return head, head_entities, tail, tail_entities
+
+
+def merge_texts(texts: Sequence[Tuple[str, Sequence[MessageEntity]]], limit: int = 4096) -> List[MergedText]:
+    """
+    Склеить тексты подряд (с форматированием) через перевод строки в сообщения
+    не длиннее limit. Смещения entities каждого текста сдвигаются на его место
+    в склеенном сообщении; текст длиннее limit режется на части.
+    """
+    merged = []
+    text, entities, parts, length = '', [], [], 0
+    for index, (part, part_entities) in enumerate(texts):
+        part_length = utf16_len(part)
+        if parts and length + 1 + part_length > limit:
+            merged.append(MergedText(text, entities, parts))
+            text, entities, parts, length = '', [], [], 0
+        if parts:
+            text += '\n'
+            length += 1
+        entities.extend(_entity(entity, length + entity.offset, entity.length) for entity in part_entities)
+        text += part
+        length += part_length
+        parts.append(index)
+        while length > limit:
+            head, head_entities, text, entities = _split(text, entities, limit)
+            merged.append(MergedText(head, head_entities, parts))
+            parts = [index]
+            length = utf16_len(text)
+    merged.append(MergedText(text, entities, parts))
+    return merged
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.constants import ChatType
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+def conversation_key(update: object) -> Optional[Hashable]:
+    """
+    Ключ "разговора", внутри которого обновления обрабатываются строго по порядку.
+    Личка - по пользователю, группа - по теме (или чату без тем).
+    None - обновление не привязано к разговору и может идти параллельно со всеми.
+    """
+    if not isinstance(update, Update):
+        return None
+
+    if update.callback_query:
+        return ('user', update.callback_query.from_user.id)
+
+    message = update.effective_message
+    chat = update.effective_chat
+    if chat is None:
+        user = update.effective_user
+        return ('user', user.id) if user else None
+
+    if chat.type == ChatType.PRIVATE:
+        return ('user', chat.id)
+    if message is not None and message.is_topic_message:
+        return ('topic', chat.id, message.message_thread_id)
+    return ('chat', chat.id)
+
+
+class ConversationUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка внутри разговора.
+
+    Обновления разных пользователей и тем обрабатываются одновременно,
+    а обновления одного разговора ждут друг друга на своем замке. Замки
+    asyncio честные (FIFO), а задачи на обновления создаются в порядке
+    получения, поэтому порядок внутри разговора совпадает с порядком Telegram.
+    Замок удаляется, как только его никто не держит и не ждет.
+
+    Место из max_concurrent_updates обновление занимает только после своего
+    замка: иначе поток сообщений одного пользователя занял бы все места,
+    ожидая сам себя, и остальные разговоры встали бы.
+    """
+
+    def __init__(self, max_concurrent_updates: int = 256):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._users: Dict[Hashable, int] = {}
+
+    @property
+    def active_conversations(self) -> int:
+        """Сколько разговоров сейчас обрабатывается или ждет очереди"""
+        return len(self._locks)
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]):
+        key = conversation_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        await coroutine
+
+    async def initialize(self):
+        """Ничего не нужно: замки создаются по мере надобности"""
+
+    async def shutdown(self):
+        """Ничего не нужно: замки освобождаются вместе с задачами обновлений"""
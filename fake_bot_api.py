@@ -0,0 +1,268 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+from http_server import Request, Response, serve_http
+
+FAKE_TOKEN = '123456:FAKE-TOKEN'
+FAKE_BOT_ID = 123456
+
+
+def _int(value: Any) -> Optional[int]:
+    return int(value) if value not in (None, '') else None
+
+
+def _json(value: Any) -> Any:
+    """Вложенные параметры PTB передает строкой JSON"""
+    return json.loads(value) if isinstance(value, str) else value
+
+
+class FakeBotAPI:
+    """Локальная замена Telegram Bot API для тестов и нагрузочных замеров.
+
+    Понимает запросы PTB (form-urlencoded и JSON), отдает обновления через
+    getUpdates, создает "темы" и "сообщения" со сквозной нумерацией и
+    считает все вызовы по методам. latency добавляет задержку к каждому
+    вызову, а flood_rate - долю отправок, на которые приходит 429 с
+    retry_after секунд (как при превышении лимитов Telegram).
+    """
+
+    # Методы, которые Telegram ограничивает по частоте
+    FLOOD_METHODS = {'sendMessage', 'sendPhoto', 'sendDocument', 'sendMediaGroup', 'copyMessage',
+                     'copyMessages', 'createForumTopic', 'editMessageText', 'editMessageCaption',
+                     'setMessageReaction'}
+
+    def __init__(self, token: str = FAKE_TOKEN, latency: float = 0.0,
+                 flood_rate: float = 0.0, retry_after: int = 1, seed: Optional[int] = None):
+        self.token = token
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.flood_errors = 0  # Сколько раз ответили 429
+        self.copied = 0  # Сколько сообщений скопировано (copyMessage и copyMessages)
+        self.requests: List[Dict[str, Any]] = []
+
+        self._updates: List[Dict[str, Any]] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._topic_ids: Dict[int, itertools.count] = {}  # Темы нумеруются в каждой группе отдельно
+        self._changed = asyncio.Condition()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.port: Optional[int] = None
+
+    # ----- запуск -----
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        self._server = await serve_http(self.handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    @property
+    def base_url(self) -> str:
+        """base_url для Application.builder() (PTB сам добавит токен)"""
+        return f'http://127.0.0.1:{self.port}/bot'
+
+    # ----- обновления -----
+    def put_update(self, data: Dict[str, Any]) -> int:
+        """Поставить обновление в очередь getUpdates; возвращает update_id"""
+        data = dict(data, update_id=next(self._update_ids))
+        self._updates.append(data)
+        asyncio.ensure_future(self._notify())
+        return data['update_id']
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def wait_until(self, predicate: Callable[[], bool], timeout: float = 60):
+        """Дождаться выполнения условия (проверяется после каждого вызова API)"""
+        async def wait():
+            async with self._changed:
+                await self._changed.wait_for(predicate)
+        await asyncio.wait_for(wait(), timeout)
+
+    async def wait_calls(self, method: str, count: int, timeout: float = 60):
+        """Дождаться, пока метод будет вызван count раз"""
+        await self.wait_until(lambda: self.calls[method] >= count, timeout)
+
+    # ----- HTTP -----
+    async def handle(self, request: Request) -> Response:
+        prefix = f'/bot{self.token}/'
+        if not request.path.startswith(prefix):
+            return Response.json({'ok': False, 'error_code': 404, 'description': 'Not Found'}, 404)
+        method = request.path[len(prefix):]
+        params = request.params()
+
+        if self.latency and method != 'getUpdates':
+            await asyncio.sleep(self.latency)
+
+        handler = getattr(self, f'api_{method}', None)
+        if handler is None:
+            return Response.json({'ok': False, 'error_code': 404,
+                                  'description': 'Not Found: method not found'}, 404)
+
+        if method in self.FLOOD_METHODS and self._random.random() < self.flood_rate:
+            self.flood_errors += 1
+            return Response.json({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, 429)
+
+        self.calls[method] += 1
+        self.requests.append({'method': method, 'params': params, 'time': time.monotonic()})
+        result = await handler(params)
+        await self._notify()
+        return Response.json({'ok': True, 'result': result})
+
+    # ----- ответы методов -----
+    def _message(self, params: Dict[str, Any], **fields) -> Dict[str, Any]:
+        chat_id = _int(params.get('chat_id'))
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'},
+            'from': {'id': FAKE_BOT_ID, 'is_bot': True, 'first_name': 'FakeBot'},
+        }
+        thread_id = _int(params.get('message_thread_id'))
+        if thread_id:
+            message['message_thread_id'] = thread_id
+            message['is_topic_message'] = True
+        message.update(fields)
+        return message
+
+    async def api_getMe(self, params):
+        return {'id': FAKE_BOT_ID, 'is_bot': True, 'first_name': 'FakeBot',
+                'username': 'fake_bot', 'can_join_groups': True,
+                'can_read_all_group_messages': True, 'supports_inline_queries': False}
+
+    async def api_getUpdates(self, params):
+        offset = _int(params.get('offset')) or 0
+        limit = _int(params.get('limit')) or 100
+        timeout = float(params.get('timeout') or 0)
+        if offset:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not self._updates and timeout:
+            try:
+                async with self._changed:
+                    await asyncio.wait_for(self._changed.wait_for(lambda: self._updates), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    async def api_setWebhook(self, params):
+        return True
+
+    async def api_deleteWebhook(self, params):
+        return True
+
+    async def api_createForumTopic(self, params):
+        topic_ids = self._topic_ids.setdefault(_int(params.get('chat_id')), itertools.count(1000))
+        return {'message_thread_id': next(topic_ids), 'name': params.get('name', ''),
+                'icon_color': 7322096}
+
+    async def api_editForumTopic(self, params):
+        return True
+
+    async def api_closeForumTopic(self, params):
+        return True
+
+    async def api_reopenForumTopic(self, params):
+        return True
+
+    async def api_getChat(self, params):
+        chat_id = _int(params.get('chat_id'))
+        return {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private',
+                'title': f'Group {chat_id}', 'accent_color_id': 0, 'max_reaction_count': 11,
+                'accepted_gift_types': {'unlimited_gifts': False, 'limited_gifts': False,
+                                        'unique_gifts': False, 'premium_subscription': False,
+                                        'gifts_from_channels': False}}
+
+    async def api_getChatAdministrators(self, params):
+        return [{'status': 'creator', 'is_anonymous': False,
+                 'user': {'id': 1, 'is_bot': False, 'first_name': 'Admin'}}]
+
+    async def api_sendMessage(self, params):
+        return self._message(params, text=params.get('text', ''))
+
+    async def api_sendPhoto(self, params):
+        return self._message(params, photo=[{'file_id': params.get('photo'), 'file_unique_id': 'p',
+                                             'width': 1, 'height': 1}])
+
+    async def api_sendDocument(self, params):
+        document = params.get('document')
+        if isinstance(document, bytes):
+            # Загруженный файл (multipart) - в ответе только его размер
+            document = f'uploaded-{len(document)}'
+        return self._message(params, document={'file_id': document, 'file_unique_id': 'd'})
+
+    async def api_editMessageText(self, params):
+        return self._message(params, text=params.get('text', ''))
+
+    async def api_editMessageCaption(self, params):
+        return self._message(params, caption=params.get('caption', ''))
+
+    async def api_answerCallbackQuery(self, params):
+        return True
+
+    async def api_setMessageReaction(self, params):
+        return True
+
+    async def api_copyMessage(self, params):
+        self.copied += 1
+        return {'message_id': next(self._message_ids)}
+
+    async def api_copyMessages(self, params):
+        message_ids = _json(params.get('message_ids'))
+        self.copied += len(message_ids)
+        return [{'message_id': next(self._message_ids)} for _ in message_ids]
+
+
+# ========== СИНТЕТИЧЕСКИЕ ОБНОВЛЕНИЯ ==========
+_message_ids = itertools.count(1)
+
+
+def private_message(user_id: int, text: Optional[str] = None, **fields) -> Dict[str, Any]:
+    """Сообщение пользователя боту в личку"""
+    message = {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+    }
+    if text is not None:
+        message['text'] = text
+    message.update(fields)
+    return {'message': message}
+
+
+def group_reply(chat_id: int, topic_id: int, admin_id: int, text: str,
+                reply_to_message_id: int) -> Dict[str, Any]:
+    """Ответ админа в теме на сообщение бота"""
+    return {'message': {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'Support', 'is_forum': True},
+        'from': {'id': admin_id, 'is_bot': False, 'first_name': 'Admin'},
+        'message_thread_id': topic_id,
+        'is_topic_message': True,
+        'text': text,
+        'reply_to_message': {
+            'message_id': reply_to_message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'Support', 'is_forum': True},
+            'from': {'id': FAKE_BOT_ID, 'is_bot': True, 'first_name': 'FakeBot'},
+            'message_thread_id': topic_id,
+            'is_topic_message': True,
+            'text': '👤 Пользователь: ...',
+        },
+    }}
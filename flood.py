@@ -0,0 +1,128 @@
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+
+class FloodDecision(NamedTuple):
+    """Решение по очередному сообщению пользователя"""
+    allowed: bool
+    muted_for: float = 0.0  # Пользователя только что заглушили на столько секунд (иначе 0)
+
+
+class Throttled(NamedTuple):
+    """Пользователь, которого ограничивали"""
+    user_id: int
+    muted_for: float  # Сколько еще секунд заглушен (0 - уже нет)
+    strikes: int  # Сколько раз его глушили
+    dropped: int  # Сколько сообщений отброшено
+
+
+class _UserState:
+    __slots__ = ('tokens', 'updated_at', 'muted_until', 'strikes', 'dropped')
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated_at = now
+        self.muted_until = 0.0
+        self.strikes = 0
+        self.dropped = 0
+
+
+class FloodControl:
+    """Ограничение частоты сообщений каждого пользователя.
+
+    У каждого пользователя - ведро на burst сообщений, которое
+    наполняется со скоростью rate сообщений в секунду. Сообщение
+    сверх ведра глушит пользователя на mute секунд, каждое следующее
+    заглушение - вдвое дольше (не больше max_mute), и все его
+    сообщения до конца заглушения отбрасываются. Состояние - несколько
+    чисел на пользователя в порядке последней активности; пользователи,
+    не писавшие дольше forget секунд, забываются вместе с заглушениями
+    (а значит, следующее заглушение снова начнется с mute).
+    """
+
+    def __init__(self, rate: float, burst: int, mute: float = 60.0, max_mute: float = 3600.0,
+                 forget: float = 3600.0):
+        self.rate = rate
+        self.burst = burst
+        self.mute = mute
+        self.max_mute = max_mute
+        # Пока пользователь заглушен, он не забывается
+        self.forget = max(forget, max_mute)
+        self._users: 'OrderedDict[int, _UserState]' = OrderedDict()
+
+    def __len__(self):
+        return len(self._users)
+
+    def check(self, user_id: int, now: Optional[float] = None) -> FloodDecision:
+        """Учесть сообщение пользователя и решить, пропускать ли его"""
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserState(self.burst, now)
+        else:
+            self._users.move_to_end(user_id)
+        state.tokens = min(self.burst, state.tokens + (now - state.updated_at) * self.rate)
+        state.updated_at = now
+
+        if now < state.muted_until:
+            state.dropped += 1
+            return FloodDecision(False)
+        if state.tokens >= 1:
+            state.tokens -= 1
+            return FloodDecision(True)
+
+        # Ведро пусто - глушим, каждый раз вдвое дольше
+        muted_for = min(self.mute * 2 ** state.strikes, self.max_mute)
+        state.strikes += 1
+        state.dropped += 1
+        state.muted_until = now + muted_for
+        return FloodDecision(False, muted_for)
+
+    def _evict(self, now: float):
+        # Самые давние - в начале; за вызов удаляется столько, сколько устарело
+        while self._users:
+            user_id, state = next(iter(self._users.items()))
+            if now - state.updated_at < self.forget:
+                break
+            del self._users[user_id]
+
+    def throttled(self, now: Optional[float] = None) -> List[Throttled]:
+        """Пользователи, которых глушили, - сначала заглушенные дольше всех"""
+        now = time.monotonic() if now is None else now
+        users = [Throttled(user_id, max(0.0, state.muted_until - now), state.strikes, state.dropped)
+                 for user_id, state in self._users.items() if state.strikes]
+        return sorted(users, key=lambda user: (-user.muted_for, -user.strikes))
+
+    def snapshot(self) -> List[Tuple[int, float, float, float, int, int]]:
+        """
+        Состояние для снимка в порядке активности: (пользователь, токены,
+        сколько секунд назад писал, сколько еще заглушен, заглушений, отброшено)
+        """
+        now = time.monotonic()
+        return [(user_id, state.tokens, now - state.updated_at, max(0.0, state.muted_until - now),
+                 state.strikes, state.dropped)
+                for user_id, state in self._users.items()]
+
+    def restore(self, users: List[Tuple[int, float, float, float, int, int]], elapsed: float):
+        """Восстановить состояние из снимка, сделанного elapsed секунд назад"""
+        now = time.monotonic()
+        for user_id, tokens, age, muted_for, strikes, dropped in users:
+            state = _UserState(tokens, now - age - elapsed)
+            state.muted_until = now + muted_for - elapsed
+            state.strikes = strikes
+            state.dropped = dropped
+            self._users[user_id] = state
+        # Пока бот был остановлен, часть пользователей устарела
+        self._evict(now)
+
+    def release(self, user_id: Optional[int] = None) -> int:
+        """Снять ограничения с пользователя (без user_id - со всех); возвращает, со скольких сняты"""
+        if user_id is None:
+            released = sum(1 for state in self._users.values() if state.strikes)
+            self._users.clear()
+            return released
+        state = self._users.pop(user_id, None)
+        return 1 if state is not None and state.strikes else 0
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 10 * 1024 * 1024  # Максимальный размер тела запроса (байт)
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+               405: 'Method Not Allowed', 413: 'Payload Too Large', 429: 'Too Many Requests',
+               500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class Request:
+    """Входящий HTTP-запрос"""
+
+    def __init__(self, method: str, target: str, headers: Dict[str, str], body: bytes):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = dict(parse_qsl(url.query))
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> Any:
+        return json.loads(self.body or b'{}')
+
+    def params(self) -> Dict[str, Any]:
+        """Параметры из query string и тела (JSON или form-urlencoded)"""
+        params: Dict[str, Any] = dict(self.query)
+        content_type = self.headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            params.update(self.json())
+        elif content_type.startswith('application/x-www-form-urlencoded'):
+            params.update(parse_qsl(self.body.decode()))
+        elif content_type.startswith('multipart/form-data'):
+            params.update(self._multipart(content_type))
+        return params
+
+    def _multipart(self, content_type: str) -> Dict[str, Any]:
+        """Поля multipart/form-data: текстовые - строками, файлы - байтами"""
+        boundary = content_type.partition('boundary=')[2].strip('"')
+        fields: Dict[str, Any] = {}
+        for part in self.body.split(b'--' + boundary.encode('latin-1'))[1:-1]:
+            # Часть обрамлена переводами строки после разделителя и перед следующим
+            head, _, value = part[2:-2].partition(b'\r\n\r\n')
+            disposition = next((line for line in head.decode('latin-1').split('\r\n')
+                                if line.lower().startswith('content-disposition')), '')
+            name = disposition.partition('name="')[2].partition('"')[0]
+            fields[name] = value if 'filename=' in disposition else value.decode()
+        return fields
+
+
+class Response:
+    """Ответ HTTP-сервера"""
+
+    def __init__(self, status: int = 200, body: bytes = b'',
+                 content_type: str = 'text/plain; charset=utf-8',
+                 headers: Optional[Dict[str, str]] = None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    @classmethod
+    def json(cls, data: Any, status: int = 200) -> 'Response':
+        return cls(status, json.dumps(data).encode(), 'application/json')
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Request]:
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode('latin-1').split(' ', 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = await _read_chunked(reader)
+    else:
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY_SIZE:
+            raise ValueError(f"Request body too large: {length}")
+        body = await reader.readexactly(length) if length else b''
+    return Request(method, target, headers, body)
+
+
+async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+    """Тело с Transfer-Encoding: chunked (так клиент шлет файл, длина которого заранее неизвестна)"""
+    chunks, size = [], 0
+    while True:
+        length = int((await reader.readline()).split(b';', 1)[0], 16)
+        if not length:
+            break
+        size += length
+        if size > MAX_BODY_SIZE:
+            raise ValueError(f"Request body too large: {size}")
+        chunks.append(await reader.readexactly(length))
+        await reader.readline()
+    # Заголовки после тела не нужны - дочитываем до пустой строки
+    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+    return b''.join(chunks)
+
+
+def _write_response(writer: asyncio.StreamWriter, response: Response, keep_alive: bool):
+    head = [f"HTTP/1.1 {response.status} {STATUS_TEXT.get(response.status, 'Unknown')}",
+            f"Content-Type: {response.content_type}",
+            f"Content-Length: {len(response.body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    head += [f"{name}: {value}" for name, value in response.headers.items()]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + response.body)
+
+
+async def serve_http(handler: Handler, host: str, port: int) -> asyncio.AbstractServer:
+    """
+    Запустить HTTP/1.1 сервер с keep-alive на asyncio.
+    Подходит для вебхука, метрик и тестового Bot API; TLS ожидается на прокси перед ботом.
+    """
+    async def on_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                try:
+                    response = await handler(request)
+                except Exception as e:
+                    logger.error(f"Error handling {request.method} {request.path}: {e}")
+                    response = Response(500)
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                _write_response(writer, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Сервер останавливается - просто закрываем соединение
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_client, host, port)
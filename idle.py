@@ -0,0 +1,101 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class IdleScheduler:
+    """Срабатывание по неактивности для большого числа ключей (тем).
+
+    Актуальный срок ключа хранится в словаре, а в куче лежат записи
+    (срок, ключ) не позже него. Продление срока только обновляет словарь -
+    O(1) на каждое сообщение; когда запись всплывает наверх кучи, а срок
+    успел сдвинуться, она перекладывается с новым сроком. Более ранний срок
+    (touch() со старым last_activity) добавляет в кучу новую запись, а
+    старая становится лишней, как и записи забытых ключей. Лишние записи
+    отбрасываются, когда всплывают, а если их становится больше, чем
+    ключей, куча пересобирается - память остается O(число ключей).
+    Фоновая задача просыпается только к ближайшему сроку.
+    on_idle(key) вызывается по очереди для каждого истекшего ключа.
+    """
+
+    def __init__(self, timeout: float, on_idle: Callable[[Hashable], Awaitable[None]]):
+        self.timeout = timeout
+        self._on_idle = on_idle
+        self._heap: List[Tuple[float, Hashable]] = []
+        self._deadlines: Dict[Hashable, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def touch(self, key: Hashable, last_activity: Optional[float] = None):
+        """Отметить активность ключа (по умолчанию - сейчас)"""
+        deadline = (last_activity if last_activity is not None else time.time()) + self.timeout
+        current = self._deadlines.get(key)
+        self._deadlines[key] = deadline
+        if current is not None and deadline >= current:
+            return
+        heapq.heappush(self._heap, (deadline, key))
+        # Новый срок может оказаться ближайшим (например, при загрузке старых тем)
+        if self._heap[0] == (deadline, key):
+            self._wakeup.set()
+        self._compact()
+
+    def forget(self, key: Hashable):
+        """Перестать следить за ключом (запись в куче отбросится, когда всплывет)"""
+        if self._deadlines.pop(key, None) is not None:
+            self._compact()
+
+    def _compact(self):
+        """Пересобрать кучу, если лишних записей в ней больше, чем ключей"""
+        if len(self._heap) - len(self._deadlines) > len(self._deadlines):
+            self._heap = [(deadline, key) for key, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            deadline, key = self._heap[0]
+            delay = deadline - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                    self._wakeup.clear()
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            current = self._deadlines.get(key)
+            if current is None or current < deadline:
+                # Ключ забыт или для него есть запись с более ранним сроком
+                continue
+            if current > deadline:
+                # Была активность - ждем заново до нового срока
+                heapq.heappush(self._heap, (current, key))
+                self._compact()
+                continue
+
+            del self._deadlines[key]
+            try:
+                await self._on_idle(key)
+            except Exception as e:
+                logger.error(f"Error handling idle {key}: {e}")
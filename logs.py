@@ -0,0 +1,152 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import zlib
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+# Поля, которые попадают в каждую запись лога, пока выполняется текущая задача
+_context: ContextVar[Dict[str, Any]] = ContextVar('log_context', default={})
+# Поля всего процесса (например, номер процесса вебхука)
+_process_fields: Dict[str, Any] = {}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def start_trace(trace_id: str, **fields):
+    """Начать контекст лога для нового обновления (поля предыдущего не наследуются)"""
+    _context.set({'trace_id': trace_id, **{k: v for k, v in fields.items() if v is not None}})
+
+
+def bind(**fields):
+    """Добавить поля в контекст лога текущей задачи (и задач, которые она создаст дальше)"""
+    _context.set({**_context.get(), **fields})
+
+
+def set_process_fields(**fields):
+    """Поля, общие для всех записей процесса"""
+    _process_fields.update(fields)
+
+
+def log_context() -> Dict[str, Any]:
+    return {**_process_fields, **_context.get()}
+
+
+class ContextFilter(logging.Filter):
+    """Сохраняет контекст в записи до того, как она уйдет в очередь (в потоке, который пишет лог)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.context = log_context()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только долю rates[имя логгера] записей ниже WARNING (предупреждения
+    и ошибки - всегда). Решение зависит от trace_id, поэтому у одного обновления
+    сохраняются либо все записи логгера, либо ни одной.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def _rate(self, name: str) -> Optional[float]:
+        # Настройка для 'httpx' действует и на 'httpx.client'
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate is None or rate >= 1:
+            return True
+        trace_id = getattr(record, 'context', {}).get('trace_id')
+        if trace_id is not None:
+            return zlib.crc32(trace_id.encode()) % 10000 < rate * 10000
+        return random.random() < rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Сообщение и трассировку - в строки сразу (аргументы могут измениться,
+        # пока запись в очереди), трассировка остается отдельным полем
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога - одна строка JSON с полями контекста"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **getattr(record, 'context', {})
+        }
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Обычный текстовый формат, поля контекста - в конце строки"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        context = getattr(record, 'context', None)
+        if context:
+            fields = ' '.join(f'{key}={value}' for key, value in context.items())
+            first_line, newline, rest = text.partition('\n')
+            text = f'{first_line} [{fields}]{newline}{rest}'
+        return text
+
+
+def setup_logging(level: int = logging.INFO, json_format: bool = False,
+                  sample_rates: Optional[Dict[str, float]] = None,
+                  stream=None) -> logging.handlers.QueueListener:
+    """
+    Настроить логирование без записи в поток событий: обработчики только кладут
+    запись в очередь, а форматирует и пишет ее (в stderr) отдельный поток.
+    """
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(ContextFilter())
+    if sample_rates:
+        handler.addFilter(SamplingFilter(sample_rates))
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if json_format else TextFormatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop_listener, listener)
+    return listener
+
+
+def _stop_listener(listener: logging.handlers.QueueListener):
+    """Дописать очередь перед выходом из процесса (если ее не остановили раньше)"""
+    if listener._thread is not None:
+        listener.stop()
@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from storage import SQLitePool
+
+logger = logging.getLogger(__name__)
+
+MessageRef = Tuple[int, int]  # (ID чата, ID сообщения)
+
+
+def _pack(chat_id: int, message_id: int) -> int:
+    """Пара (чат, сообщение) одним int: ID сообщений в чате меньше 2**32"""
+    return (chat_id << 32) | message_id
+
+
+def _unpack(key: int) -> MessageRef:
+    return key >> 32, key & 0xFFFFFFFF
+
+
+class MessageIndex:
+    """Двусторонний индекс ID сообщений: личный чат пользователя <-> админская группа.
+
+    Каждая связь - пара сообщений: в личке (оригинал пользователя или копия
+    ответа админа) и в группе (копия в теме или оригинал ответа). В памяти
+    держится не больше capacity последних связей (LRU), каждая - два int
+    в двух словарях, поиск в обе стороны за O(1). Новые связи пишутся в
+    SQLite пачкой раз в flush_interval секунд, промахи кэша дочитываются
+    с диска, а связи старше retention секунд периодически удаляются.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            user_id INTEGER NOT NULL,
+            private_message_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            group_message_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (user_id, private_message_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS messages_group ON messages (chat_id, group_message_id);
+        CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at);
+    """
+
+    def __init__(self, filename: str, capacity: int = 100_000, retention: float = 30 * 86400,
+                 flush_interval: float = 1.0, compact_interval: float = 3600, shared: bool = False):
+        self.filename = filename
+        self.capacity = capacity
+        self.retention = retention
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self.shared = shared
+        self.pool = SQLitePool(filename, size=2)
+
+        # private -> group в порядке использования и обратный словарь
+        self._to_group: 'OrderedDict[int, int]' = OrderedDict()
+        self._to_private: Dict[int, int] = {}
+        # Еще не записанные на диск связи: (private, group, время)
+        self._pending: List[Tuple[int, int, float]] = []
+        self._flush_lock = asyncio.Lock()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def cached(self) -> int:
+        """Сколько связей в памяти"""
+        return len(self._to_group)
+
+    async def open(self):
+        self.pool.open()
+        await self.pool.run(self._create)
+        self._tasks = [asyncio.create_task(self._flush_loop()),
+                       asyncio.create_task(self._compact_loop())]
+
+    def _create(self, conn: sqlite3.Connection):
+        # Освобождать место после удаления старых связей (действует только для нового файла)
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.executescript(self.SCHEMA)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+        self.pool.close()
+
+    # ----- кэш -----
+    def _remember(self, private: int, group: int):
+        old_group = self._to_group.pop(private, None)
+        if old_group is not None:
+            self._to_private.pop(old_group, None)
+        self._to_group[private] = group
+        self._to_private[group] = private
+        while len(self._to_group) > self.capacity:
+            _, evicted = self._to_group.popitem(last=False)
+            self._to_private.pop(evicted, None)
+
+    # ----- связи -----
+    async def add(self, user_id: int, private_message_id: int, chat_id: int, group_message_id: int):
+        """Запомнить, что сообщение в личке пользователя соответствует сообщению в группе"""
+        private, group = _pack(user_id, private_message_id), _pack(chat_id, group_message_id)
+        self._remember(private, group)
+        self._pending.append((private, group, time.time()))
+        # Другие процессы вебхука видят связь только на диске - пишем сразу
+        if self.shared:
+            await self.flush()
+
+    async def get_group_message(self, user_id: int, message_id: int) -> Optional[MessageRef]:
+        """Сообщение в группе, связанное с сообщением в личке пользователя"""
+        private = _pack(user_id, message_id)
+        group = self._to_group.get(private)
+        if group is None:
+            # Связь могла вытесниться из памяти раньше записи на диск
+            await self.flush()
+            row = await self.pool.run(self._fetch_one, 'SELECT chat_id, group_message_id FROM messages '
+                                                       'WHERE user_id = ? AND private_message_id = ?',
+                                      (user_id, message_id))
+            if row is None:
+                return None
+            group = _pack(*row)
+            self._remember(private, group)
+        else:
+            self._to_group.move_to_end(private)
+        return _unpack(group)
+
+    async def get_private_message(self, chat_id: int, message_id: int) -> Optional[MessageRef]:
+        """Сообщение в личке пользователя, связанное с сообщением в группе"""
+        group = _pack(chat_id, message_id)
+        private = self._to_private.get(group)
+        if private is None:
+            # Связь могла вытесниться из памяти раньше записи на диск
+            await self.flush()
+            row = await self.pool.run(self._fetch_one, 'SELECT user_id, private_message_id FROM messages '
+                                                       'WHERE chat_id = ? AND group_message_id = ? '
+                                                       'ORDER BY created_at DESC LIMIT 1',
+                                      (chat_id, message_id))
+            if row is None:
+                return None
+            private = _pack(*row)
+            self._remember(private, group)
+        else:
+            self._to_group.move_to_end(private)
+        return _unpack(private)
+
+    @staticmethod
+    def _fetch_one(conn: sqlite3.Connection, query: str, args: tuple) -> Optional[tuple]:
+        return conn.execute(query, args).fetchone()
+
+    # ----- диск -----
+    async def flush(self):
+        """Записать накопленные связи на диск"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            rows = [_unpack(private) + _unpack(group) + (created_at,)
+                    for private, group, created_at in pending]
+            try:
+                await self.pool.run(self._write, rows)
+            except Exception:
+                # Не потеряем связи: допишем в следующий раз
+                self._pending = pending + self._pending
+                raise
+
+    @staticmethod
+    def _write(conn: sqlite3.Connection, rows: List[tuple]):
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO messages '
+                             '(user_id, private_message_id, chat_id, group_message_id, created_at) '
+                             'VALUES (?, ?, ?, ?, ?)', rows)
+
+    async def compact(self) -> int:
+        """Удалить связи старше retention; возвращает количество удаленных"""
+        return await self.pool.run(self._compact, time.time() - self.retention)
+
+    @staticmethod
+    def _compact(conn: sqlite3.Connection, before: float) -> int:
+        with conn:
+            deleted = conn.execute('DELETE FROM messages WHERE created_at < ?', (before,)).rowcount
+        if deleted:
+            conn.execute('PRAGMA incremental_vacuum').fetchall()
+        return deleted
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing message index: {e}")
+
+    async def _compact_loop(self):
+        while True:
+            try:
+                deleted = await self.compact()
+                if deleted:
+                    logger.info(f"Message index: removed {deleted} old mappings")
+            except Exception as e:
+                logger.error(f"Error compacting message index: {e}")
+            await asyncio.sleep(self.compact_interval)
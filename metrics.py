@@ -0,0 +1,281 @@
+import bisect
+import functools
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.ext import ApplicationHandlerStop
+
+from http_server import Request, Response, serve_http
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержки (сек)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Общая часть метрик: имя, описание и метки"""
+
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+
+class Counter(Metric):
+    """Счетчик, который только растет"""
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, value in self._values.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Gauge(Metric):
+    """Текущее значение; может считаться функцией в момент запроса метрик"""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def set_function(self, function: Callable[[], float], *labels: str):
+        self._functions[labels] = function
+
+    def render(self) -> List[str]:
+        values = dict(self._values)
+        for labels, function in self._functions.items():
+            try:
+                values[labels] = function()
+            except Exception as e:
+                logger.error(f"Error reading gauge {self.name}: {e}")
+        lines = super().render()
+        for labels, value in values.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram(Metric):
+    """Распределение значений по корзинам (накопительно при выводе)"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Для каждого набора меток: счетчики корзин (последняя - +Inf) и сумма
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, *labels: str):
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    def count(self, *labels: str) -> int:
+        return sum(self._counts.get(labels, ()))
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, counts in self._counts.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {total}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(self._sums[labels])}')
+            lines.append(f'{self.name}_count{label_text} {total}')
+        return lines
+
+
+class Registry:
+    """Набор метрик для вывода в формате Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# ========== МЕТРИКИ БОТА ==========
+HANDLER_SECONDS = REGISTRY.histogram(
+    'bot_handler_seconds', 'Время работы обработчика обновления', ('handler',))
+HANDLER_TOTAL = REGISTRY.counter(
+    'bot_handler_total', 'Вызовы обработчиков по результату', ('handler', 'outcome'))
+API_SECONDS = REGISTRY.histogram(
+    'bot_api_request_seconds', 'Время запроса к Bot API (без ожидания лимитов)', ('method',))
+API_TOTAL = REGISTRY.counter(
+    'bot_api_requests_total', 'Запросы к Bot API по результату', ('method', 'outcome'))
+DATABASE_SECONDS = REGISTRY.histogram(
+    'bot_database_seconds', 'Время методов Database', ('method',))
+TOPICS_CREATED = REGISTRY.counter(
+    'bot_topics_created_total', 'Сколько создано тем для пользователей')
+TOPICS_AUTO_CLOSED = REGISTRY.counter(
+    'bot_topics_auto_closed_total', 'Сколько тем закрыто по неактивности')
+TOPICS_REOPENED = REGISTRY.counter(
+    'bot_topics_reopened_total', 'Сколько закрытых тем открыто снова для вернувшихся пользователей')
+MESSAGES_THROTTLED = REGISTRY.counter(
+    'bot_messages_throttled_total', 'Сколько сообщений пользователей отброшено ограничением частоты')
+ACTIVE_TOPICS = REGISTRY.gauge(
+    'bot_active_topics', 'Сколько открытых тем')
+SPARE_TOPICS = REGISTRY.gauge(
+    'bot_spare_topics', 'Сколько заранее созданных тем ждут новых обращений')
+QUEUE_DEPTH = REGISTRY.gauge(
+    'bot_queue_depth', 'Длина внутренних очередей', ('queue',))
+
+
+def error_outcome(error: BaseException) -> str:
+    """Короткое имя результата для метки outcome"""
+    if isinstance(error, RetryAfter):
+        return 'retry_after'
+    if isinstance(error, Forbidden):
+        return 'forbidden'
+    if isinstance(error, BadRequest):
+        return 'bad_request'
+    if isinstance(error, TimedOut):
+        return 'timed_out'
+    if isinstance(error, NetworkError):
+        return 'network_error'
+    return 'error'
+
+
+async def observe_api_call(method: str, callback, *args, **kwargs):
+    """Выполнить запрос к Bot API и записать его время и результат"""
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        return await callback(*args, **kwargs)
+    except Exception as e:
+        outcome = error_outcome(e)
+        raise
+    finally:
+        API_SECONDS.observe(time.perf_counter() - started, method)
+        API_TOTAL.inc(method, outcome)
+
+
+def timed(histogram: Histogram):
+    """Декоратор для async-функций: время вызова с меткой по имени функции"""
+    def decorator(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+
+def instrument_handler(callback):
+    """Обернуть callback обработчика PTB: время и результат (ApplicationHandlerStop - не ошибка)"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            outcome = 'stop'
+            raise
+        except Exception as e:
+            outcome = error_outcome(e)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+            HANDLER_TOTAL.inc(name, outcome)
+    return wrapper
+
+
+def instrument_handlers(application):
+    """Обернуть все зарегистрированные обработчики приложения"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+
+
+async def serve_metrics(host: str, port: int, registry: Optional[Registry] = None):
+    """Запустить HTTP-сервер с метриками на /metrics"""
+    registry = registry or REGISTRY
+
+    async def handle(request: Request) -> Response:
+        if request.path != '/metrics':
+            return Response(404)
+        return Response(200, registry.render().encode(), 'text/plain; version=0.0.4; charset=utf-8')
+
+    server = await serve_http(handle, host, port)
+    logger.info(f"Metrics available on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,292 @@
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from sender import retry_after_seconds
+from storage import SQLitePool
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+DONE = 'done'
+DEAD = 'dead'
+PART = 'part'  # Вид записи о доставленной части сообщения, ушедшего несколькими запросами
+
+
+def part_key(key: str, number: int) -> str:
+    """Ключ части number записи key"""
+    return f'{key}#{number}'
+
+
+def part_owner(part: str) -> str:
+    """Ключ записи, которой принадлежит часть"""
+    return part.rsplit('#', 1)[0]
+
+
+class OutboxEntry(NamedTuple):
+    """Запись журнала исходящих пересылок"""
+    id: int
+    key: str  # Ключ идемпотентности, например 'user:<user_id>:<message_id>'
+    kind: str  # Что доставлять: пересылка в тему, ответ пользователю...
+    payload: Dict[str, Any]
+    attempts: int
+    error: Optional[str]
+    created_at: float
+
+
+class DeliveryPostponed(Exception):
+    """
+    Попытка не удалась, но повтор может помочь: запись остается в ожидании.
+    delay - через сколько секунд повторить; None - журнал останавливается,
+    запись уйдет после перезапуска.
+    """
+
+    def __init__(self, error: str, delay: Optional[float] = None):
+        super().__init__(error)
+        self.delay = delay
+
+
+def is_permanent(error: BaseException) -> bool:
+    """Повтор не поможет: запрос неверен или бот заблокирован"""
+    return isinstance(error, (BadRequest, Forbidden))
+
+
+class Outbox:
+    """Журнал исходящих пересылок в SQLite.
+
+    Обработчик записывает сообщение в журнал до того, как поставить его
+    в очередь, поэтому после перезапуска недоставленное отправляется снова.
+    Ключ идемпотентности уникален: повторно пришедшее обновление (Telegram
+    присылает его заново, если бот упал до подтверждения) не попадет в
+    журнал второй раз, а доставленные ключи помнятся retention секунд.
+    deliver() делает одну попытку и не ждет: после неудачи запись остается
+    в журнале с номером попытки, а вызывающий повторяет ее через паузу из
+    DeliveryPostponed (растет экспоненциально или берется из RetryAfter).
+    После max_attempts попыток или ошибки, которую повтор не исправит,
+    запись становится недоставленной и ждет решения админов.
+    Записи принадлежат процессу (worker), который их создал.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            worker INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, worker);
+    """
+    COLUMNS = 'id, key, kind, payload, attempts, error, created_at'
+
+    def __init__(self, filename: str, worker: int = 0, max_attempts: int = 8,
+                 base_delay: float = 1.0, max_delay: float = 300.0, retention: float = 86400):
+        self.filename = filename
+        self.worker = worker
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retention = retention
+        self.pool = SQLitePool(filename, size=2)
+        self._stopping = False
+        # Сколько попыток уже сделано для записей, ожидающих повтора
+        self._attempts: Dict[str, int] = {}
+        self._purge_task: Optional[asyncio.Task] = None
+        # Записи, ожидающие общей транзакции: (ключ, вид, данные, время, future)
+        self._batch: List[Tuple[str, str, str, float, asyncio.Future]] = []
+        self._writer: Optional[asyncio.Task] = None
+
+    async def open(self):
+        self.pool.open()
+        await self.pool.run(lambda conn: conn.executescript(self.SCHEMA))
+        self._purge_task = asyncio.create_task(self._purge_loop())
+
+    def stop(self):
+        """Прекратить повторы: ожидающие записи доставятся после перезапуска"""
+        self._stopping = True
+
+    async def close(self):
+        self.stop()
+        if self._purge_task:
+            self._purge_task.cancel()
+            await asyncio.gather(self._purge_task, return_exceptions=True)
+        self.pool.close()
+
+    # ----- журнал -----
+    async def add(self, key: str, kind: str, payload: Dict[str, Any]) -> bool:
+        """
+        Записать сообщение в журнал; False - такой ключ уже есть (повтор обновления).
+        Записи, пришедшие одновременно, сохраняются одной транзакцией.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._batch.append((key, kind, json.dumps(payload), time.time(), future))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_batches())
+        return await future
+
+    async def _write_batches(self):
+        while self._batch:
+            batch, self._batch = self._batch, []
+            try:
+                added = await self.pool.run(self._add, [entry[:4] for entry in batch])
+            except Exception as e:
+                for *_, future in batch:
+                    future.set_exception(e)
+            else:
+                for (*_, future), result in zip(batch, added):
+                    future.set_result(result)
+
+    def _add(self, conn: sqlite3.Connection, entries: List[tuple]) -> List[bool]:
+        added = []
+        with conn:
+            for key, kind, payload, now in entries:
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO outbox (key, kind, payload, worker, status, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)', (key, kind, payload, self.worker, PENDING, now, now))
+                added.append(cursor.rowcount > 0)
+        return added
+
+    async def _update(self, keys: List[str], status: str, attempts: int, error: Optional[str]):
+        def update(conn: sqlite3.Connection):
+            with conn:
+                conn.executemany(
+                    'UPDATE outbox SET status = ?, attempts = ?, error = ?, updated_at = ? WHERE key = ?',
+                    [(status, attempts, error, time.time(), key) for key in keys])
+        await self.pool.run(update)
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        """Пауза перед попыткой attempt + 1"""
+        if isinstance(error, RetryAfter):
+            return retry_after_seconds(error)
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        # Разброс, чтобы повторы после общего сбоя не пришли одновременно
+        return delay * random.uniform(0.5, 1.0)
+
+    async def deliver(self, keys: List[str], send: Callable[[], Awaitable[Any]],
+                      parts: Sequence[str] = ()) -> Any:
+        """
+        Выполнить send() для записей keys (одна попытка).
+        Успех отмечает записи доставленными; при окончательной ошибке они
+        становятся недоставленными и ошибка пробрасывается дальше. Если
+        поможет повтор, записи остаются в ожидании и бросается DeliveryPostponed.
+        parts - части записей (part_key), которые отправка доставляет, но
+        не целиком: успех запоминает части (см. delivered()), а их записи
+        остаются в ожидании до отправки последней части.
+        """
+        tracked = list(keys) + list(parts)
+        # Ошибку отправки части учитываем в ее записи
+        entries = list(dict.fromkeys(list(keys) + [part_owner(part) for part in parts]))
+        attempt = max(self._attempts.get(key, 0) for key in tracked) + 1
+        try:
+            result = await send()
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            if is_permanent(e) or attempt >= self.max_attempts:
+                self._forget(tracked)
+                await self._update(entries, DEAD, attempt, error)
+                logger.error(f"Outbox {tracked[0]}: giving up after {attempt} attempts: {error}")
+                raise
+            for key in tracked:
+                self._attempts[key] = attempt
+            await self._update(entries, PENDING, attempt, error)
+            if self._stopping:
+                raise DeliveryPostponed(error) from e
+            delay = self.backoff(attempt, e)
+            logger.warning(f"Outbox {tracked[0]}: attempt {attempt} failed ({error}), retry in {delay:.1f}s")
+            raise DeliveryPostponed(error, delay) from e
+        self._forget(tracked)
+        if parts:
+            await self._add_parts(list(parts))
+        await self._update(keys, DONE, attempt, None)
+        return result
+
+    async def _add_parts(self, parts: List[str]):
+        def add(conn: sqlite3.Connection):
+            now = time.time()
+            with conn:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO outbox (key, kind, payload, worker, status, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)', [(part, PART, '{}', self.worker, DONE, now, now) for part in parts])
+        await self.pool.run(add)
+
+    async def delivered(self, keys: List[str]) -> Set[str]:
+        """Какие из ключей (записей или частей) уже доставлены"""
+        if not keys:
+            return set()
+        rows = await self.pool.run(lambda conn: conn.execute(
+            f'SELECT key FROM outbox WHERE status = ? AND key IN ({", ".join("?" * len(keys))})',
+            (DONE, *keys)).fetchall())
+        return {key for key, in rows}
+
+    def _forget(self, keys: List[str]):
+        for key in keys:
+            self._attempts.pop(key, None)
+
+    # ----- просмотр и повтор -----
+    def _entries(self, conn: sqlite3.Connection, where: str, args: tuple) -> List[OutboxEntry]:
+        rows = conn.execute(f'SELECT {self.COLUMNS} FROM outbox WHERE {where} ORDER BY id', args).fetchall()
+        return [OutboxEntry(id, key, kind, json.loads(payload), attempts, error, created_at)
+                for id, key, kind, payload, attempts, error, created_at in rows]
+
+    async def pending(self) -> List[OutboxEntry]:
+        """Недоставленные записи этого процесса, которые еще нужно отправить"""
+        entries = await self.pool.run(self._entries, 'status = ? AND worker = ?', (PENDING, self.worker))
+        # Счет попыток продолжается с того, на чем остановился до перезапуска
+        for entry in entries:
+            if entry.attempts:
+                self._attempts[entry.key] = entry.attempts
+        return entries
+
+    async def dead(self) -> List[OutboxEntry]:
+        """Записи, которые не удалось доставить"""
+        return await self.pool.run(self._entries, 'status = ?', (DEAD,))
+
+    async def counts(self) -> Dict[str, int]:
+        """Количество записей по состояниям"""
+        rows = await self.pool.run(
+            lambda conn: conn.execute('SELECT status, COUNT(*) FROM outbox WHERE kind != ? GROUP BY status',
+                                      (PART,)).fetchall())
+        return dict(rows)
+
+    async def revive(self, entry_id: Optional[int] = None) -> List[OutboxEntry]:
+        """Вернуть недоставленные записи (одну или все) в ожидание этого процесса"""
+        def revive(conn: sqlite3.Connection) -> List[OutboxEntry]:
+            where, args = 'status = ?', (DEAD,)
+            if entry_id is not None:
+                where, args = 'status = ? AND id = ?', (DEAD, entry_id)
+            with conn:
+                entries = self._entries(conn, where, args)
+                conn.executemany(
+                    'UPDATE outbox SET status = ?, worker = ?, attempts = 0, updated_at = ? WHERE id = ?',
+                    [(PENDING, self.worker, time.time(), entry.id) for entry in entries])
+            return entries
+        entries = await self.pool.run(revive)
+        self._forget([entry.key for entry in entries])
+        return entries
+
+    async def purge(self) -> int:
+        """Забыть доставленные записи старше retention"""
+        def purge(conn: sqlite3.Connection) -> int:
+            with conn:
+                return conn.execute('DELETE FROM outbox WHERE status = ? AND updated_at < ?',
+                                    (DONE, time.time() - self.retention)).rowcount
+        return await self.pool.run(purge)
+
+    async def _purge_loop(self):
+        while True:
+            try:
+                await self.purge()
+            except Exception as e:
+                logger.error(f"Error purging outbox: {e}")
+            await asyncio.sleep(min(self.retention, 3600))
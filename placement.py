@@ -0,0 +1,78 @@
+import bisect
+import zlib
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+from telegram import User
+
+
+class PlacementPolicy(ABC):
+    """Выбор админской группы, в которой создается тема нового пользователя"""
+
+    @abstractmethod
+    def choose(self, user: User, groups: List[int], loads: Dict[int, int]) -> int:
+        """
+        Выбрать группу из groups (непустой список).
+        loads - сколько открытых тем сейчас в каждой группе.
+        """
+
+
+class LeastLoadedPolicy(PlacementPolicy):
+    """Группа с наименьшим числом открытых тем"""
+
+    def choose(self, user: User, groups: List[int], loads: Dict[int, int]) -> int:
+        return min(groups, key=lambda group_id: loads.get(group_id, 0))
+
+
+class ConsistentHashPolicy(PlacementPolicy):
+    """Кольцо хешей: пользователь всегда попадает в одну и ту же группу,
+    а при добавлении группы переезжает только ~1/N новых пользователей"""
+
+    def __init__(self, replicas: int = 100):
+        self.replicas = replicas
+        self._groups: Optional[List[int]] = None
+        self._ring: List[int] = []
+        self._owners: List[int] = []
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return zlib.crc32(key.encode())
+
+    def _build(self, groups: List[int]):
+        points = sorted((self._hash(f'{group_id}:{replica}'), group_id)
+                        for group_id in groups for replica in range(self.replicas))
+        self._ring = [point for point, _ in points]
+        self._owners = [group_id for _, group_id in points]
+        self._groups = list(groups)
+
+    def choose(self, user: User, groups: List[int], loads: Dict[int, int]) -> int:
+        if groups != self._groups:
+            self._build(groups)
+        index = bisect.bisect(self._ring, self._hash(str(user.id))) % len(self._ring)
+        return self._owners[index]
+
+
+class LanguagePolicy(PlacementPolicy):
+    """Группа по языку пользователя (language_code из Telegram), иначе - запасная политика"""
+
+    def __init__(self, routes: Dict[str, int], fallback: Optional[PlacementPolicy] = None):
+        self.routes = routes
+        self.fallback = fallback or LeastLoadedPolicy()
+
+    def choose(self, user: User, groups: List[int], loads: Dict[int, int]) -> int:
+        language = (user.language_code or '').split('-')[0].lower()
+        group_id = self.routes.get(language)
+        if group_id in groups:
+            return group_id
+        return self.fallback.choose(user, groups, loads)
+
+
+def create_policy(name: str, language_groups: Optional[Dict[str, int]] = None) -> PlacementPolicy:
+    """Создать политику по названию из настроек"""
+    if name == 'least_loaded':
+        return LeastLoadedPolicy()
+    if name == 'hash':
+        return ConsistentHashPolicy()
+    if name == 'language':
+        return LanguagePolicy(language_groups or {})
+    raise ValueError(f"Unknown placement policy: {name}")
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RelayBuffer:
+    """Буфер пересылки сообщений.
+
+    Сообщения одного ключа (пользователя) копятся, пока предыдущая пачка
+    еще отправляется, и уходят следующей пачкой одним вызовом. Для каждого
+    ключа одновременно работает не больше одной отправки, поэтому порядок
+    сохраняется. window - сколько подождать остальные сообщения пачки
+    перед первой отправкой.
+
+    Части альбома (media_group_id) приходят отдельными обновлениями, поэтому
+    add(..., hold=...) придерживает отправку, пока части продолжают приходить:
+    весь альбом попадает в одну пачку и уходит одним вызовом. Тот же механизм
+    служит для склейки коротких текстов подряд. max_delay ограничивает, на
+    сколько можно придержать первое сообщение пачки.
+
+    Если отправку нужно повторить позже, flush возвращает неотправленное
+    через defer(): ключ не отправляется до повтора, а новые сообщения
+    встают в очередь за возвращенными, и ничья задача не спит в ожидании.
+    """
+
+    def __init__(self, flush: Callable[[Hashable, List[Any]], Awaitable[None]],
+                 window: float = 0.0, max_batch: int = 100, max_delay: float = 5.0):
+        self._flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending: Dict[Hashable, List[Any]] = {}
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._hold_until: Dict[Hashable, float] = {}
+        self._first_added: Dict[Hashable, float] = {}
+        self._deferred: Dict[Hashable, Tuple[List[Any], float]] = {}
+        self._resume: Dict[Hashable, asyncio.TimerHandle] = {}
+
+    @property
+    def depth(self) -> int:
+        """Сколько сообщений ждут отправки"""
+        return sum(len(items) for items in self._pending.values())
+
+    def add(self, key: Hashable, item: Any, hold: float = 0.0):
+        """
+        Поставить сообщение в очередь на пересылку (не ждет отправки).
+        hold - не отправлять пачку раньше, чем через hold секунд после этого сообщения.
+        """
+        now = time.monotonic()
+        self._pending.setdefault(key, []).append(item)
+        first_added = self._first_added.setdefault(key, now)
+        if hold:
+            hold_until = min(now + hold, first_added + self.max_delay)
+            self._hold_until[key] = max(self._hold_until.get(key, 0.0), hold_until)
+        if key not in self._tasks and key not in self._resume:
+            self._tasks[key] = asyncio.create_task(self._run(key))
+
+    def defer(self, key: Hashable, items: List[Any], delay: float):
+        """
+        Вызывается из flush: вернуть неотправленные сообщения в начало очереди
+        ключа и отправить их (вместе с пришедшими за это время) через delay секунд.
+        """
+        self._deferred[key] = (list(items), delay)
+
+    def _wake(self, key: Hashable):
+        del self._resume[key]
+        if self._pending.get(key) and key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._run(key))
+
+    async def _run(self, key: Hashable):
+        try:
+            if self.window:
+                await asyncio.sleep(self.window)
+            while self._pending.get(key):
+                # Ждем, пока перестанут приходить части альбома или тексты подряд
+                delay = self._hold_until.get(key, 0.0) - time.monotonic()
+                while delay > 0:
+                    await asyncio.sleep(delay)
+                    delay = self._hold_until.get(key, 0.0) - time.monotonic()
+                self._hold_until.pop(key, None)
+                self._first_added.pop(key, None)
+
+                batch = self._pending.pop(key)
+                for start in range(0, len(batch), self.max_batch):
+                    try:
+                        await self._flush(key, batch[start:start + self.max_batch])
+                    except Exception as e:
+                        logger.error(f"Error flushing relay batch for {key}: {e}")
+                    if key in self._deferred:
+                        items, delay = self._deferred.pop(key)
+                        rest = batch[start + self.max_batch:]
+                        self._pending[key] = items + rest + self._pending.get(key, [])
+                        self._resume[key] = asyncio.get_running_loop().call_later(delay, self._wake, key)
+                        return
+        finally:
+            del self._tasks[key]
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Дождаться отправки всех сообщений в буфере; False - не успели за timeout секунд.
+        Отложенные повторы не ждет: их сообщения остаются в очереди до cancel().
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._tasks:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            # wait, а не gather: по истечении времени отправки не отменяются
+            await asyncio.wait(list(self._tasks.values()), timeout=remaining)
+        return True
+
+    async def cancel(self) -> int:
+        """Прервать все отправки и очистить буфер; возвращает, сколько сообщений не ушло"""
+        dropped = self.depth
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for handle in self._resume.values():
+            handle.cancel()
+        self._resume.clear()
+        self._deferred.clear()
+        self._pending.clear()
+        self._hold_until.clear()
+        self._first_added.clear()
+        return dropped
@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from storage import Changes, ShelveBackend, SQLiteBackend
+
+BATCH_SIZE = 10_000  # Размер пачки при заполнении базы
+LOOKUPS = 10_000  # Количество случайных запросов для замера задержки
+FLUSH_BATCH = 100  # Размер пачки при замере фоновой записи
+GROUP_ID = -1001  # ID админской группы в тестовых связях
+
+
+def percentile(values, p):
+    """Перцентиль p (0-100) по отсортированному списку"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def bench_backend(name, backend, size):
+    """
+    Замеряет одно хранилище на size связях.
+    Возвращает словарь с результатами в миллисекундах.
+    """
+    result = {'backend': name, 'size': size}
+
+    # 1. Заполнение пачками, как это делает фоновая запись Database
+    await backend.open()
+    started = time.perf_counter()
+    for start in range(0, size, BATCH_SIZE):
+        changes = Changes()
+        for user_id in range(start, min(size, start + BATCH_SIZE)):
+            changes.set_mapping(user_id, (GROUP_ID, user_id + 1_000_000))
+        await backend.write(changes)
+    result['fill_s'] = time.perf_counter() - started
+    await backend.close()
+
+    # 2. Холодный старт с загрузкой всех связей в память (preload)
+    started = time.perf_counter()
+    await backend.open()
+    mappings = await backend.load_mappings()
+    result['preload_s'] = time.perf_counter() - started
+    assert len(mappings) == size
+    del mappings
+
+    # 3. Дочитывание промахов (preload=False): случайные запросы в обе стороны
+    latencies = []
+    for _ in range(LOOKUPS):
+        user_id = random.randrange(size)
+        started = time.perf_counter()
+        await backend.get_user_topic(user_id)
+        await backend.get_user_by_topic(GROUP_ID, user_id + 1_000_000)
+        latencies.append((time.perf_counter() - started) * 1000 / 2)
+    result['lookup_p50_ms'] = percentile(latencies, 50)
+    result['lookup_p99_ms'] = percentile(latencies, 99)
+
+    # 4. Запись типичной пачки изменений
+    latencies = []
+    for _ in range(5):
+        changes = Changes()
+        for _ in range(FLUSH_BATCH):
+            changes.set_mapping(random.randrange(size), (GROUP_ID, random.randrange(2_000_000, 3_000_000)))
+        started = time.perf_counter()
+        await backend.write(changes)
+        latencies.append((time.perf_counter() - started) * 1000)
+    result['flush_ms'] = statistics.median(latencies)
+
+    await backend.close()
+    return result
+
+
+async def main(sizes, backends):
+    """
+    Основная асинхронная функция
+    """
+    results = []
+    for size in sizes:
+        for name in backends:
+            workdir = tempfile.mkdtemp(prefix='bench_storage_')
+            try:
+                if name == 'shelve':
+                    backend = ShelveBackend(os.path.join(workdir, 'bot_database.db'))
+                else:
+                    backend = SQLiteBackend(os.path.join(workdir, 'bot_database.sqlite3'))
+                print(f"⏱ {name}: {size} связей...")
+                results.append(await bench_backend(name, backend, size))
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    print("\n" + "=" * 78)
+    print(f"{'хранилище':<10}{'связей':>10}{'заполнение, с':>15}{'preload, с':>12}"
+          f"{'get p50, мс':>12}{'get p99, мс':>12}{'flush, мс':>10}")
+    print("=" * 78)
+    for r in results:
+        print(f"{r['backend']:<10}{r['size']:>10}{r['fill_s']:>15.2f}{r['preload_s']:>12.2f}"
+              f"{r['lookup_p50_ms']:>12.3f}{r['lookup_p99_ms']:>12.3f}{r['flush_ms']:>10.1f}")
+
+
+def run_script():
+    """
+    Запускает асинхронную функцию
+    """
+    parser = argparse.ArgumentParser(description="Сравнение хранилищ базы бота")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 1_000_000],
+                        help="Количество связей пользователь-тема")
+    parser.add_argument('--backends', nargs='+', default=['shelve', 'sqlite'],
+                        choices=['shelve', 'sqlite'])
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args.sizes, args.backends))
+    except KeyboardInterrupt:
+        print("\n\n👋 Скрипт остановлен пользователем")
+
+
+if __name__ == "__main__":
+    run_script()
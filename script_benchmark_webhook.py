@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import contextlib
+import functools
+import itertools
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
+import time
+
+import httpx
+
+import bot
+import webhook
+from fake_bot_api import FAKE_TOKEN, FakeBotAPI, private_message
+from storage import Changes, SQLiteBackend, TopicOwners
+
+ADMIN_GROUP_ID = -1001  # ID тестовой админской группы
+SECRET_TOKEN = 'benchmark-secret'
+
+_update_ids = itertools.count(1)
+
+
+async def prepare_database(users: int):
+    """Заполнить базу: у всех пользователей уже есть темы"""
+    backend = SQLiteBackend(bot.SQLITE_DATABASE_FILE)
+    await backend.open()
+    changes = Changes()
+    for user_id in range(1, users + 1):
+        changes.set_mapping(user_id, (ADMIN_GROUP_ID, 1000 + user_id))
+    changes.set_value('admin_group_id', ADMIN_GROUP_ID)
+    changes.set_value('admin_groups', [ADMIN_GROUP_ID])
+    await backend.write(changes)
+    await backend.close()
+
+
+def forwarded_count() -> int:
+    """
+    Сколько сообщений пользователей доставлено в темы - по журналу отправки
+    всех процессов. Копии в Bot API не подходят: тексты подряд уходят одним
+    склеенным сообщением.
+    """
+    try:
+        with contextlib.closing(sqlite3.connect(bot.OUTBOX_FILE)) as conn:
+            return conn.execute("SELECT COUNT(*) FROM outbox WHERE kind = 'to_topic' AND status = 'done'").fetchone()[0]
+    except sqlite3.OperationalError:
+        # Журнал еще не создан
+        return 0
+
+
+async def wait_forwarded(count: int, timeout: float = 600):
+    """Дождаться, пока в темы будут доставлены count сообщений пользователей"""
+    deadline = time.monotonic() + timeout
+    while forwarded_count() < count:
+        if time.monotonic() > deadline:
+            raise asyncio.TimeoutError(f"only {forwarded_count()} of {count} messages forwarded")
+        await asyncio.sleep(0.05)
+
+
+def make_updates(count: int, users: int):
+    return [private_message(1 + i % users, f"Сообщение {i}") for i in range(count)]
+
+
+async def bench_polling(api: FakeBotAPI, updates):
+    """Один процесс, обновления через getUpdates"""
+    bot.STORAGE_BACKEND = 'sqlite'
+    application = bot.build_application(FAKE_TOKEN, base_url=api.base_url, rate_limits=False,
+                                        flood_control=False)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+
+    expected = forwarded_count() + len(updates)
+    started = time.perf_counter()
+    for data in updates:
+        api.put_update(data)
+    await wait_forwarded(expected)
+    elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    return elapsed
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _post_all(port: int, updates, concurrency: int):
+    url = f'http://127.0.0.1:{port}/webhook'
+    headers = {webhook.SECRET_HEADER: SECRET_TOKEN}
+    queue = asyncio.Queue()
+    for data in updates:
+        queue.put_nowait(data)
+
+    async def sender(client):
+        while not queue.empty():
+            data = queue.get_nowait()
+            data = dict(data, update_id=next(_update_ids))
+            response = await client.post(url, json=data, headers=headers)
+            response.raise_for_status()
+
+    async with httpx.AsyncClient() as client:
+        await asyncio.gather(*[sender(client) for _ in range(concurrency)])
+
+
+async def bench_webhook(api: FakeBotAPI, updates, workers: int, concurrency: int):
+    """Вебхук с workers процессами; обновления отправляет локальный "Telegram" """
+    port = _free_port()
+    build = functools.partial(bot.build_application, FAKE_TOKEN, base_url=api.base_url,
+                              shared_storage=True, rate_limits=False, flood_control=False)
+    process = multiprocessing.get_context('spawn').Process(
+        target=webhook.run_webhook,
+        args=(build, FAKE_TOKEN, SECRET_TOKEN),
+        kwargs={'listen': '127.0.0.1', 'port': port, 'workers': workers,
+                'topic_owner': TopicOwners(bot.SQLITE_DATABASE_FILE)}
+    )
+    process.start()
+
+    # Прогрев: ждем, пока поднимутся сервер и все процессы-обработчики
+    warmup = make_updates(workers * 4, workers * 4)
+    before = forwarded_count()
+    for _ in range(100):
+        try:
+            await _post_all(port, warmup, 1)
+            break
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    await wait_forwarded(before + len(warmup), timeout=120)
+
+    expected = forwarded_count() + len(updates)
+    started = time.perf_counter()
+    await _post_all(port, updates, concurrency)
+    await wait_forwarded(expected)
+    elapsed = time.perf_counter() - started
+
+    os.kill(process.pid, signal.SIGTERM)
+    await asyncio.get_running_loop().run_in_executor(None, process.join, 60)
+    return elapsed
+
+
+async def main(args):
+    """
+    Основная асинхронная функция
+    """
+    await prepare_database(args.users)
+    api = FakeBotAPI(latency=args.latency)
+    await api.start()
+
+    updates = make_updates(args.updates, args.users)
+    print(f"⏱ polling: {args.updates} обновлений от {args.users} пользователей...")
+    polling = await bench_polling(api, updates)
+
+    print(f"⏱ webhook: {args.workers} процесса(ов)...")
+    # Новые ID сообщений: повторы уже полученных журнал отправки отбрасывает
+    updates = make_updates(args.updates, args.users)
+    webhook_time = await bench_webhook(api, updates, args.workers, args.concurrency)
+
+    await api.stop()
+
+    print("\n" + "=" * 50)
+    print(f"Задержка Bot API: {args.latency * 1000:.0f} мс")
+    print(f"polling:             {args.updates / polling:8.1f} обновлений/с")
+    print(f"webhook x{args.workers:<2}         {args.updates / webhook_time:8.1f} обновлений/с")
+    print("=" * 50)
+
+
+def run_script():
+    """
+    Запускает асинхронную функцию
+    """
+    parser = argparse.ArgumentParser(description="Сравнение пропускной способности polling и вебхука")
+    parser.add_argument('--updates', type=int, default=2000, help="Количество обновлений")
+    parser.add_argument('--users', type=int, default=200, help="Количество пользователей")
+    parser.add_argument('--workers', type=int, default=4, help="Процессов-обработчиков вебхука")
+    parser.add_argument('--concurrency', type=int, default=32, help="Параллельных запросов к вебхуку")
+    parser.add_argument('--latency', type=float, default=0.02, help="Задержка Bot API, сек")
+    args = parser.parse_args()
+
+    # Все файлы базы создаются во временной папке
+    workdir = tempfile.mkdtemp(prefix='bench_webhook_')
+    os.chdir(workdir)
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print("\n\n👋 Скрипт остановлен пользователем")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    run_script()
@@ -1,159 +1,259 @@
+import argparse
 import asyncio
+import json
 import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
 from telegram import Bot
 from telegram.constants import ChatType
+from telegram.error import BadRequest, Conflict, Forbidden
+from telegram.request import HTTPXRequest
 
+from chat_registry import find_registry_files, load_registry
 
-async def get_bot_groups():
-    """
-    Получает список всех групп, в которых состоит бот.
-    Возвращает список словарей с информацией о группе.
-    """
+API_TOKEN_FILE = 'api'  # Файл с токеном бота
+CHAT_REGISTRY_FILE = 'chats.json'  # Реестр чатов, который ведет работающий бот (bot.py)
+CACHE_FILE = 'groups_cache.json'  # Сведения о группах с прошлого запуска
 
-    # 1. Читаем токен из файла 'api'
-    if not os.path.exists('api'):
-        print("❌ Файл 'api' не найден!")
-        print("Создайте файл 'api' в той же директории и поместите туда токен вашего бота.")
-        return []
+GROUP_TYPES = {ChatType.GROUP, ChatType.SUPERGROUP}
 
-    with open('api', 'r') as f:
-        token = f.read().strip()
+# В режиме --json в stdout идет только результат, сообщения - в stderr
+_output = sys.stdout
 
-    if not token:
-        print("❌ Токен не найден в файле 'api'!")
-        return []
 
-    print(f"✅ Токен загружен (первые 10 символов): {token[:10]}...")
+def log(text: str = ''):
+    print(text, file=_output)
 
-    # 2. Создаем экземпляр бота
-    bot = Bot(token=token)
 
-    # 3. Получаем информацию о боте (для проверки)
-    try:
-        me = await bot.get_me()
-        print(f"🤖 Бот: @{me.username} ({me.first_name})")
-    except Exception as e:
-        print(f"❌ Ошибка при получении информации о боте: {e}")
-        return []
-
-    # 4. Получаем обновления, чтобы найти чаты
-    print("📡 Получаю список чатов...")
+# ========== ИСТОЧНИКИ ЧАТОВ ==========
+def read_token() -> Optional[str]:
+    """Токен бота из файла 'api'"""
+    if not os.path.exists(API_TOKEN_FILE):
+        log(f"❌ Файл '{API_TOKEN_FILE}' не найден!")
+        log(f"Создайте файл '{API_TOKEN_FILE}' в той же директории и поместите туда токен вашего бота.")
+        return None
 
-    groups = []
+    with open(API_TOKEN_FILE, 'r') as f:
+        token = f.read().strip()
 
+    if not token:
+        log(f"❌ Токен не найден в файле '{API_TOKEN_FILE}'!")
+        return None
+    return token
+
+
+def chats_from_registry(filename: str) -> Dict[int, Dict[str, Any]]:
+    """Группы из реестра работающего бота (всех процессов), в которых бот еще состоит"""
+    chats: Dict[int, Dict[str, Any]] = {}
+    for path in find_registry_files(filename):
+        for chat in load_registry(path):
+            known = chats.get(chat['id'])
+            # Один чат может быть в реестрах нескольких процессов - берем свежую запись
+            if known is None or chat.get('seen_at', 0) > known.get('seen_at', 0):
+                chats[chat['id']] = chat
+    return {chat_id: chat for chat_id, chat in chats.items()
+            if chat.get('type') in GROUP_TYPES and chat.get('member', True)}
+
+
+def update_chat(update):
+    """Чат, из которого пришло обновление"""
+    for item in (update.message, update.edited_message, update.channel_post,
+                 update.edited_channel_post, update.my_chat_member, update.chat_member,
+                 update.chat_join_request):
+        if item:
+            return item.chat
+    return None
+
+
+async def chats_from_updates(bot: Bot) -> Dict[int, Dict[str, Any]]:
+    """
+    Группы из еще не полученных ботом обновлений.
+    Читаем только первую страницу без offset: запрос с offset подтверждает
+    все предыдущие обновления, и работающий бот их бы уже не получил.
+    """
     try:
-        # Получаем последние обновления (можно увеличить лимит при необходимости)
-        updates = await bot.get_updates(limit=100, timeout=10)
-
-        print(f"🔍 Найдено {len(updates)} обновлений в истории...")
-
-        # Проходим по всем обновлениям и собираем уникальные чаты
-        seen_chats = set()
-
-        for update in updates:
-            chat = None
-
-            # Определяем, откуда пришло обновление
-            if update.message:
-                chat = update.message.chat
-            elif update.edited_message:
-                chat = update.edited_message.chat
-            elif update.channel_post:
-                chat = update.channel_post.chat
-            elif update.edited_channel_post:
-                chat = update.edited_channel_post.chat
-            elif update.my_chat_member:
-                chat = update.my_chat_member.chat
-            elif update.chat_member:
-                chat = update.chat_member.chat
-            elif update.chat_join_request:
-                chat = update.chat_join_request.chat
-
-            if chat and chat.id not in seen_chats:
-                seen_chats.add(chat.id)
-
-                # Фильтруем только группы и супергруппы
-                if chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
-                    # Получаем более полную информацию о чате
-                    try:
-                        chat_info = await bot.get_chat(chat.id)
-
-                        group_info = {
-                            'id': chat_info.id,
-                            'title': chat_info.title,
-                            'type': chat_info.type,
-                            'username': chat_info.username,
-                            'invite_link': chat_info.invite_link,
-                            'member_count': getattr(chat_info, 'member_count', 'N/A')
-                        }
-
-                        groups.append(group_info)
-                        print(f"✅ Добавлена группа: {chat_info.title} (ID: {chat_info.id})")
-
-                    except Exception as e:
-                        print(f"⚠️ Не удалось получить информацию о чате {chat.id}: {e}")
+        updates = await bot.get_updates(limit=100, timeout=0)
+    except Conflict:
+        log("ℹ️ Бот сейчас получает обновления сам (polling или вебхук) - читаю только реестр")
+        return {}
+
+    log(f"🔍 Найдено {len(updates)} обновлений в очереди...")
+    chats = {}
+    for update in updates:
+        chat = update_chat(update)
+        if chat and chat.type in GROUP_TYPES:
+            chats[chat.id] = {'id': chat.id, 'title': chat.title, 'type': chat.type}
+    return chats
+
+
+# ========== СВЕДЕНИЯ О ГРУППАХ ==========
+def load_cache(filename: str) -> Dict[int, Dict[str, Any]]:
+    try:
+        with open(filename, encoding='utf-8') as f:
+            return {group['id']: group for group in json.load(f)}
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_cache(filename: str, cache: Dict[int, Dict[str, Any]]):
+    tmp_file = f'{filename}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(list(cache.values()), f, ensure_ascii=False, indent=1)
+    os.replace(tmp_file, filename)
+
+
+def is_stale(cached: Optional[Dict[str, Any]], known: Dict[str, Any], max_age: float) -> bool:
+    """Нужно ли заново запросить сведения о группе"""
+    if cached is None or cached['fetched_at'] < time.time() - max_age:
+        return True
+    # Бот видел группу с другим названием уже после запроса - ее переименовали
+    return (known.get('seen_at', 0) > cached['fetched_at']
+            and known.get('title') not in (None, cached.get('title')))
+
+
+async def fetch_group(bot: Bot, chat_id: int, limit: asyncio.Semaphore) -> Dict[str, Any]:
+    """Полные сведения о группе (member=False - бот в ней больше не состоит)"""
+    async with limit:
+        try:
+            chat_info = await bot.get_chat(chat_id)
+        except (Forbidden, BadRequest) as e:
+            log(f"⚠️ Бот больше не состоит в чате {chat_id}: {e}")
+            return {'id': chat_id, 'member': False, 'fetched_at': time.time()}
+
+    log(f"✅ Добавлена группа: {chat_info.title} (ID: {chat_info.id})")
+    return {
+        'id': chat_info.id,
+        'member': True,
+        'title': chat_info.title,
+        'type': chat_info.type,
+        'username': chat_info.username,
+        'invite_link': chat_info.invite_link,
+        'member_count': getattr(chat_info, 'member_count', None),
+        'fetched_at': time.time()
+    }
+
+
+async def get_bot_groups(args) -> List[Dict[str, Any]]:
+    """
+    Получает список всех групп, в которых состоит бот.
+    Возвращает список словарей с информацией о группе.
+    """
+    token = read_token()
+    if not token:
+        return []
 
-    except Exception as e:
-        print(f"❌ Ошибка при получении обновлений: {e}")
+    # Пул соединений под параллельные запросы get_chat
+    bot = Bot(token=token, request=HTTPXRequest(connection_pool_size=args.concurrency))
+    async with bot:
+        me = bot.bot
+        log(f"🤖 Бот: @{me.username} ({me.first_name})")
+
+        log("📡 Получаю список чатов...")
+        known: Dict[int, Dict[str, Any]] = {}
+        if args.source in ('registry', 'all'):
+            known.update(chats_from_registry(args.registry))
+            log(f"📒 В реестре бота групп: {len(known)}")
+        if args.source in ('updates', 'all'):
+            for chat_id, chat in (await chats_from_updates(bot)).items():
+                known.setdefault(chat_id, chat)
+
+        # Запрашиваем только новые и устаревшие группы, остальное - из кэша
+        cache = {} if args.refresh else load_cache(args.cache)
+        max_age = args.max_age * 3600
+        stale = [chat_id for chat_id, chat in known.items()
+                 if is_stale(cache.get(chat_id), chat, max_age)]
+        log(f"🔄 Запрашиваю сведения о {len(stale)} группах (из кэша: {len(known) - len(stale)})")
+
+        limit = asyncio.Semaphore(args.concurrency)
+        results = await asyncio.gather(*(fetch_group(bot, chat_id, limit) for chat_id in stale))
+        cache.update(zip(stale, results))
+
+    save_cache(args.cache, cache)
+    return [cache[chat_id] for chat_id in known if cache[chat_id]['member']]
+
+
+# ========== ЗАПУСК ==========
+def print_groups(groups: List[Dict[str, Any]]):
+    log("\n" + "=" * 50)
+    log("📊 РЕЗУЛЬТАТЫ")
+    log("=" * 50)
 
-    # 5. Альтернативный метод: если бот администратор, можно получить список чатов через getChatAdministrators
-    # Но для этого нужно знать ID чатов заранее
+    if groups:
+        log(f"\n✅ Бот состоит в {len(groups)} группе(ах):\n")
 
-    return groups
+        for i, group in enumerate(groups, 1):
+            log(f"{i}. {group['title']}")
+            log(f"   ID: {group['id']}")
+            log(f"   Тип: {group['type']}")
+            if group['username']:
+                log(f"   Юзернейм: @{group['username']}")
+            if group['invite_link']:
+                log(f"   Пригласительная ссылка: {group['invite_link']}")
+            if group['member_count'] is not None:
+                log(f"   Участников: {group['member_count']}")
+            log()
+    else:
+        log("\n❌ Бот не найден ни в одной группе.")
+        log("\n💡 Советы:")
+        log("1. Убедитесь, что бот добавлен в группу как участник")
+        log("2. Отправьте любое сообщение в группе, где есть бот")
+        log(f"3. Запустите bot.py: он записывает группы в реестр {CHAT_REGISTRY_FILE}")
+
+    log("\n📝 Примечание:")
+    log("Находятся группы, из которых бот получал обновления (реестр bot.py)")
+    log("и группы из еще не полученных ботом обновлений.")
 
 
-async def main():
+async def main(args):
     """
     Основная асинхронная функция
     """
-    print("=" * 50)
-    print("🔍 ПОИСК ГРУПП БОТА")
-    print("=" * 50)
-
-    groups = await get_bot_groups()
+    log("=" * 50)
+    log("🔍 ПОИСК ГРУПП БОТА")
+    log("=" * 50)
 
-    print("\n" + "=" * 50)
-    print("📊 РЕЗУЛЬТАТЫ")
-    print("=" * 50)
-
-    if groups:
-        print(f"\n✅ Бот состоит в {len(groups)} группе(ах):\n")
+    groups = await get_bot_groups(args)
 
-        for i, group in enumerate(groups, 1):
-            print(f"{i}. {group['title']}")
-            print(f"   ID: {group['id']}")
-            print(f"   Тип: {group['type']}")
-            if group['username']:
-                print(f"   Юзернейм: @{group['username']}")
-            if group['invite_link']:
-                print(f"   Пригласительная ссылка: {group['invite_link']}")
-            if group['member_count'] != 'N/A':
-                print(f"   Участников: {group['member_count']}")
-            print()
+    if args.json:
+        json.dump(groups, sys.stdout, ensure_ascii=False, indent=2)
+        print()
     else:
-        print("\n❌ Бот не найден ни в одной группе.")
-        print("\n💡 Советы:")
-        print("1. Убедитесь, что бот добавлен в группу как участник")
-        print("2. Отправьте любое сообщение в группе, где есть бот")
-        print("3. Попробуйте перезапустить бота командой /start в личке с ботом")
-        print("4. Метод работает только с чатами, где бот получал обновления")
+        print_groups(groups)
+
 
-    print("\n📝 Примечание:")
-    print("Этот метод находит только те группы, где бот получал обновления.")
-    print("Для получения полного списка нужно использовать другой подход.")
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Поиск групп, в которых состоит бот")
+    parser.add_argument('--source', choices=('registry', 'updates', 'all'), default='all',
+                        help="откуда брать чаты: реестр bot.py, очередь обновлений или оба")
+    parser.add_argument('--registry', default=CHAT_REGISTRY_FILE, help="файл реестра чатов bot.py")
+    parser.add_argument('--cache', default=CACHE_FILE, help="файл кэша сведений о группах")
+    parser.add_argument('--max-age', type=float, default=24,
+                        help="через сколько часов перезапрашивать сведения о группе")
+    parser.add_argument('--refresh', action='store_true', help="перезапросить все группы")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="сколько запросов get_chat выполнять одновременно")
+    parser.add_argument('--json', action='store_true', help="вывести результат в JSON (для скриптов)")
+    return parser.parse_args(argv)
 
 
 def run_script():
     """
     Запускает асинхронную функцию
     """
+    global _output
+    args = parse_args()
+    if args.json:
+        _output = sys.stderr
     try:
-        asyncio.run(main())
+        asyncio.run(main(args))
     except KeyboardInterrupt:
-        print("\n\n👋 Скрипт остановлен пользователем")
+        log("\n\n👋 Скрипт остановлен пользователем")
     except Exception as e:
-        print(f"\n❌ Неожиданная ошибка: {e}")
+        log(f"\n❌ Неожиданная ошибка: {e}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    run_script()
\ No newline at end of file
+    run_script()
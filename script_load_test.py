@@ -0,0 +1,309 @@
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List
+
+import bot
+from fake_bot_api import FAKE_TOKEN, FakeBotAPI, group_reply, private_message
+
+ADMIN_GROUP_ID = -1001  # ID тестовой админской группы
+ADMIN_ID = 1  # ID админа, который отвечает пользователям
+
+# Вызовы, которые делает сам PTB, а не обработка обновлений
+SERVICE_METHODS = {'getMe', 'getUpdates', 'deleteWebhook', 'setWebhook'}
+
+# Методы Database, время которых считаем
+DATABASE_METHODS = ('get_user_topic', 'set_user_topic', 'get_user_by_topic', 'delete_user',
+                    'get_topic', 'start_topic', 'record_messages', 'close_topic', 'reopen_topic',
+                    'add_group', 'flush')
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (0..1) по ближайшему рангу"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# ========== СИНТЕТИЧЕСКИЙ ТРАФИК ==========
+def parse_mix(text: str) -> Dict[str, int]:
+    """'text=70,photo=10' -> {'text': 70, 'photo': 10}"""
+    mix = {}
+    for part in text.split(','):
+        kind, weight = part.split('=')
+        if kind not in MESSAGE_KINDS:
+            raise argparse.ArgumentTypeError(f"неизвестный тип сообщения: {kind}")
+        mix[kind] = int(weight)
+    return mix
+
+
+def _photo(user_id: int, n: int, **fields):
+    return [private_message(user_id, photo=[{'file_id': f'photo{user_id}_{n}',
+                                             'file_unique_id': f'p{user_id}_{n}',
+                                             'width': 100, 'height': 100}], **fields)]
+
+
+def _document(user_id: int, n: int):
+    return [private_message(user_id, document={'file_id': f'doc{user_id}_{n}',
+                                               'file_unique_id': f'd{user_id}_{n}'})]
+
+
+def _sticker(user_id: int, n: int):
+    return [private_message(user_id, sticker={'file_id': f'sticker{n}', 'file_unique_id': f's{n}',
+                                              'type': 'regular', 'width': 512, 'height': 512,
+                                              'is_animated': False, 'is_video': False})]
+
+
+def _voice(user_id: int, n: int):
+    return [private_message(user_id, voice={'file_id': f'voice{user_id}_{n}',
+                                            'file_unique_id': f'v{user_id}_{n}', 'duration': 3})]
+
+
+def _album(user_id: int, n: int):
+    group = f'album{user_id}_{n}'
+    return [_photo(user_id, n * 10 + part, media_group_id=group)[0] for part in range(3)]
+
+
+MESSAGE_KINDS = {
+    'text': lambda user_id, n: [private_message(user_id, f"Сообщение {n} от пользователя {user_id}")],
+    'photo': _photo,
+    'document': _document,
+    'sticker': _sticker,
+    'voice': _voice,
+    'album': _album,
+}
+
+
+def make_user_traffic(users: int, messages: int, mix: Dict[str, int], rng: random.Random):
+    """Сообщения пользователей вперемешку, но по порядку внутри каждого пользователя"""
+    kinds, weights = zip(*mix.items())
+    traffic = []
+    for n in range(messages):
+        user_id = 10_000 + rng.randrange(users)
+        kind = rng.choices(kinds, weights)[0]
+        traffic.extend((kind, data) for data in MESSAGE_KINDS[kind](user_id, n))
+    return traffic
+
+
+# ========== ЗАМЕРЫ ==========
+class Recorder:
+    """Время обработчиков и методов Database"""
+
+    def __init__(self):
+        self.handler_times: Dict[str, List[float]] = defaultdict(list)
+        self.database_time: Counter = Counter()
+        self.database_calls: Counter = Counter()
+        self.handled = 0
+
+    def wrap_handlers(self, application):
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                handler.callback = self._timed_handler(handler.callback)
+
+    def _timed_handler(self, callback):
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                self.handler_times[callback.__name__].append(time.perf_counter() - started)
+                self.handled += 1
+        return wrapper
+
+    def wrap_database(self, database):
+        for name in DATABASE_METHODS:
+            setattr(database, name, self._timed_method(name, getattr(database, name)))
+
+    def _timed_method(self, name, method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                self.database_time[name] += time.perf_counter() - started
+                self.database_calls[name] += 1
+        return wrapper
+
+
+async def replay(api: FakeBotAPI, recorder: Recorder, updates: List[Dict[str, Any]],
+                 timeout: float):
+    """Отдать обновления боту и дождаться, пока все будет обработано и отправлено"""
+    expected = recorder.handled + len(updates)
+    for data in updates:
+        api.put_update(data)
+    deadline = time.monotonic() + timeout
+    while recorder.handled < expected:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"обработано {recorder.handled} из {expected} обновлений")
+        await asyncio.sleep(0.01)
+    await bot.get_relay().drain()
+
+
+async def run_load_test(args) -> Dict[str, Any]:
+    api = FakeBotAPI(latency=args.latency, flood_rate=args.flood_rate,
+                     retry_after=args.retry_after, seed=args.seed)
+    await api.start()
+
+    bot.STORAGE_BACKEND = args.backend
+    bot.METRICS_PORT = None  # Тест может идти рядом с работающим ботом
+    application = bot.build_application(FAKE_TOKEN, base_url=api.base_url,
+                                        rate_limits=args.rate_limits, flood_control=False)
+    recorder = Recorder()
+    recorder.wrap_handlers(application)
+
+    await application.initialize()
+    await application.post_init(application)
+    await bot.get_database().add_group(ADMIN_GROUP_ID)
+    recorder.wrap_database(bot.get_database())
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+
+    rng = random.Random(args.seed)
+    traffic = make_user_traffic(args.users, args.messages, args.mix, rng)
+    calls_before = sum(api.calls.values())
+
+    # Фаза 1: пользователи пишут (первые сообщения создают темы)
+    started = time.perf_counter()
+    await replay(api, recorder, [data for _, data in traffic], args.timeout)
+
+    # Фаза 2: админы отвечают части пользователей
+    database = bot.get_database()
+    user_ids = sorted({data['message']['from']['id'] for _, data in traffic})
+    replies = []
+    for user_id in rng.sample(user_ids, int(len(user_ids) * args.reply_ratio)):
+        # Мимо замеров: это запрос самого теста, а не бота
+        topic = await bot.Database.get_user_topic(database, user_id)
+        if topic:
+            replies.append(group_reply(*topic, ADMIN_ID,
+                                       f"Ответ пользователю {user_id}", reply_to_message_id=1))
+    await replay(api, recorder, replies, args.timeout)
+    elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await api.stop()
+
+    updates = len(traffic) + len(replies)
+    api_calls = Counter({method: count for method, count in api.calls.items()
+                         if method not in SERVICE_METHODS})
+    all_times = [t for times in recorder.handler_times.values() for t in times]
+    return {
+        'config': {
+            'users': args.users, 'messages': args.messages, 'mix': args.mix,
+            'reply_ratio': args.reply_ratio, 'latency': args.latency,
+            'flood_rate': args.flood_rate, 'retry_after': args.retry_after,
+            'rate_limits': args.rate_limits, 'backend': args.backend, 'seed': args.seed,
+        },
+        'updates': updates,
+        'user_messages': dict(Counter(kind for kind, _ in traffic)),
+        'admin_replies': len(replies),
+        'elapsed': elapsed,
+        'updates_per_second': updates / elapsed,
+        'handler_latency': {
+            'p50': percentile(all_times, 0.50),
+            'p99': percentile(all_times, 0.99),
+            'max': max(all_times, default=0.0),
+            'by_handler': {name: {'count': len(times),
+                                  'p50': percentile(times, 0.50),
+                                  'p99': percentile(times, 0.99)}
+                           for name, times in recorder.handler_times.items()},
+        },
+        'api_calls': dict(api_calls),
+        'api_calls_total': sum(api.calls.values()) - calls_before,
+        'api_calls_per_update': sum(api_calls.values()) / updates,
+        'api_flood_errors': api.flood_errors,
+        'database': {
+            'total_time': sum(recorder.database_time.values()),
+            'calls': dict(recorder.database_calls),
+            'time': dict(recorder.database_time),
+        },
+    }
+
+
+def print_summary(result: Dict[str, Any]):
+    latency = result['handler_latency']
+    print("\n" + "=" * 50)
+    print(f"Обновлений:             {result['updates']} за {result['elapsed']:.2f} с")
+    print(f"Пропускная способность: {result['updates_per_second']:.1f} обновлений/с")
+    print(f"Задержка обработчиков:  p50 {latency['p50'] * 1000:.2f} мс, "
+          f"p99 {latency['p99'] * 1000:.2f} мс")
+    print(f"Вызовов API на обновление: {result['api_calls_per_update']:.2f} "
+          f"(429: {result['api_flood_errors']})")
+    for method, count in sorted(result['api_calls'].items()):
+        print(f"  {method:<20} {count}")
+    print(f"Время в Database:       {result['database']['total_time'] * 1000:.1f} мс")
+    print("=" * 50)
+
+
+async def main(args):
+    """
+    Основная асинхронная функция
+    """
+    print(f"⏱ {args.messages} сообщений от {args.users} пользователей, "
+          f"задержка API {args.latency * 1000:.0f} мс, 429 в {args.flood_rate:.0%} отправок...")
+    result = await run_load_test(args)
+    print_summary(result)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены в {args.output}")
+
+
+def run_script():
+    """
+    Запускает асинхронную функцию
+    """
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальном Bot API")
+    parser.add_argument('--users', type=int, default=200, help="Количество пользователей")
+    parser.add_argument('--messages', type=int, default=2000, help="Количество сообщений пользователей")
+    parser.add_argument('--mix', type=parse_mix,
+                        default='text=70,photo=10,document=5,sticker=5,voice=5,album=5',
+                        help="Доли типов сообщений: text, photo, document, sticker, voice, album")
+    parser.add_argument('--reply-ratio', type=float, default=0.5,
+                        help="Доля пользователей, которым отвечает админ")
+    parser.add_argument('--latency', type=float, default=0.02, help="Задержка Bot API, сек")
+    parser.add_argument('--flood-rate', type=float, default=0.0,
+                        help="Доля отправок, на которые Bot API отвечает 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429, сек")
+    parser.add_argument('--rate-limits', action='store_true',
+                        help="Включить планировщик отправки (с лимитами Telegram тест идет долго)")
+    parser.add_argument('--backend', choices=('shelve', 'sqlite'), default=bot.STORAGE_BACKEND,
+                        help="Хранилище базы")
+    parser.add_argument('--seed', type=int, default=1, help="Зерно генератора трафика")
+    parser.add_argument('--timeout', type=float, default=600, help="Сколько ждать обработки, сек")
+    parser.add_argument('--output', help="Файл для результатов в JSON")
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    # Все файлы базы создаются во временной папке
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    os.chdir(workdir)
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print("\n\n👋 Скрипт остановлен пользователем")
+    except TimeoutError as e:
+        print(f"❌ Тест не завершился: {e}")
+        sys.exit(1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    run_script()
@@ -0,0 +1,267 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import observe_api_call
+
+logger = logging.getLogger(__name__)
+
+# ========== ПРИОРИТЕТЫ ==========
+# Чем меньше число, тем раньше уйдет запрос при нехватке лимита
+PRIORITY_HIGH = 0  # Ответы админов пользователям
+PRIORITY_NORMAL = 10  # Пересылка сообщений пользователей, приветствия в новых темах и подтверждения
+PRIORITY_LOW = 20  # Переименование и закрытие тем, запас тем и прочий фон
+
+_sequence = itertools.count()
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Время ожидания из RetryAfter в секундах (int или timedelta в разных версиях PTB)"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+# ========== TOKEN BUCKET ==========
+class TokenBucket:
+    """Token bucket с очередью ожидающих по приоритету.
+
+    rate - сколько токенов добавляется в секунду, capacity - размер всплеска.
+    Когда токенов нет, ожидающие встают в кучу (приоритет, порядок прихода)
+    и будятся одним таймером, без активного опроса.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def waiting(self) -> int:
+        """Количество запросов, ожидающих токен"""
+        return len(self._waiters)
+
+    def is_idle(self) -> bool:
+        """Полный и без ожидающих - такой bucket можно удалить без потери состояния"""
+        self._refill(time.monotonic())
+        return (not self._waiters and self.tokens >= self.capacity
+                and self.blocked_until <= self.updated)
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _wait_time(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        wait = self.blocked_until - now
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return max(wait, 0.0)
+
+    def _pump(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters:
+            fut = self._waiters[0][2]
+            if fut.done():
+                heapq.heappop(self._waiters)
+                continue
+            wait = self._wait_time()
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._pump)
+                return
+            self.tokens -= 1
+            heapq.heappop(self._waiters)
+            fut.set_result(None)
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL):
+        """Дождаться токена; запросы с меньшим priority обслуживаются первыми"""
+        if not self._waiters and self._wait_time() == 0:
+            self.tokens -= 1
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(_sequence), fut))
+        self._pump()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Токен уже выдан, но ожидающего отменили - возвращаем
+                self.tokens += 1
+            self._pump()
+            raise
+
+    def block(self, seconds: float):
+        """Не выдавать токены seconds секунд (ответ RetryAfter от Telegram)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0)
+        if self._waiters:
+            self._pump()
+
+    def snapshot(self) -> Tuple[float, float]:
+        """Состояние для снимка: (токены, сколько еще секунд заблокирован)"""
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens, max(0.0, self.blocked_until - now)
+
+    def restore(self, state: Tuple[float, float], elapsed: float):
+        """Восстановить состояние из снимка, сделанного elapsed секунд назад"""
+        tokens, blocked_for = state
+        now = time.monotonic()
+        # Пока бот был остановлен, токены копились, а блокировка истекала
+        self.tokens = tokens
+        self.updated = now - elapsed
+        self.blocked_until = now + blocked_for - elapsed
+        self._refill(now)
+
+
+# ========== ПЛАНИРОВЩИК ОТПРАВКИ ==========
+class OutboundScheduler(BaseRateLimiter[Dict[str, Any]]):
+    """Планировщик всех исходящих запросов бота к Bot API.
+
+    Подключается через Application.builder().rate_limiter(...), поэтому
+    через него проходят все вызовы context.bot и update.message.reply_*.
+    Каждый запрос ждет токен в bucket своего чата (группы и личные чаты
+    имеют разные лимиты Telegram) и в общем bucket бота. Приоритет
+    задается через rate_limit_args={'priority': ...}. При RetryAfter чат
+    (или весь бот) приостанавливается на указанное время, и запрос
+    повторяется автоматически.
+    """
+
+    # Запросы без chat_id, которые не нужно ограничивать
+    UNLIMITED_ENDPOINTS = {'getMe', 'getChat', 'getChatAdministrators', 'getChatMember',
+                           'answerCallbackQuery', 'setWebhook', 'deleteWebhook'}
+
+    def __init__(self, global_rate: float = 30, group_rate: float = 20 / 60,
+                 group_burst: float = 3, private_rate: float = 1, private_burst: float = 3,
+                 max_retries: int = 3, max_buckets: int = 10_000):
+        self.global_rate = global_rate
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.max_retries = max_retries
+        self.max_buckets = max_buckets
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+
+    async def initialize(self):
+        """Ничего не нужно: bucket создаются по мере надобности"""
+
+    async def shutdown(self):
+        """Ничего не нужно: ожидающие запросы завершатся вместе с задачами бота"""
+
+    @property
+    def queue_depth(self) -> int:
+        """Сколько запросов сейчас ждут лимита"""
+        return self._global.waiting + sum(bucket.waiting for bucket in self._chats.values())
+
+    def _chat_bucket(self, chat_id: Any) -> Optional[TokenBucket]:
+        if not isinstance(chat_id, int):
+            # @username каналов и прочее - ограничиваем только общим лимитом
+            return None
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_buckets:
+                self._evict_idle()
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _evict_idle(self):
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.is_idle()]:
+            del self._chats[chat_id]
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Состояние лимитов для снимка (полные bucket не сохраняются - они как новые)"""
+        return {
+            'global': self._global.snapshot(),
+            'chats': {chat_id: bucket.snapshot() for chat_id, bucket in self._chats.items()
+                      if not bucket.is_idle()}
+        }
+
+    def restore(self, state: Dict[str, Any], elapsed: float):
+        """
+        Восстановить лимиты из снимка, сделанного elapsed секунд назад: после
+        быстрого перезапуска бот не начнет с полных bucket и не продолжит
+        слать в чаты, которым Telegram велел подождать (RetryAfter).
+        """
+        self._global.restore(state['global'], elapsed)
+        for chat_id, bucket_state in state['chats'].items():
+            bucket = self._chat_bucket(chat_id)
+            bucket.restore(bucket_state, elapsed)
+            if bucket.is_idle():
+                del self._chats[chat_id]
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ):
+        if endpoint in self.UNLIMITED_ENDPOINTS:
+            return await observe_api_call(endpoint, callback, *args, **kwargs)
+
+        priority = (rate_limit_args or {}).get('priority', PRIORITY_NORMAL)
+        chat_bucket = self._chat_bucket(data.get('chat_id'))
+
+        for attempt in range(self.max_retries + 1):
+            if chat_bucket:
+                await chat_bucket.acquire(priority)
+            await self._global.acquire(priority)
+            try:
+                return await observe_api_call(endpoint, callback, *args, **kwargs)
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                (chat_bucket or self._global).block(delay)
+                logger.warning(f"Flood limit on {endpoint} for chat {data.get('chat_id')}: "
+                               f"retry in {delay}s (attempt {attempt + 1})")
+                if attempt == self.max_retries:
+                    raise
+
+
+class PassThroughLimiter(BaseRateLimiter[Dict[str, Any]]):
+    """Ограничитель без лимитов: отправляет запросы сразу.
+
+    Нужен, когда лимиты отключены (нагрузочные тесты), но обработчики
+    все равно передают rate_limit_args - без ограничителя PTB на них падает.
+    """
+
+    async def initialize(self):
+        """Ничего не нужно"""
+
+    async def shutdown(self):
+        """Ничего не нужно"""
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ):
+        return await observe_api_call(endpoint, callback, *args, **kwargs)
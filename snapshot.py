@@ -0,0 +1,62 @@
+import logging
+import marshal
+import os
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Меняется, когда меняется состав снимка: снимок другой версии не читается
+SNAPSHOT_VERSION = 1
+
+
+def save_snapshot(filename: str, state: Dict[str, Any]):
+    """
+    Записать снимок состояния при остановке. marshal читается на порядок
+    быстрее, чем хранилище базы, но понимает только встроенные типы
+    (словари, кортежи, числа, строки) - их и должен содержать state.
+    Файл заменяется целиком через временный, поэтому оборванная запись
+    не оставит поврежденного снимка.
+    """
+    data = marshal.dumps({'version': SNAPSHOT_VERSION, 'saved_at': time.time(), **state})
+    tmp_file = f'{filename}.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, filename)
+
+
+def load_snapshot(filename: str) -> Optional[Dict[str, Any]]:
+    """
+    Прочитать снимок при запуске и удалить его: после запуска состояние
+    меняется, и этот же снимок при следующем запуске был бы устаревшим.
+    None - снимка нет или он не читается (тогда все загружается как обычно).
+    """
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning(f"Cannot read snapshot {filename}: {e}")
+        return None
+    try:
+        os.remove(filename)
+    except OSError as e:
+        logger.warning(f"Cannot remove snapshot {filename}: {e}")
+
+    try:
+        state = marshal.loads(data)
+    except (EOFError, ValueError, TypeError) as e:
+        logger.warning(f"Snapshot {filename} is damaged, ignoring it: {e}")
+        return None
+    if not isinstance(state, dict) or state.get('version') != SNAPSHOT_VERSION:
+        logger.warning(f"Snapshot {filename} has an unknown format, ignoring it")
+        return None
+    return state
+
+
+def snapshot_age(state: Dict[str, Any]) -> float:
+    """Сколько секунд прошло с записи снимка (сколько бот был остановлен)"""
+    return max(0.0, time.time() - state['saved_at'])
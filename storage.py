@@ -0,0 +1,647 @@
+import asyncio
+import glob
+import heapq
+import json
+import logging
+import os
+import pickle
+import queue
+import shelve
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+TopicRef = Tuple[int, int]  # (ID админской группы, ID темы)
+
+
+class TopicInfo(NamedTuple):
+    """Сведения о теме пользователя для статистики и закрытия старых тем"""
+    user_id: int
+    created_at: float  # Время создания (unix)
+    last_activity: float  # Время последнего сообщения в любую сторону
+    from_user: int = 0  # Сообщений от пользователя
+    from_admins: int = 0  # Ответов админов
+    first_response: Optional[float] = None  # Через сколько секунд пришел первый ответ
+    closed: bool = False  # Закрыта по неактивности (связь с пользователем сохраняется)
+
+
+# ========== ИЗМЕНЕНИЯ ==========
+class Changes:
+    """Пачка несохраненных изменений базы.
+
+    mappings: user_id -> (chat_id, topic_id) (None - связь удалена)
+    topics: (chat_id, topic_id) -> TopicInfo (None - сведения удалены)
+    values: прочие ключи (ID группы и т.п.), deleted_values - удаленные ключи
+    """
+
+    def __init__(self):
+        self.mappings: Dict[int, Optional[TopicRef]] = {}
+        self.topics: Dict[TopicRef, Optional[TopicInfo]] = {}
+        self.values: Dict[str, Any] = {}
+        self.deleted_values: Set[str] = set()
+
+    def __len__(self):
+        return len(self.mappings) + len(self.topics) + len(self.values) + len(self.deleted_values)
+
+    def set_mapping(self, user_id: int, topic: Optional[TopicRef]):
+        self.mappings[user_id] = topic
+
+    def set_topic(self, topic: TopicRef, info: Optional[TopicInfo]):
+        self.topics[topic] = info
+
+    def set_value(self, key: str, value: Any):
+        self.deleted_values.discard(key)
+        self.values[key] = value
+
+    def delete_value(self, key: str):
+        self.values.pop(key, None)
+        self.deleted_values.add(key)
+
+    def merge_older(self, older: 'Changes'):
+        """Вернуть в очередь изменения неудавшейся записи, не затирая более новые"""
+        for user_id, topic in older.mappings.items():
+            self.mappings.setdefault(user_id, topic)
+        for topic, info in older.topics.items():
+            self.topics.setdefault(topic, info)
+        for key, value in older.values.items():
+            if key not in self.values and key not in self.deleted_values:
+                self.values[key] = value
+        for key in older.deleted_values:
+            if key not in self.values:
+                self.deleted_values.add(key)
+
+
+# ========== ИНТЕРФЕЙС ХРАНИЛИЩА ==========
+class StorageBackend(ABC):
+    """Хранилище на диске, в которое Database сбрасывает изменения.
+
+    Все методы асинхронные: реальная работа с диском идет в пуле потоков,
+    чтобы не блокировать цикл событий бота.
+    """
+
+    @abstractmethod
+    async def open(self):
+        """Открыть хранилище"""
+
+    @abstractmethod
+    async def close(self):
+        """Закрыть хранилище"""
+
+    @abstractmethod
+    async def load_mappings(self) -> Dict[int, TopicRef]:
+        """Загрузить все связи user_id -> (chat_id, topic_id)"""
+
+    @abstractmethod
+    async def load_values(self) -> Dict[str, Any]:
+        """Загрузить все прочие ключи"""
+
+    @abstractmethod
+    async def load_topics(self) -> Dict[TopicRef, TopicInfo]:
+        """Загрузить сведения обо всех темах"""
+
+    @abstractmethod
+    async def get_topic(self, topic: TopicRef) -> Optional[TopicInfo]:
+        """Сведения о теме"""
+
+    @abstractmethod
+    async def idle_topics(self, before: float) -> List[TopicRef]:
+        """Темы без активности с момента before (unix)"""
+
+    @abstractmethod
+    async def get_user_topic(self, user_id: int) -> Optional[TopicRef]:
+        """Найти тему пользователя"""
+
+    @abstractmethod
+    async def get_user_by_topic(self, chat_id: int, topic_id: int) -> Optional[int]:
+        """Найти пользователя по теме в группе"""
+
+    @abstractmethod
+    async def user_ids(self, after: int, limit: int) -> List[int]:
+        """ID пользователей больше after по возрастанию, не больше limit штук"""
+
+    @abstractmethod
+    async def write(self, changes: Changes):
+        """Атомарно записать пачку изменений"""
+
+
+# ========== SHELVE ==========
+class ShelveBackend(StorageBackend):
+    """Хранилище на shelve (исходный формат bot_database.db).
+
+    Ключи: user_{id} -> (chat_id, topic_id), topic_{chat_id}_{topic_id} -> user_id,
+    topicinfo_{chat_id}_{topic_id} -> TopicInfo, остальные как есть. Базу
+    старого формата (одна группа: user_{id} -> topic_id) при открытии
+    один раз переводим в новый, считая все темы темами admin_group_id.
+    shelve не потокобезопасен, поэтому вся работа идет в одном потоке.
+    Пачка изменений сначала пишется в журнал, поэтому падение во время
+    записи не оставляет базу в промежуточном состоянии.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.journal_file = f'{filename}.journal'
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._db: Optional[shelve.Shelf] = None
+
+    async def _run(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shelve')
+        await self._run(self._open)
+
+    def _open(self):
+        self._db = shelve.open(self.filename)
+        self._replay_journal()
+        self._upgrade()
+
+    async def close(self):
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _replay_journal(self):
+        """Дописать в базу пачку, запись которой прервалась падением"""
+        if not os.path.exists(self.journal_file):
+            return
+        try:
+            with open(self.journal_file, 'rb') as f:
+                changes = pickle.load(f)
+        except Exception as e:
+            # Журнал появляется на диске только целиком (через rename),
+            # поэтому битый файл означает внешнее повреждение
+            logger.error(f"Error reading database journal: {e}")
+            return
+        self._apply(changes)
+        os.remove(self.journal_file)
+        logger.info(f"Database journal replayed: {len(changes)} changes")
+
+    def _upgrade(self):
+        """Перевести базу с одной группой в формат с несколькими группами"""
+        db = self._db
+        if db.get('storage_version', 1) >= 2:
+            return
+        keys = [key for key in db.keys() if key.startswith(('user_', 'topic_', 'topicinfo_'))]
+        group_id = db.get('admin_group_id')
+        if keys and group_id is None:
+            logger.warning("Database has topics but no admin_group_id, cannot upgrade it")
+            return
+        for key in keys:
+            prefix, _, suffix = key.partition('_')
+            if prefix == 'user':
+                if isinstance(db[key], int):
+                    db[key] = (group_id, db[key])
+            elif '_' not in suffix.lstrip('-'):
+                db[f'{prefix}_{group_id}_{suffix}'] = db.pop(key)
+        db['storage_version'] = 2
+        db.sync()
+        logger.info(f"Database upgraded to multi-group format: {len(keys)} keys")
+
+    @staticmethod
+    def _topic_suffix(topic: TopicRef) -> str:
+        return f'{topic[0]}_{topic[1]}'
+
+    @staticmethod
+    def _parse_topic(suffix: str) -> TopicRef:
+        chat_id, topic_id = suffix.rsplit('_', 1)
+        return int(chat_id), int(topic_id)
+
+    async def load_mappings(self) -> Dict[int, TopicRef]:
+        return await self._run(self._load_mappings)
+
+    def _load_mappings(self) -> Dict[int, TopicRef]:
+        # Ключи отбираем до чтения значений: значения других ключей не читаются с диска
+        return {int(key[len('user_'):]): tuple(self._db[key])
+                for key in self._db.keys() if key.startswith('user_')}
+
+    async def load_values(self) -> Dict[str, Any]:
+        return await self._run(self._load_values)
+
+    def _load_values(self) -> Dict[str, Any]:
+        return {key: self._db[key] for key in self._db.keys()
+                if not key.startswith(('user_', 'topic_', 'topicinfo_'))}
+
+    async def load_topics(self) -> Dict[TopicRef, TopicInfo]:
+        return await self._run(self._load_topics)
+
+    def _load_topics(self) -> Dict[TopicRef, TopicInfo]:
+        return {self._parse_topic(key[len('topicinfo_'):]): TopicInfo(*self._db[key])
+                for key in self._db.keys() if key.startswith('topicinfo_')}
+
+    async def get_topic(self, topic: TopicRef) -> Optional[TopicInfo]:
+        value = await self._run(self._db.get, f'topicinfo_{self._topic_suffix(topic)}')
+        return TopicInfo(*value) if value is not None else None
+
+    async def idle_topics(self, before: float) -> List[TopicRef]:
+        # В shelve нет индексов - полный просмотр (команда редкая)
+        topics = await self.load_topics()
+        return [topic for topic, info in topics.items()
+                if info.last_activity < before and not info.closed]
+
+    async def get_user_topic(self, user_id: int) -> Optional[TopicRef]:
+        value = await self._run(self._db.get, f'user_{user_id}')
+        return tuple(value) if value is not None else None
+
+    async def get_user_by_topic(self, chat_id: int, topic_id: int) -> Optional[int]:
+        return await self._run(self._db.get, f'topic_{chat_id}_{topic_id}')
+
+    async def user_ids(self, after: int, limit: int) -> List[int]:
+        return await self._run(self._user_ids, after, limit)
+
+    def _user_ids(self, after: int, limit: int) -> List[int]:
+        # В shelve нет порядка ключей - просматриваем все, но держим только limit
+        user_ids = (int(key[len('user_'):]) for key in self._db.keys() if key.startswith('user_'))
+        return heapq.nsmallest(limit, (user_id for user_id in user_ids if user_id > after))
+
+    async def write(self, changes: Changes):
+        await self._run(self._write, changes)
+
+    def _write(self, changes: Changes):
+        tmp_file = f'{self.journal_file}.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(changes, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.journal_file)
+        self._apply(changes)
+        os.remove(self.journal_file)
+
+    def _apply(self, changes: Changes):
+        db = self._db
+        for user_id, topic in changes.mappings.items():
+            old_topic = db.get(f'user_{user_id}')
+            if old_topic is not None and tuple(old_topic) != topic:
+                old_key = f'topic_{self._topic_suffix(old_topic)}'
+                if db.get(old_key) == user_id:
+                    del db[old_key]
+            if topic is None:
+                db.pop(f'user_{user_id}', None)
+            else:
+                db[f'user_{user_id}'] = tuple(topic)
+                db[f'topic_{self._topic_suffix(topic)}'] = user_id
+        for topic, info in changes.topics.items():
+            if info is None:
+                db.pop(f'topicinfo_{self._topic_suffix(topic)}', None)
+            else:
+                # Храним обычный tuple, чтобы формат не зависел от класса
+                db[f'topicinfo_{self._topic_suffix(topic)}'] = tuple(info)
+        for key in changes.deleted_values:
+            db.pop(key, None)
+        for key, value in changes.values.items():
+            db[key] = value
+        db.sync()
+
+
+# ========== SQLITE ==========
+class SQLitePool:
+    """Небольшой пул соединений SQLite, работающий в пуле потоков"""
+
+    def __init__(self, filename: str, size: int = 4):
+        self.filename = filename
+        self.size = size
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._connections: 'queue.SimpleQueue[sqlite3.Connection]' = queue.SimpleQueue()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.filename, check_same_thread=False, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='sqlite')
+        for _ in range(self.size):
+            self._connections.put(self._connect())
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        while not self._connections.empty():
+            self._connections.get().close()
+
+    def _call(self, func: Callable, args: tuple):
+        conn = self._connections.get()
+        try:
+            return func(conn, *args)
+        finally:
+            self._connections.put(conn)
+
+    async def run(self, func: Callable, *args):
+        """Выполнить func(conn, *args) на свободном соединении"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, args)
+
+
+class SQLiteBackend(StorageBackend):
+    """Хранилище на SQLite в режиме WAL.
+
+    Связи лежат в таблице users с индексами по user_id и (chat_id, topic_id),
+    сведения о темах - в таблице topics с индексом по времени активности,
+    прочие ключи - в таблице settings (значения в JSON). В режиме WAL
+    читатели не блокируют писателя, а файл можно безопасно открывать
+    из нескольких процессов.
+    """
+
+    TOPICS_TABLE = """
+        CREATE TABLE IF NOT EXISTS topics (
+            chat_id INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_activity REAL NOT NULL,
+            from_user INTEGER NOT NULL,
+            from_admins INTEGER NOT NULL,
+            first_response REAL,
+            closed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, topic_id)
+        )
+    """
+    TOPIC_COLUMNS = 'user_id, created_at, last_activity, from_user, from_admins, first_response, closed'
+    TOPIC_PLACEHOLDERS = ', '.join('?' * len(TOPIC_COLUMNS.split(', ')))
+
+    SCHEMA = TOPICS_TABLE + """;
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS users_chat_topic ON users (chat_id, topic_id);
+        CREATE INDEX IF NOT EXISTS topics_last_activity ON topics (last_activity);
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, filename: str, pool_size: int = 4):
+        self.filename = filename
+        self.pool = SQLitePool(filename, pool_size)
+
+    async def open(self):
+        self.pool.open()
+        await self.pool.run(self._upgrade)
+        await self.pool.run(lambda conn: conn.executescript(self.SCHEMA))
+
+    async def close(self):
+        self.pool.close()
+
+    @staticmethod
+    def _columns(conn: sqlite3.Connection, table: str) -> Set[str]:
+        return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+    def _upgrade(self, conn: sqlite3.Connection):
+        """
+        Добавить chat_id в таблицы базы с одной группой (темы - из admin_group_id)
+        и отметку closed в таблицу тем
+        """
+        # BEGIN IMMEDIATE: процессы вебхука открывают базу одновременно
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            users = self._columns(conn, 'users')
+            topics = self._columns(conn, 'topics')
+            if topics and 'closed' not in topics:
+                conn.execute('ALTER TABLE topics ADD COLUMN closed INTEGER NOT NULL DEFAULT 0')
+            old_users = bool(users) and 'chat_id' not in users
+            old_topics = bool(topics) and 'chat_id' not in topics
+            if old_users or old_topics:
+                value = self._fetch_one(conn, "SELECT value FROM settings WHERE key = 'admin_group_id'", ())
+                group_id = json.loads(value) if value is not None else 0
+            if old_users:
+                conn.execute('ALTER TABLE users ADD COLUMN chat_id INTEGER NOT NULL DEFAULT 0')
+                conn.execute('UPDATE users SET chat_id = ?', (group_id,))
+                conn.execute('DROP INDEX IF EXISTS users_topic_id')
+            if old_topics:
+                conn.execute('ALTER TABLE topics RENAME TO topics_old')
+                conn.execute('DROP INDEX IF EXISTS topics_last_activity')
+                conn.execute(self.TOPICS_TABLE)
+                conn.execute(f'INSERT INTO topics (chat_id, topic_id, {self.TOPIC_COLUMNS}) '
+                             f'SELECT ?, topic_id, {self.TOPIC_COLUMNS} FROM topics_old', (group_id,))
+                conn.execute('DROP TABLE topics_old')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if old_users or old_topics:
+            logger.info(f"Database {self.filename} upgraded to multi-group format")
+
+    async def load_mappings(self) -> Dict[int, TopicRef]:
+        rows = await self.pool.run(
+            lambda conn: conn.execute('SELECT user_id, chat_id, topic_id FROM users').fetchall()
+        )
+        return {user_id: (chat_id, topic_id) for user_id, chat_id, topic_id in rows}
+
+    async def load_values(self) -> Dict[str, Any]:
+        rows = await self.pool.run(
+            lambda conn: conn.execute('SELECT key, value FROM settings').fetchall()
+        )
+        return {key: json.loads(value) for key, value in rows}
+
+    async def load_topics(self) -> Dict[TopicRef, TopicInfo]:
+        rows = await self.pool.run(
+            lambda conn: conn.execute(
+                f'SELECT chat_id, topic_id, {self.TOPIC_COLUMNS} FROM topics').fetchall()
+        )
+        return {(row[0], row[1]): self._topic_info(row[2:]) for row in rows}
+
+    async def get_topic(self, topic: TopicRef) -> Optional[TopicInfo]:
+        row = await self.pool.run(
+            lambda conn: conn.execute(
+                f'SELECT {self.TOPIC_COLUMNS} FROM topics WHERE chat_id = ? AND topic_id = ?',
+                topic).fetchone()
+        )
+        return self._topic_info(row) if row else None
+
+    @staticmethod
+    def _topic_info(row: tuple) -> TopicInfo:
+        # closed хранится как 0/1
+        return TopicInfo(*row[:-1], closed=bool(row[-1]))
+
+    async def idle_topics(self, before: float) -> List[TopicRef]:
+        rows = await self.pool.run(
+            lambda conn: conn.execute('SELECT chat_id, topic_id FROM topics '
+                                      'WHERE last_activity < ? AND closed = 0', (before,)).fetchall()
+        )
+        return [tuple(row) for row in rows]
+
+    @staticmethod
+    def _fetch_one(conn: sqlite3.Connection, sql: str, args: tuple) -> Optional[Any]:
+        row = conn.execute(sql, args).fetchone()
+        return row[0] if row else None
+
+    async def get_user_topic(self, user_id: int) -> Optional[TopicRef]:
+        row = await self.pool.run(
+            lambda conn: conn.execute('SELECT chat_id, topic_id FROM users WHERE user_id = ?',
+                                      (user_id,)).fetchone()
+        )
+        return tuple(row) if row else None
+
+    async def get_user_by_topic(self, chat_id: int, topic_id: int) -> Optional[int]:
+        return await self.pool.run(
+            self._fetch_one, 'SELECT user_id FROM users WHERE chat_id = ? AND topic_id = ?',
+            (chat_id, topic_id)
+        )
+
+    async def user_ids(self, after: int, limit: int) -> List[int]:
+        rows = await self.pool.run(
+            lambda conn: conn.execute('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                                      (after, limit)).fetchall()
+        )
+        return [row[0] for row in rows]
+
+    async def count_users(self) -> int:
+        return await self.pool.run(self._fetch_one, 'SELECT COUNT(*) FROM users', ())
+
+    async def get_value(self, key: str) -> Optional[Any]:
+        value = await self.pool.run(
+            self._fetch_one, 'SELECT value FROM settings WHERE key = ?', (key,)
+        )
+        return json.loads(value) if value is not None else None
+
+    async def update_values(self, keys: Tuple[str, ...],
+                            update: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+        """Атомарно прочитать ключи, передать их в update и записать то, что он вернет.
+
+        Транзакция берет блокировку записи до чтения, поэтому процессы,
+        одновременно меняющие одни и те же ключи, не затирают друг друга.
+        Возвращает записанные значения.
+        """
+        return await self.pool.run(self._update_values, keys, update)
+
+    @staticmethod
+    def _update_values(conn: sqlite3.Connection, keys: Tuple[str, ...],
+                       update: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                f'SELECT key, value FROM settings WHERE key IN ({", ".join("?" * len(keys))})', keys
+            ).fetchall()
+            changes = update({key: json.loads(value) for key, value in rows})
+            conn.executemany(
+                'INSERT INTO settings (key, value) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                [(key, json.dumps(value)) for key, value in changes.items()]
+            )
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        return changes
+
+    async def write(self, changes: Changes):
+        await self.pool.run(self._write, changes)
+
+    @classmethod
+    def _write(cls, conn: sqlite3.Connection, changes: Changes):
+        with conn:
+            deleted = [(user_id,) for user_id, topic in changes.mappings.items() if topic is None]
+            updated = [(user_id, *topic) for user_id, topic in changes.mappings.items()
+                       if topic is not None]
+            conn.executemany('DELETE FROM users WHERE user_id = ?', deleted)
+            conn.executemany(
+                'INSERT INTO users (user_id, chat_id, topic_id) VALUES (?, ?, ?) '
+                'ON CONFLICT (user_id) DO UPDATE SET chat_id = excluded.chat_id, '
+                'topic_id = excluded.topic_id',
+                updated
+            )
+            conn.executemany('DELETE FROM topics WHERE chat_id = ? AND topic_id = ?',
+                             [topic for topic, info in changes.topics.items() if info is None])
+            conn.executemany(
+                f'INSERT OR REPLACE INTO topics (chat_id, topic_id, {cls.TOPIC_COLUMNS}) '
+                f'VALUES (?, ?, {cls.TOPIC_PLACEHOLDERS})',
+                [(*topic, *info) for topic, info in changes.topics.items() if info is not None]
+            )
+            conn.executemany('DELETE FROM settings WHERE key = ?',
+                             [(key,) for key in changes.deleted_values])
+            conn.executemany(
+                'INSERT INTO settings (key, value) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                [(key, json.dumps(value)) for key, value in changes.values.items()]
+            )
+
+    async def migrate_from_shelve(self, shelve_file: str) -> bool:
+        """Однократно перенести данные из старой базы shelve.
+
+        Возвращает True, если перенос был выполнен. Повторный вызов
+        ничего не делает: в settings остается отметка о миграции.
+        """
+        if await self.get_value('migrated_from_shelve'):
+            return False
+        if not glob.glob(f'{shelve_file}*') or await self.count_users():
+            return False
+
+        source = ShelveBackend(shelve_file)
+        await source.open()
+        try:
+            changes = Changes()
+            changes.mappings.update(await source.load_mappings())
+            changes.topics.update(await source.load_topics())
+            changes.values.update(await source.load_values())
+        finally:
+            await source.close()
+        changes.set_value('migrated_from_shelve', shelve_file)
+        await self.write(changes)
+        logger.info(f"Migrated {len(changes.mappings)} users from {shelve_file} to {self.filename}")
+        return True
+
+
+class TopicOwners:
+    """Поиск пользователя темы в базе SQLite для главного процесса вебхука.
+
+    Главный процесс не открывает базу целиком: он только отправляет
+    обновление процессу пользователя, поэтому читает связь из общего
+    файла синхронно (поиск по индексу) и запоминает найденные связи -
+    тема не переходит к другому пользователю. Не найденные не
+    запоминаются: связь новой темы появится в базе чуть позже.
+    """
+
+    def __init__(self, filename: str, cache_size: int = 100_000):
+        self.filename = filename
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[TopicRef, int]' = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def __call__(self, chat_id: int, topic_id: int) -> Optional[int]:
+        topic = (chat_id, topic_id)
+        user_id = self._cache.get(topic)
+        if user_id is not None:
+            self._cache.move_to_end(topic)
+            return user_id
+        try:
+            if self._conn is None:
+                self._conn = sqlite3.connect(f'file:{self.filename}?mode=ro', uri=True, timeout=1)
+            row = self._conn.execute('SELECT user_id FROM users WHERE chat_id = ? AND topic_id = ?',
+                                     topic).fetchone()
+        except sqlite3.Error as e:
+            # Базы еще нет или она занята - обновление уйдет по ключу темы
+            logger.warning(f"Cannot look up owner of topic {topic_id} in {chat_id}: {e}")
+            self.close()
+            return None
+        if row is None:
+            return None
+        self._cache[topic] = row[0]
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return row[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def create_backend(kind: str, shelve_file: str, sqlite_file: str, pool_size: int = 4) -> StorageBackend:
+    """Создать хранилище по названию из настроек ('shelve' или 'sqlite')"""
+    if kind == 'shelve':
+        return ShelveBackend(shelve_file)
+    if kind == 'sqlite':
+        return SQLiteBackend(sqlite_file, pool_size)
+    raise ValueError(f"Unknown storage backend: {kind}")
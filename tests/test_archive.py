@@ -0,0 +1,83 @@
+import asyncio
+import os
+
+import pytest
+
+from archive import Archive
+
+
+def append_messages(archive, count, topic=(-1001, 7)):
+    for number in range(count):
+        archive.append(5, topic, f'message {number:03d} ' + 'x' * 40)
+
+
+def texts(archive, topic=(-1001, 7)):
+    return [record['text'][:11] for record in archive.iter_records(topic=topic)]
+
+
+def test_export_by_topic_and_user(tmp_path):
+    async def main():
+        archive = Archive(str(tmp_path), block_size=200)
+        await archive.open()
+        append_messages(archive, 5)
+        archive.append(5, (-1001, 8), 'other topic')
+        archive.append(6, (-1001, 9), 'other user')
+        path = str(tmp_path / 'export.txt')
+        count = await archive.export(path, lambda record: record['text'], user_id=5)
+        await archive.close()
+        return archive, count, path
+
+    archive, count, path = asyncio.run(main())
+    assert count == 6
+    assert texts(archive) == [f'message {number:03d}' for number in range(5)]
+    with open(path, encoding='utf-8') as f:
+        assert f.read().splitlines()[-1] == 'other topic'
+
+
+def test_torn_tail_is_cut_and_unindexed_blocks_recovered(tmp_path):
+    async def main():
+        archive = Archive(str(tmp_path), block_size=200)
+        await archive.open()
+        append_messages(archive, 6)
+        await archive.flush()
+        segment = os.path.join(str(tmp_path), archive._segment)
+        # Сбой после записи блоков, но до индекса, и оборванный хвост
+        await archive._run(lambda: archive._conn.execute('DELETE FROM blocks').connection.commit())
+        await archive.close()
+        with open(segment, 'ab') as f:
+            f.write(b'\x00\x00\x10\x00torn')
+
+        reopened = Archive(str(tmp_path), block_size=200)
+        await reopened.open()
+        await reopened.close()
+        return reopened
+
+    assert texts(asyncio.run(main())) == [f'message {number:03d}' for number in range(6)]
+
+
+def test_failed_block_requeues_only_unwritten_records(tmp_path):
+    async def main():
+        archive = Archive(str(tmp_path), block_size=200)
+        await archive.open()
+        append_messages(archive, 8)
+        write_block = archive._write_block
+        calls = []
+
+        def failing_write_block(lines, records):
+            calls.append(len(records))
+            if len(calls) == 2:
+                archive._file.write(b'half a block')
+                raise OSError('no space left on device')
+            write_block(lines, records)
+
+        archive._write_block = failing_write_block
+        with pytest.raises(OSError):
+            await archive.flush()
+        left = len(archive._pending)
+        archive._write_block = write_block
+        await archive.close()
+        return archive, calls[0], left
+
+    archive, first_block, left = asyncio.run(main())
+    assert left == 8 - first_block
+    assert texts(archive) == [f'message {number:03d}' for number in range(8)]
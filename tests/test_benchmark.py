@@ -0,0 +1,17 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_webhook_benchmark_smoke():
+    """Замер polling и вебхука на фиктивном Bot API проходит до конца"""
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'script_benchmark_webhook.py'),
+         '--updates', '20', '--users', '5', '--workers', '2', '--latency', '0'],
+        cwd=ROOT, capture_output=True, text=True, timeout=300
+    )
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert 'polling:' in result.stdout
+    assert 'webhook x2' in result.stdout
@@ -0,0 +1,34 @@
+from telegram import MessageEntity
+
+from coalesce import merge_texts, utf16_len
+
+
+def entities(merged):
+    return [(entity.type, entity.offset, entity.length) for entity in merged.entities]
+
+
+def test_merge_joins_texts_and_shifts_entities():
+    merged = merge_texts([('😀a', [MessageEntity('bold', 0, 3)]),
+                          ('hi', [MessageEntity('italic', 0, 2)])])
+    assert len(merged) == 1
+    assert merged[0].text == '😀a\nhi'
+    assert merged[0].parts == [0, 1]
+    # Эмодзи - две единицы UTF-16, перевод строки - одна
+    assert entities(merged[0]) == [('bold', 0, 3), ('italic', 4, 2)]
+
+
+def test_merge_starts_new_message_at_limit():
+    merged = merge_texts([('a' * 5, []), ('b' * 5, []), ('c' * 3, [])], limit=11)
+    assert [chunk.text for chunk in merged] == ['aaaaa\nbbbbb', 'ccc']
+    assert [chunk.parts for chunk in merged] == [[0, 1], [2]]
+
+
+def test_long_text_is_split_without_breaking_surrogates():
+    # Граница limit приходится на середину первого эмодзи - он уходит во вторую часть
+    text = 'x' * 5 + '😀' * 3
+    merged = merge_texts([(text, [MessageEntity('bold', 3, 8)])], limit=6)
+    assert ''.join(chunk.text for chunk in merged) == text
+    assert all(utf16_len(chunk.text) <= 6 for chunk in merged)
+    assert all(chunk.parts == [0] for chunk in merged)
+    # Форматирование обрезается по границам частей
+    assert [entities(chunk) for chunk in merged] == [[('bold', 3, 2)], [('bold', 0, 6)]]
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from bot import Database
+from storage import SQLiteBackend
+
+
+def run_database(tmp_path, scenario, **options):
+    async def main():
+        db = Database(SQLiteBackend(str(tmp_path / 'db.sqlite')), **options)
+        await db.open()
+        try:
+            return await scenario(db)
+        finally:
+            await db.close()
+
+    return asyncio.run(main())
+
+
+async def collect(db, after=0, batch=1000):
+    return [user_id async for user_id in db.iter_users(after=after, batch=batch)]
+
+
+@pytest.mark.parametrize('preload', [True, False])
+def test_iter_users_resumes_after_cursor(tmp_path, preload):
+    async def scenario(db):
+        for user_id in (42, 7, 1000, 3, 15):
+            await db.set_user_topic(user_id, (-1001, user_id))
+        return await collect(db), await collect(db, after=7, batch=2), await collect(db, after=9, batch=2)
+
+    full, resumed, between = run_database(tmp_path, scenario, preload=preload)
+    assert full == [3, 7, 15, 42, 1000]
+    assert resumed == [15, 42, 1000]
+    assert between == [15, 42, 1000]
+
+
+def test_shared_workers_do_not_lose_each_others_groups(tmp_path):
+    async def main():
+        workers = [Database(SQLiteBackend(str(tmp_path / 'db.sqlite')), shared=True, worker=worker)
+                   for worker in range(2)]
+        for db in workers:
+            await db.open()
+        try:
+            await workers[0].add_group(-1000)
+            # Оба процесса меняют список, не видя изменений друг друга в памяти
+            await asyncio.gather(*(db.add_group(-1001 - number)
+                                   for number, db in enumerate(workers * 2)))
+            removed = await workers[1].remove_group(-1000)
+            again = await workers[0].add_group(-1001)
+            backend = workers[0].backend
+            return removed, again, await backend.get_value('admin_groups'), await backend.get_value('admin_group_id')
+        finally:
+            for db in workers:
+                await db.close()
+
+    removed, again, groups, main_group = asyncio.run(main())
+    assert removed and not again
+    assert sorted(groups, reverse=True) == [-1001, -1002, -1003, -1004]
+    assert main_group == -1000
+
+
+def test_first_added_group_becomes_main(tmp_path):
+    async def scenario(db):
+        added = [await db.add_group(-1001), await db.add_group(-1002), await db.add_group(-1001)]
+        await db.remove_group(-1001)
+        return added, db.get_groups(), db.get_value('admin_group_id')
+
+    assert run_database(tmp_path, scenario) == ([True, True, False], [-1002], -1001)
+
+
+@pytest.mark.parametrize('preload', [True, False])
+def test_iter_users_resumes_after_deleted_cursor(tmp_path, preload):
+    async def scenario(db):
+        for user_id in range(1, 8):
+            await db.set_user_topic(user_id, (-1001, user_id))
+        # Рассылка прервалась на пользователе 3, а он успел удалить тему
+        await db.delete_user(3)
+        return await collect(db, after=3, batch=3)
+
+    assert run_database(tmp_path, scenario, preload=preload) == [4, 5, 6, 7]
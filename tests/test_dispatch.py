@@ -0,0 +1,63 @@
+import asyncio
+import itertools
+
+from telegram import Update
+
+from dispatch import ConversationUpdateProcessor, conversation_key
+from fake_bot_api import group_reply, private_message
+
+_update_ids = itertools.count(1)
+
+
+def update(data):
+    return Update.de_json({'update_id': next(_update_ids), **data}, None)
+
+
+def test_conversation_key():
+    assert conversation_key(update(private_message(5, 'hi'))) == ('user', 5)
+    assert conversation_key(update(group_reply(-1001, 7, 1, 'ok', 3))) == ('topic', -1001, 7)
+    assert conversation_key(object()) is None
+
+
+def test_updates_of_one_conversation_keep_order():
+    async def main():
+        processor = ConversationUpdateProcessor(8)
+        handled = []
+
+        async def handle(number, delay):
+            await asyncio.sleep(delay)
+            handled.append(number)
+
+        user = [update(private_message(5, str(number))) for number in range(5)]
+        # Первые обработчики - самые медленные: без замка порядок бы перепутался
+        await asyncio.gather(*(processor.process_update(item, handle(number, 0.05 - number * 0.01))
+                               for number, item in enumerate(user)))
+        assert processor.active_conversations == 0
+        return handled
+
+    assert asyncio.run(main()) == [0, 1, 2, 3, 4]
+
+
+def test_burst_of_one_conversation_does_not_block_others():
+    async def main():
+        processor = ConversationUpdateProcessor(4)
+        release = asyncio.Event()
+        handled = []
+
+        async def slow():
+            await release.wait()
+
+        async def fast():
+            handled.append('other')
+
+        # Поток обновлений одного пользователя больше лимита одновременных обновлений
+        burst = [asyncio.create_task(processor.process_update(update(private_message(5, 'spam')), slow()))
+                 for _ in range(20)]
+        await asyncio.sleep(0.01)
+        assert processor.current_concurrent_updates == 1
+        await asyncio.wait_for(processor.process_update(update(private_message(6, 'hi')), fast()), 1)
+        release.set()
+        await asyncio.gather(*burst)
+        return handled
+
+    assert asyncio.run(main()) == ['other']
@@ -0,0 +1,43 @@
+from flood import FloodControl
+
+
+def test_burst_then_mute():
+    flood = FloodControl(rate=1, burst=3, mute=60)
+    assert [flood.check(1, now=0).allowed for _ in range(3)] == [True, True, True]
+    decision = flood.check(1, now=0)
+    assert not decision.allowed and decision.muted_for == 60
+    # Во время заглушения сообщения отбрасываются без нового заглушения
+    assert flood.check(1, now=30) == (False, 0.0)
+    assert flood.check(1, now=61).allowed
+
+
+def test_mute_doubles_up_to_max():
+    flood = FloodControl(rate=0.001, burst=1, mute=10, max_mute=25)
+    mutes, now = [], 0.0
+    for _ in range(4):
+        flood.check(1, now=now)
+        decision = flood.check(1, now=now)
+        mutes.append(decision.muted_for)
+        now += decision.muted_for + 1000
+    assert mutes == [10, 20, 25, 25]
+    throttled = flood.throttled(now=now)
+    assert [(user.user_id, user.strikes) for user in throttled] == [(1, 4)]
+
+
+def test_idle_users_are_forgotten():
+    flood = FloodControl(rate=1, burst=1, mute=10, max_mute=10, forget=100)
+    flood.check(1, now=0)
+    flood.check(1, now=0)
+    flood.check(2, now=200)
+    assert len(flood) == 1
+    # Забытый пользователь начинает заново с коротким заглушением
+    flood.check(1, now=200)
+    assert flood.check(1, now=200).muted_for == 10
+
+
+def test_release():
+    flood = FloodControl(rate=1, burst=1)
+    flood.check(1, now=0)
+    flood.check(1, now=0)
+    assert flood.release(1) == 1
+    assert flood.check(1, now=0).allowed
@@ -0,0 +1,62 @@
+import pytest
+from telegram import Message
+
+import bot
+from fake_bot_api import private_message
+
+
+def relay_item(text):
+    message = Message.de_json(private_message(5, text)['message'], None)
+    return bot.RelayItem(message, (-1001, 7), False, f'user:5:{message.message_id}')
+
+
+@pytest.fixture
+def coalescing(monkeypatch):
+    monkeypatch.setattr(bot, 'TEXT_COALESCE_WINDOW', 1.0)
+    monkeypatch.setattr(bot, 'MESSAGE_MAX_LENGTH', 10)
+
+
+def describe(sends):
+    return [([item.message.text for item in send.items], [item.key for item in send.done], send.parts)
+            for send in sends]
+
+
+def test_short_texts_are_merged_and_media_copied(coalescing):
+    items = [relay_item('one'), relay_item('two'), relay_item(None), relay_item('three')]
+    sends = bot.forward_sends(None, 5, (-1001, 7), items)
+    assert [[item.key for item in send.done] for send in sends] == [
+        [items[0].key, items[1].key], [items[2].key], [items[3].key]]
+    assert all(send.parts == [] for send in sends)
+
+
+def test_long_text_parts_get_own_keys_stable_on_retry(coalescing):
+    short, long, tail = relay_item('hi'), relay_item('x' * 25), relay_item('ok')
+    key = long.key
+    sends = bot.forward_sends(None, 5, (-1001, 7), [short, long, tail])
+    assert describe(sends) == [
+        (['hi'], [short.key], []),
+        (['x' * 25], [], [f'{key}#0']),
+        (['x' * 25], [], [f'{key}#1']),
+        (['x' * 25, 'ok'], [key, tail.key], []),
+    ]
+    # Повтор начинается с длинного текста: части режутся так же и сохраняют ключи
+    retry = bot.forward_sends(None, 5, (-1001, 7), [long, tail])
+    assert describe(retry) == describe(sends)[1:]
+    # Даже если длинный текст остался один
+    alone = bot.forward_sends(None, 5, (-1001, 7), [long])
+    assert [send.parts for send in alone] == [[f'{key}#0'], [f'{key}#1'], []]
+
+
+def test_coalescing_off_copies_everything(monkeypatch):
+    monkeypatch.setattr(bot, 'TEXT_COALESCE_WINDOW', 0)
+    items = [relay_item('one'), relay_item('two')]
+    sends = bot.forward_sends(None, 5, (-1001, 7), items)
+    assert describe(sends) == [(['one', 'two'], [item.key for item in items], [])]
+
+
+def test_text_length_is_counted_in_utf16(coalescing):
+    # Смайлик занимает в UTF-16 две единицы: 6 смайликов не влезают в лимит 10
+    emoji = relay_item('😀' * 6)
+    sends = bot.forward_sends(None, 5, (-1001, 7), [emoji])
+    assert [send.parts for send in sends] == [[f'{emoji.key}#0'], []]
+    assert bot.forward_sends(None, 5, (-1001, 7), [relay_item('😀' * 5)])[0].parts == []
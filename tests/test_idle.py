@@ -0,0 +1,71 @@
+import asyncio
+import time
+
+from idle import IdleScheduler
+
+
+def run_scheduler(timeout, actions, wait):
+    async def main():
+        fired = []
+
+        async def on_idle(key):
+            fired.append(key)
+
+        scheduler = IdleScheduler(timeout, on_idle)
+        scheduler.start()
+        actions(scheduler)
+        await asyncio.sleep(wait)
+        await scheduler.stop()
+        return fired, scheduler
+
+    return asyncio.run(main())
+
+
+def test_fires_once_after_timeout():
+    fired, scheduler = run_scheduler(0.05, lambda scheduler: scheduler.touch('a'), 0.15)
+    assert fired == ['a']
+    assert len(scheduler) == 0
+
+
+def test_activity_postpones_deadline():
+    async def main():
+        fired = []
+
+        async def on_idle(key):
+            fired.append(key)
+
+        scheduler = IdleScheduler(0.1, on_idle)
+        scheduler.start()
+        scheduler.touch('a')
+        await asyncio.sleep(0.06)
+        scheduler.touch('a')
+        await asyncio.sleep(0.06)
+        assert fired == []
+        await asyncio.sleep(0.1)
+        await scheduler.stop()
+        return fired
+
+    assert asyncio.run(main()) == ['a']
+
+
+def test_earlier_deadline_is_honoured():
+    def actions(scheduler):
+        scheduler.touch('a')
+        # Более старая активность (например, при загрузке тем) - срок ближе
+        scheduler.touch('a', time.time() - 9.9)
+
+    fired, _ = run_scheduler(10, actions, 0.3)
+    assert fired == ['a']
+
+
+def test_forgotten_keys_do_not_fire_and_heap_is_compacted():
+    def actions(scheduler):
+        for key in range(1000):
+            scheduler.touch(key)
+            scheduler.forget(key)
+        scheduler.touch('kept')
+
+    fired, scheduler = run_scheduler(0.05, actions, 0.01)
+    assert fired == []
+    assert len(scheduler) == 1
+    assert len(scheduler._heap) <= 2
@@ -0,0 +1,24 @@
+import asyncio
+
+from message_index import MessageIndex, _pack, _unpack
+
+
+def test_pack_roundtrip():
+    for chat_id, message_id in [(5, 1), (-1001234567890, 2**31 + 7), (123456789, 0xFFFFFFFF)]:
+        assert _unpack(_pack(chat_id, message_id)) == (chat_id, message_id)
+
+
+def test_lookups_both_ways_and_from_disk(tmp_path):
+    async def main():
+        index = MessageIndex(str(tmp_path / 'messages.sqlite3'), capacity=2)
+        await index.open()
+        for message_id in range(1, 4):
+            await index.add(5, message_id, -1001, 100 + message_id)
+        assert await index.get_group_message(5, 3) == (-1001, 103)
+        assert await index.get_private_message(-1001, 103) == (5, 3)
+        # Первая связь вытеснена из памяти - читается с диска
+        assert await index.get_group_message(5, 1) == (-1001, 101)
+        assert await index.get_group_message(5, 99) is None
+        await index.close()
+
+    asyncio.run(main())
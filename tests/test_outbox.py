@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest, NetworkError
+
+from outbox import DEAD, DONE, PENDING, DeliveryPostponed, Outbox, part_key
+
+
+def run_outbox(tmp_path, scenario, **kwargs):
+    async def main():
+        outbox = Outbox(str(tmp_path / 'outbox.sqlite3'), **kwargs)
+        await outbox.open()
+        try:
+            return await scenario(outbox)
+        finally:
+            await outbox.close()
+
+    return asyncio.run(main())
+
+
+async def fail():
+    raise NetworkError('connection reset')
+
+
+async def succeed():
+    return [42]
+
+
+def test_duplicate_keys_are_not_journaled_twice(tmp_path):
+    async def scenario(outbox):
+        return await outbox.add('user:1:1', 'to_topic', {}), await outbox.add('user:1:1', 'to_topic', {})
+
+    assert run_outbox(tmp_path, scenario) == (True, False)
+
+
+def test_retryable_error_postpones_without_waiting(tmp_path):
+    async def scenario(outbox):
+        await outbox.add('user:1:1', 'to_topic', {})
+        with pytest.raises(DeliveryPostponed) as postponed:
+            await outbox.deliver(['user:1:1'], fail)
+        pending = await outbox.pending()
+        result = await outbox.deliver(['user:1:1'], succeed)
+        return postponed.value.delay, pending, result, await outbox.counts()
+
+    delay, pending, result, counts = run_outbox(tmp_path, scenario, base_delay=2.0)
+    assert 1.0 <= delay <= 2.0
+    assert [(entry.key, entry.attempts) for entry in pending] == [('user:1:1', 1)]
+    assert result == [42]
+    assert counts == {DONE: 1}
+
+
+def test_gives_up_after_max_attempts_and_revives(tmp_path):
+    async def scenario(outbox):
+        await outbox.add('user:1:1', 'to_topic', {'n': 1})
+        for _ in range(2):
+            with pytest.raises(DeliveryPostponed):
+                await outbox.deliver(['user:1:1'], fail)
+        with pytest.raises(NetworkError):
+            await outbox.deliver(['user:1:1'], fail)
+        dead = await outbox.dead()
+        revived = await outbox.revive()
+        return dead, revived, await outbox.pending(), await outbox.counts()
+
+    dead, revived, pending, counts = run_outbox(tmp_path, scenario, max_attempts=3)
+    assert [(entry.attempts, entry.error) for entry in dead] == [(3, 'NetworkError: connection reset')]
+    assert [entry.payload for entry in revived] == [{'n': 1}]
+    assert [(entry.key, entry.attempts) for entry in pending] == [('user:1:1', 0)]
+    assert counts == {PENDING: 1}
+
+
+def test_permanent_error_is_dead_at_once(tmp_path):
+    async def scenario(outbox):
+        await outbox.add('reply:1:1', 'to_user', {})
+
+        async def bad_request():
+            raise BadRequest('message to copy not found')
+
+        with pytest.raises(BadRequest):
+            await outbox.deliver(['reply:1:1'], bad_request)
+        return await outbox.counts()
+
+    assert run_outbox(tmp_path, scenario) == {DEAD: 1}
+
+
+def test_stopped_outbox_postpones_until_restart(tmp_path):
+    async def scenario(outbox):
+        await outbox.add('user:1:1', 'to_topic', {})
+        outbox.stop()
+        with pytest.raises(DeliveryPostponed) as postponed:
+            await outbox.deliver(['user:1:1'], fail)
+        return postponed.value.delay
+
+    assert run_outbox(tmp_path, scenario) is None
+
+
+def test_split_text_parts_are_remembered_until_the_last_one(tmp_path):
+    async def scenario(outbox):
+        await outbox.add('user:1:1', 'to_topic', {})
+        first = part_key('user:1:1', 0)
+        await outbox.deliver([], succeed, [first])
+        with pytest.raises(DeliveryPostponed):
+            await outbox.deliver(['user:1:1'], fail)
+        # Повтор знает, что начало текста уже дошло, а запись ждет последней части
+        delivered = await outbox.delivered([first, part_key('user:1:1', 1)])
+        pending = [entry.key for entry in await outbox.pending()]
+        await outbox.deliver(['user:1:1'], succeed)
+        return delivered, pending, await outbox.counts()
+
+    delivered, pending, counts = run_outbox(tmp_path, scenario)
+    assert delivered == {'user:1:1#0'}
+    assert pending == ['user:1:1']
+    assert counts == {DONE: 1}
+
+
+def test_failed_part_is_counted_in_its_entry(tmp_path):
+    async def scenario(outbox):
+        await outbox.add('user:1:1', 'to_topic', {})
+        with pytest.raises(DeliveryPostponed):
+            await outbox.deliver([], fail, [part_key('user:1:1', 0)])
+        return await outbox.pending()
+
+    assert [(entry.key, entry.attempts) for entry in run_outbox(tmp_path, scenario)] == [('user:1:1', 1)]
@@ -0,0 +1,81 @@
+import asyncio
+
+from relay import RelayBuffer
+
+
+def test_messages_within_window_go_in_one_batch():
+    async def main():
+        batches = []
+
+        async def flush(key, items):
+            batches.append((key, items))
+
+        buffer = RelayBuffer(flush, window=0.05)
+        for item in range(3):
+            buffer.add(1, item)
+        buffer.add(2, 'x')
+        await buffer.drain()
+        return batches
+
+    assert sorted(asyncio.run(main())) == [(1, [0, 1, 2]), (2, ['x'])]
+
+
+def test_batch_is_split_by_max_batch():
+    async def main():
+        batches = []
+
+        async def flush(key, items):
+            batches.append(items)
+
+        buffer = RelayBuffer(flush, window=0.01, max_batch=2)
+        for item in range(5):
+            buffer.add(1, item)
+        await buffer.drain()
+        return batches
+
+    assert asyncio.run(main()) == [[0, 1], [2, 3], [4]]
+
+
+def test_messages_during_flush_form_next_batch():
+    async def main():
+        batches = []
+
+        async def flush(key, items):
+            batches.append(items)
+            await asyncio.sleep(0.05)
+
+        buffer = RelayBuffer(flush)
+        buffer.add(1, 'a')
+        await asyncio.sleep(0.01)
+        buffer.add(1, 'b')
+        buffer.add(1, 'c')
+        await buffer.drain()
+        return batches
+
+    assert asyncio.run(main()) == [['a'], ['b', 'c']]
+
+
+def test_deferred_items_keep_order_with_new_ones():
+    async def main():
+        sent = []
+        failures = [2]
+
+        async def flush(key, items):
+            for position, item in enumerate(items):
+                if item in failures:
+                    failures.remove(item)
+                    buffer.defer(key, items[position:], 0.05)
+                    return
+                sent.append(item)
+
+        buffer = RelayBuffer(flush)
+        for item in (1, 2, 3):
+            buffer.add(1, item)
+        await asyncio.sleep(0.01)
+        buffer.add(1, 4)
+        assert sent == [1] and buffer.depth == 3
+        await asyncio.sleep(0.1)
+        await buffer.drain()
+        return sent
+
+    assert asyncio.run(main()) == [1, 2, 3, 4]
@@ -0,0 +1,94 @@
+import asyncio
+import json
+import sqlite3
+
+from fake_bot_api import group_reply, private_message
+from http_server import Request
+from storage import TopicOwners
+from webhook import SECRET_HEADER, WebhookServer, choose_worker, partition_key
+
+
+def test_private_chat_and_its_topic_go_to_the_same_worker():
+    owners = {(-1001, 7): 5}.get
+
+    def owner(chat_id, topic_id):
+        return owners((chat_id, topic_id))
+
+    private, reply = private_message(5, 'hi'), group_reply(-1001, 7, 1, 'ok', 3)
+    assert partition_key(reply, owner) == partition_key(private) == 'user:5'
+    for workers in (2, 3, 8):
+        assert choose_worker(reply, workers, owner) == choose_worker(private, workers)
+    # Тема без известного пользователя - по ключу темы
+    assert partition_key(group_reply(-1001, 8, 1, 'ok', 3), owner) == 'topic:-1001:8'
+
+
+def test_topic_owners_reads_shared_database(tmp_path):
+    filename = str(tmp_path / 'bot.sqlite3')
+    owners = TopicOwners(filename)
+    assert owners(-1001, 7) is None
+
+    conn = sqlite3.connect(filename)
+    conn.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, chat_id INTEGER, topic_id INTEGER)')
+    conn.execute('INSERT INTO users VALUES (5, -1001, 7)')
+    conn.commit()
+    assert owners(-1001, 7) == 5
+    conn.execute('DELETE FROM users')
+    conn.commit()
+    # Найденная связь запоминается
+    assert owners(-1001, 7) == 5
+    assert owners(-1001, 8) is None
+    owners.close()
+    conn.close()
+
+
+class FakeProcess:
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.name = 'webhook-worker-test'
+        self.exitcode = None if alive else -9
+
+    def is_alive(self):
+        return self.alive
+
+
+def webhook_request(data):
+    body = json.dumps(data).encode()
+    return Request('POST', '/webhook', {SECRET_HEADER: 'secret', 'content-type': 'application/json'}, body)
+
+
+def make_server(queue_size=10):
+    server = WebhookServer(None, 1, 'secret', queue_size=queue_size)
+    server._queues = [server._context.Queue(queue_size)]
+    server._processes = [FakeProcess()]
+    spawned = []
+
+    def spawn(index):
+        spawned.append(index)
+        return FakeProcess()
+
+    server._spawn = spawn
+    return server, spawned
+
+
+def test_dead_worker_is_restarted_and_update_retried():
+    server, spawned = make_server()
+    server._processes[0].alive = False
+    response = asyncio.run(server.handle(webhook_request({'update_id': 1, **private_message(5, 'hi')})))
+    assert response.status == 503
+    assert spawned == [0]
+    response = asyncio.run(server.handle(webhook_request({'update_id': 2, **private_message(5, 'hi')})))
+    assert response.status == 200
+
+
+def test_full_queue_asks_telegram_to_retry():
+    server, _ = make_server(queue_size=1)
+    statuses = [asyncio.run(server.handle(webhook_request({'update_id': number, **private_message(5, 'hi')}))).status
+                for number in range(2)]
+    assert statuses == [200, 503]
+
+
+def test_wrong_secret_is_rejected():
+    server, _ = make_server()
+    request = webhook_request(private_message(5, 'hi'))
+    request.headers[SECRET_HEADER] = 'wrong'
+    assert asyncio.run(server.handle(request)).status == 403
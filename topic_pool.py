@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from telegram.error import BadRequest, Forbidden
+
+logger = logging.getLogger(__name__)
+
+
+class TopicPool:
+    """Запас заранее созданных тем в каждой админской группе.
+
+    Новое обращение забирает готовую тему (take() - без запросов к Telegram),
+    а фоновая задача досоздает темы через create(chat_id), когда в группе
+    их остается low или меньше, и пополняет запас до high. Состояние - списки
+    ID тем по группам - после каждого изменения передается в on_change,
+    чтобы пережить перезапуск. Группы берутся из groups() при каждом
+    пополнении, поэтому новые группы подхватываются сами.
+    """
+
+    def __init__(self, create: Callable[[int], Awaitable[int]], groups: Callable[[], List[int]],
+                 low: int = 2, high: int = 5, on_change: Optional[Callable[[Dict[int, List[int]]], Any]] = None,
+                 retry_delay: float = 60.0):
+        self._create = create
+        self._groups = groups
+        self.low = low
+        self.high = high
+        self._on_change = on_change
+        self.retry_delay = retry_delay
+        self._topics: Dict[int, List[int]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def load(self, state: Optional[Dict[Any, List[int]]]):
+        """Восстановить запас из сохраненного состояния (ключи - ID групп, в JSON строкой)"""
+        self._topics = {int(chat_id): list(topics) for chat_id, topics in (state or {}).items() if topics}
+
+    def state(self) -> Dict[int, List[int]]:
+        return {chat_id: list(topics) for chat_id, topics in self._topics.items() if topics}
+
+    def available(self, chat_id: Optional[int] = None) -> int:
+        """Сколько готовых тем в группе (без chat_id - во всех группах)"""
+        if chat_id is None:
+            return sum(len(topics) for topics in self._topics.values())
+        return len(self._topics.get(chat_id, ()))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        self.refill()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def refill(self):
+        """Проверить запас всех групп (например, после добавления группы)"""
+        self._wakeup.set()
+
+    async def _changed(self):
+        if self._on_change:
+            await self._on_change(self.state())
+
+    async def take(self, chat_id: int) -> Optional[int]:
+        """Забрать готовую тему в группе; None - запас пуст"""
+        topics = self._topics.get(chat_id)
+        if not topics:
+            self.refill()
+            return None
+        topic_id = topics.pop(0)
+        if len(topics) <= self.low:
+            self.refill()
+        await self._changed()
+        return topic_id
+
+    async def _fill(self, chat_id: int):
+        topics = self._topics.setdefault(chat_id, [])
+        while len(topics) < self.high:
+            topic_id = await self._create(chat_id)
+            topics.append(topic_id)
+            await self._changed()
+
+    async def _run(self):
+        failed = False
+        while True:
+            if failed:
+                # Не долбим Telegram, пока группа недоступна
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.retry_delay)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self._wakeup.wait()
+            self._wakeup.clear()
+
+            failed = False
+            for chat_id in self._groups():
+                if self.available(chat_id) > self.low:
+                    continue
+                try:
+                    await self._fill(chat_id)
+                except (BadRequest, Forbidden) as e:
+                    # Бота убрали из группы или у него нет права управлять темами
+                    logger.warning(f"Cannot fill topic pool in {chat_id}: {e}")
+                    failed = True
+                except Exception as e:
+                    logger.error(f"Error filling topic pool in {chat_id}: {e}")
+                    failed = True
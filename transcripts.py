@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import re
+import sqlite3
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+from storage import SQLitePool
+
+logger = logging.getLogger(__name__)
+
+# Границы найденных слов во фрагменте
+MATCH_START = '['
+MATCH_END = ']'
+
+
+class SearchHit(NamedTuple):
+    """Найденное сообщение переписки"""
+    user_id: int
+    chat_id: int
+    topic_id: int
+    from_admin: bool
+    created_at: float
+    snippet: str  # Фрагмент текста вокруг найденных слов
+
+
+def match_query(text: str) -> Optional[str]:
+    """
+    Запрос FTS5 из того, что ввел админ: все слова должны встретиться,
+    слово со звездочкой в конце (оплат*) - как начало слова. Слова берутся
+    в кавычки, поэтому синтаксис FTS5 во вводе не ломает запрос.
+    None - искать нечего.
+    """
+    terms = re.findall(r'(\w+)(\*?)', text.replace('ё', 'е').replace('Ё', 'Е'))
+    return ' '.join(f'"{term}"{star}' for term, star in terms) or None
+
+
+class Transcripts:
+    """Полнотекстовый архив переписки в SQLite FTS5.
+
+    Тексты сообщений пользователей и ответов админов копятся в памяти
+    (add() ничего не ждет) и раз в flush_interval секунд пишутся на диск
+    пачкой в потоке пула соединений. Индекс FTS5 - внешний (content=) к
+    таблице messages и пополняется триггером в той же транзакции, поэтому
+    текст хранится один раз, а индексируется только новое. Поиск идет
+    от свежих сообщений к старым и останавливается на limit совпадениях,
+    так что его время почти не растет вместе с архивом (кроме поиска по
+    началу слова: такие запросы перебирают все подходящие слова индекса).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL,
+            from_admin INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts5(
+            text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        );
+        -- Токенизатор не считает "ё" и "е" одной буквой - в индекс идет текст с "е"
+        CREATE TRIGGER IF NOT EXISTS messages_indexed AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_text (rowid, text)
+            VALUES (new.id, replace(replace(new.text, 'ё', 'е'), 'Ё', 'Е'));
+        END;
+    """
+
+    def __init__(self, filename: str, flush_interval: float = 1.0):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.pool = SQLitePool(filename, size=2)
+        # Еще не записанные сообщения: (пользователь, группа, тема, от админа, время, текст)
+        self._pending: List[Tuple[int, int, int, int, float, str]] = []
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def open(self):
+        self.pool.open()
+        await self.pool.run(self._create)
+        self._task = asyncio.create_task(self._flush_loop())
+
+    def _create(self, conn: sqlite3.Connection):
+        conn.executescript(self.SCHEMA)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        self.pool.close()
+
+    def add(self, user_id: int, topic: Tuple[int, int], text: Optional[str], from_admin: bool = False):
+        """Добавить текст сообщения переписки (запишется на диск в фоне; без текста - пропустить)"""
+        if text:
+            self._pending.append((user_id, topic[0], topic[1], int(from_admin), time.time(), text))
+
+    async def flush(self):
+        """Записать накопленные сообщения на диск"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            try:
+                await self.pool.run(self._write, pending)
+            except Exception:
+                # Не потеряем сообщения: допишем в следующий раз
+                self._pending = pending + self._pending
+                raise
+
+    @staticmethod
+    def _write(conn: sqlite3.Connection, rows: List[tuple]):
+        with conn:
+            conn.executemany('INSERT INTO messages (user_id, chat_id, topic_id, from_admin, created_at, text) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    async def search(self, text: str, limit: int = 10) -> List[SearchHit]:
+        """Последние limit сообщений со всеми словами запроса"""
+        query = match_query(text)
+        if query is None:
+            return []
+        # Только что добавленное тоже должно находиться
+        await self.flush()
+        return await self.pool.run(self._search, query, limit)
+
+    @staticmethod
+    def _search(conn: sqlite3.Connection, query: str, limit: int) -> List[SearchHit]:
+        try:
+            rows = conn.execute(
+                f"SELECT m.user_id, m.chat_id, m.topic_id, m.from_admin, m.created_at, "
+                f"snippet(messages_text, 0, '{MATCH_START}', '{MATCH_END}', '…', 16) "
+                f"FROM messages_text JOIN messages m ON m.id = messages_text.rowid "
+                f"WHERE messages_text MATCH ? ORDER BY messages_text.rowid DESC LIMIT ?",
+                (query, limit)
+            ).fetchall()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Transcript search failed for {query!r}: {e}")
+            return []
+        return [SearchHit(user_id, chat_id, topic_id, bool(from_admin), created_at, snippet)
+                for user_id, chat_id, topic_id, from_admin, created_at, snippet in rows]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error writing transcripts: {e}")
@@ -0,0 +1,260 @@
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+import zlib
+from typing import Any, Callable, Dict, List, Optional
+
+from telegram import Bot, Update
+from telegram.ext import Application
+
+from http_server import Request, Response, serve_http
+from logs import set_process_fields, setup_logging
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+SUPERVISE_INTERVAL = 1.0  # Как часто проверять, живы ли процессы-обработчики (сек)
+
+
+TopicOwner = Callable[[int, int], Optional[int]]
+
+
+def partition_key(data: Dict[str, Any], topic_owner: Optional[TopicOwner] = None) -> str:
+    """
+    Ключ раздела для сырого обновления: все обновления одного пользователя
+    (или одной темы в группе) должны попадать в один и тот же процесс.
+    Повторяет логику dispatch.conversation_key, но без разбора в объекты PTB.
+    topic_owner(chat_id, topic_id) находит пользователя темы: тогда ответы
+    админов попадают в тот же процесс, что и личка этого пользователя.
+    """
+    callback_query = data.get('callback_query')
+    if callback_query:
+        return f"user:{callback_query['from']['id']}"
+
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        message = data.get(field)
+        if message:
+            chat = message['chat']
+            if chat['type'] == 'private':
+                return f"user:{chat['id']}"
+            if message.get('is_topic_message'):
+                owner = topic_owner(chat['id'], message['message_thread_id']) if topic_owner else None
+                if owner is not None:
+                    return f"user:{owner}"
+                return f"topic:{chat['id']}:{message['message_thread_id']}"
+            return f"chat:{chat['id']}"
+
+    for field in ('my_chat_member', 'chat_member', 'chat_join_request'):
+        member = data.get(field)
+        if member:
+            return f"chat:{member['chat']['id']}"
+
+    return f"update:{data.get('update_id', 0)}"
+
+
+def choose_worker(data: Dict[str, Any], workers: int, topic_owner: Optional[TopicOwner] = None) -> int:
+    """Номер процесса для обновления (стабильный хеш, одинаковый во всех процессах)"""
+    return zlib.crc32(partition_key(data, topic_owner).encode()) % workers
+
+
+# ========== ПРОЦЕСС-ОБРАБОТЧИК ==========
+def _worker_main(index: int, updates: multiprocessing.Queue,
+                 build_application: Callable[[], Application]):
+    """Точка входа процесса-обработчика"""
+    # Остановкой управляет главный процесс через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Номер процесса - в каждой записи лога; логирование настраивает модуль бота
+    # при импорте (он уже загружен вместе с build_application)
+    set_process_fields(worker=index)
+    if not logging.getLogger().handlers:
+        setup_logging()
+    asyncio.run(_run_worker(index, updates, build_application))
+
+
+async def _run_worker(index: int, updates: multiprocessing.Queue,
+                      build_application: Callable[[], Application]):
+    application = build_application()
+    application.bot_data['worker_index'] = index
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info(f"Webhook worker {index} started")
+
+    loop = asyncio.get_running_loop()
+    try:
+        running = True
+        while running:
+            # Ждем в потоке первое обновление, остальные забираем пачкой без переключений
+            batch = [await loop.run_in_executor(None, updates.get)]
+            while True:
+                try:
+                    batch.append(updates.get_nowait())
+                except queue.Empty:
+                    break
+            for data in batch:
+                if data is None:
+                    running = False
+                    break
+                update = Update.de_json(json.loads(data), application.bot)
+                await application.update_queue.put(update)
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        logger.info(f"Webhook worker {index} stopped")
+
+
+# ========== ГЛАВНЫЙ ПРОЦЕСС ==========
+class WebhookServer:
+    """HTTP-сервер вебхука, раздающий обновления процессам-обработчикам.
+
+    Проверяет секретный токен из заголовка X-Telegram-Bot-Api-Secret-Token,
+    кладет обновление в очередь процесса, выбранного по хешу пользователя
+    (темы в группе - по ее пользователю, см. topic_owner), и отвечает
+    Telegram 200. Так порядок и кэши каждого разговора остаются внутри
+    одного процесса.
+
+    Упавший процесс перезапускается с той же очередью (supervise()). Пока
+    процесс недоступен или его очередь (queue_size) заполнена, вебхук
+    отвечает 503, и Telegram присылает обновление повторно.
+    """
+
+    def __init__(self, build_application: Callable[[], Application], workers: int,
+                 secret_token: str, path: str = '/webhook', queue_size: int = 10_000,
+                 topic_owner: Optional[TopicOwner] = None):
+        self.build_application = build_application
+        self.workers = workers
+        self.secret_token = secret_token
+        self.path = path
+        self.queue_size = queue_size
+        self.topic_owner = topic_owner
+        self._stopping = False
+
+        self._context = multiprocessing.get_context('spawn')
+        self._queues: List[multiprocessing.Queue] = []
+        self._processes: List[multiprocessing.Process] = []
+
+    def _spawn(self, index: int) -> multiprocessing.Process:
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self._queues[index], self.build_application),
+            name=f'webhook-worker-{index}'
+        )
+        process.start()
+        return process
+
+    def start_workers(self):
+        for index in range(self.workers):
+            self._queues.append(self._context.Queue(self.queue_size))
+            self._processes.append(self._spawn(index))
+
+    def supervise(self) -> int:
+        """Перезапустить упавшие процессы; возвращает, сколько перезапущено"""
+        if self._stopping:
+            return 0
+        restarted = 0
+        for index, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            # Необработанное осталось в очереди и достанется новому процессу;
+            # потеряны только обновления, которые упавший процесс уже забрал
+            logger.error(f"{process.name} exited with code {process.exitcode}, restarting")
+            self._processes[index] = self._spawn(index)
+            restarted += 1
+        return restarted
+
+    def stop_workers(self, timeout: float = 30):
+        self._stopping = True
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in {timeout}s, terminating")
+                process.terminate()
+
+    async def handle(self, request: Request) -> Response:
+        if request.path != self.path:
+            return Response(404)
+        if request.method != 'POST':
+            return Response(405)
+        secret = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(secret, self.secret_token):
+            return Response(403)
+
+        try:
+            data = request.json()
+            index = choose_worker(data, self.workers, self.topic_owner)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Bad webhook update: {e}")
+            return Response(400)
+
+        if not self._processes[index].is_alive():
+            self.supervise()
+            # Новый процесс еще запускается - Telegram повторит обновление
+            return Response(503)
+        try:
+            # Передаем исходный JSON, разбор в Update делает процесс-обработчик
+            self._queues[index].put_nowait(request.body.decode())
+        except queue.Full:
+            logger.warning(f"Webhook worker {index} queue is full, asking Telegram to retry")
+            return Response(503)
+        return Response(200)
+
+
+async def _serve(server: WebhookServer, token: str, listen: str, port: int,
+                 url: Optional[str], base_url: Optional[str], allowed_updates: List[str]):
+    http = await serve_http(server.handle, listen, port)
+    if url:
+        bot = Bot(token, base_url=base_url) if base_url else Bot(token)
+        async with bot:
+            await bot.set_webhook(url=url, secret_token=server.secret_token,
+                                  allowed_updates=allowed_updates)
+        logger.info(f"Webhook set to {url}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: остановка по KeyboardInterrupt
+            pass
+
+    async with http:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), SUPERVISE_INTERVAL)
+            except asyncio.TimeoutError:
+                server.supervise()
+
+
+def run_webhook(build_application: Callable[[], Application], token: str, secret_token: str,
+                listen: str = '0.0.0.0', port: int = 8443, url: Optional[str] = None,
+                workers: int = 4, base_url: Optional[str] = None,
+                allowed_updates: Optional[List[str]] = None, queue_size: int = 10_000,
+                topic_owner: Optional[TopicOwner] = None):
+    """
+    Запустить бота в режиме вебхука с workers процессами-обработчиками.
+    build_application должен быть функцией уровня модуля (или functools.partial от нее),
+    чтобы его можно было передать в дочерний процесс. topic_owner вызывается
+    в главном процессе (см. WebhookServer).
+    """
+    server = WebhookServer(build_application, workers, secret_token, queue_size=queue_size,
+                           topic_owner=topic_owner)
+    server.start_workers()
+    try:
+        asyncio.run(_serve(server, token, listen, port, url, base_url,
+                           allowed_updates or Update.ALL_TYPES))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop_workers()